@@ -0,0 +1,463 @@
+import asyncio
+import os
+import serial
+import sys
+from Util import FrameDecoder, ResponseDataFrame, GenyFaultError
+from SerialMonitor import SerialMonitor
+from ErrorCalibration import EnergyErrorCalibration, SamplingData, ErrorSamplingData, SettleDetector
+from GenyTestBench import GenyTestBench
+import time
+
+class AsyncSerialTransport:
+    '''
+        Non-blocking GENY serial handler for asyncio. Received bytes are read from the event loop
+        (add_reader on POSIX, polling task elsewhere) and decoded with FrameDecoder. Commands are written on the
+        non-blocking file descriptor, waiting with add_writer when the output buffer is full (executor thread elsewhere).
+    '''
+    READ_CHUNK_SIZE = 4096
+    POLL_INTERVAL = 0.002 # Used only when event loop can not watch the serial file descriptor
+
+    def __init__(self, usb_port:str, baudrate:int, onReceive=None):
+        '''
+            params:
+                usb_port (str) USB path attached to GENY test bench
+                baudrate (int) Baudrate used to communicate with the test benchs
+                onReceive (function) Function used as callback when there is frame received from test bench
+        '''
+        options = {}
+        if sys.platform.startswith('linux') or sys.platform.startswith('cygwin'):
+            options['exclusive'] = True
+        self.ser = serial.Serial(
+            port = usb_port,
+            baudrate = baudrate,
+            parity = serial.PARITY_NONE,
+            bytesize = serial.EIGHTBITS,
+            stopbits = serial.STOPBITS_ONE,
+            timeout = 0, # non-blocking read
+            **options
+        )
+        self.port = usb_port
+        self.callback = onReceive
+        self.decoder = FrameDecoder(self.onFrame, checkCRC=True)
+        self.chunk = bytearray(AsyncSerialTransport.READ_CHUNK_SIZE)
+        self.view = memoryview(self.chunk)
+        self.pending = None
+        self.pendingCommand = None
+        self.listeners = {}
+        self.fault = None
+        self.faultHandlers = ()
+        self.loop = None
+        self.poller = None
+        self.lock = None
+        self.closed = False # set when the port disconnected
+
+    def startMonitor(self):
+        '''
+            Reading is attached to the running event loop on first transaction
+        '''
+        pass
+
+    def attach(self):
+        '''
+            Start reading serial from the running event loop
+        '''
+        if self.loop != None:
+            return
+        self.loop = asyncio.get_running_loop()
+        self.lock = asyncio.Lock()
+        try:
+            self.loop.add_reader(self.ser.fileno(), self.onReadable)
+        except (NotImplementedError, AttributeError):
+            self.poller = self.loop.create_task(self.poll())
+
+    async def write(self, dataFrame:bytes):
+        '''
+            Send data frame without blocking the event loop
+        '''
+        if self.poller != None: # no file descriptor support, let a worker thread block
+            await self.loop.run_in_executor(None, self.ser.write, dataFrame)
+            return
+        fd = self.ser.fileno() # opened with O_NONBLOCK by pyserial
+        view = memoryview(dataFrame)
+        while len(view) > 0:
+            try:
+                written = os.write(fd, view)
+            except BlockingIOError:
+                written = 0
+            view = view[written:]
+            if len(view) > 0:
+                await self.writable(fd)
+
+    async def writable(self, fd:int):
+        '''
+            Wait until the serial output buffer accepts more bytes
+        '''
+        ready = self.loop.create_future()
+        self.loop.add_writer(fd, lambda: ready.done() or ready.set_result(None))
+        try:
+            await ready
+        finally:
+            self.loop.remove_writer(fd)
+
+    async def exchange(self, dataFrame:bytes, pending) -> bytes:
+        await self.write(dataFrame)
+        return await pending
+
+    async def poll(self):
+        while self.loop != None:
+            try:
+                waiting = self.ser.in_waiting
+            except (serial.SerialException, OSError):
+                self.onDisconnect()
+                return
+            if waiting:
+                self.onReadable()
+            await asyncio.sleep(AsyncSerialTransport.POLL_INTERVAL)
+
+    def detach(self):
+        '''
+            Stop reading serial from the event loop
+        '''
+        if self.loop != None:
+            if self.poller != None:
+                self.poller.cancel()
+                self.poller = None
+            else:
+                self.loop.remove_reader(self.ser.fileno())
+            self.loop = None
+
+    def stopMonitor(self, isBlocking=True):
+        '''
+            Detach from event loop and close serial port
+        '''
+        self.detach()
+        self.ser.close()
+
+    def onDisconnect(self):
+        '''
+            Serial port is gone (device unplugged, pty closed): stop reading, close the port and fail the waiting
+            request with ConnectionError, same as SerialMonitor.onDisconnect
+        '''
+        print(f'[AsyncSerialTransport] {self.port} disconnected')
+        self.closed = True
+        self.detach()
+        pending = self.pending
+        self.pending = None
+        if pending != None and not pending.done():
+            pending.set_exception(ConnectionError(f'Serial port {self.port} disconnected'))
+        try:
+            self.ser.close()
+        except Exception:
+            pass
+
+    def onReadable(self):
+        '''
+            Readable without any byte is end of file (hang up), pyserial reports it as SerialException
+        '''
+        try:
+            received = self.ser.readinto(self.view[:AsyncSerialTransport.READ_CHUNK_SIZE])
+        except (serial.SerialException, OSError):
+            self.onDisconnect()
+            return
+        if received:
+            self.decoder.feed(self.view[:received])
+
+    def addListener(self, command:int, listener):
+        '''
+            Same as SerialMonitor.addListener, listener is called from event loop
+        '''
+        self.listeners[command] = self.listeners.get(command, ()) + (listener,)
+
+    def removeListener(self, command:int, listener):
+        listeners = tuple(fn for fn in self.listeners.get(command, ()) if fn != listener)
+        if len(listeners) > 0:
+            self.listeners[command] = listeners
+        else:
+            self.listeners.pop(command, None)
+
+    def addFaultHandler(self, handler):
+        '''
+            Same as SerialMonitor.addFaultHandler, handler is called from event loop
+        '''
+        self.faultHandlers = self.faultHandlers + (handler,)
+
+    def removeFaultHandler(self, handler):
+        self.faultHandlers = tuple(fn for fn in self.faultHandlers if fn != handler)
+
+    def clearFault(self):
+        self.fault = None
+
+    def onFault(self, frame:bytes):
+        fault = GenyFaultError(self.port, frame)
+        self.fault = fault
+        pending = self.pending
+        self.pending = None
+        if pending != None and not pending.done():
+            pending.set_exception(GenyFaultError(self.port, frame))
+        for handler in self.faultHandlers:
+            try:
+                handler(fault)
+            except Exception as e:
+                print(f'[AsyncSerialTransport] fault handler failed: {e}')
+
+    def onFrame(self, frame:bytes):
+        command = frame[FrameDecoder.HEADER_LENGTH]
+        if command in SerialMonitor.FAULT_COMMANDS:
+            self.onFault(frame)
+            if self.callback != None:
+                self.callback(frame)
+            return
+        listeners = self.listeners.get(command)
+        pending = self.pending
+        if pending != None and not pending.done() and self.pendingCommand == command:
+            self.pending = None
+            pending.set_result(frame)
+        elif listeners == None:
+            print(f'[AsyncSerialTransport] {self.port} dropping unexpected frame of command {hex(command)}')
+        if listeners != None:
+            for listener in listeners:
+                try:
+                    listener(frame)
+                except Exception as e:
+                    print(f'[AsyncSerialTransport] listener of command {hex(command)} failed: {e}')
+        if self.callback != None:
+            self.callback(frame)
+
+    async def transaction(self, dataFrame:bytes, timeout=10) -> bytes:
+        '''
+            Awaitable version of SerialMonitor.transaction. Return b'' on timeout, raise GenyFaultError on test bench fault
+            and ConnectionError once the serial port disconnected
+
+            parameter
+                dataFrame (bytes) data farme will be sent to test bench
+                timeout (int) how much time for waiting serial answer in second
+        '''
+        if self.closed:
+            raise ConnectionError(f'Serial port {self.port} disconnected')
+        self.attach()
+        if self.fault != None:
+            raise GenyFaultError(self.port, self.fault.frame)
+        async with self.lock:
+            pending = self.loop.create_future()
+            self.pendingCommand = dataFrame[FrameDecoder.HEADER_LENGTH]
+            self.pending = pending
+            try:
+                return await asyncio.wait_for(self.exchange(dataFrame, pending), timeout)
+            except asyncio.TimeoutError:
+                return b''
+            finally:
+                self.pending = None
+
+class AsyncGenyTestBench(GenyTestBench):
+    '''
+        asyncio version of GenyTestBench. Setters are the same, every method doing serial transaction is awaitable
+    '''
+    def createSerialMonitor(self):
+        return AsyncSerialTransport(self.usbport, self.baudrate, self.onSerialReceived)
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def request(self, buffer:bytes) -> ResponseDataFrame:
+        result = await self.serialMonitor.transaction(buffer)
+        if result == b'':
+            raise TimeoutError
+        response = ResponseDataFrame()
+        response.extractDataFrame(result)
+        return response
+
+    # API
+    async def open(self):
+        self.energyErrorCalibration.markApplied(None)
+        self.serialMonitor.clearFault()
+        response = await self.request(self.connect())
+        return response.getErrorCode() == 0
+
+    async def close(self):
+        self.energyErrorCalibration.markApplied(None)
+        response = await self.request(self.disconnect())
+        return response.getErrorCode() == 0
+
+    async def apply(self, force:bool=False):
+        '''
+            Apply configuration on test bench, see GenyTestBench.apply
+        '''
+        if self.mode == GenyTestBench.Mode.ENERGY_ERROR_CALIBRATION:
+            buffer, register = self.energyErrorCalibration.applyCommandForm(force)
+            if buffer == None:
+                return True
+            self.lastSampling = None # sampled power of the previous point, no longer valid for errorResultSchedule
+            try:
+                response = await self.request(buffer)
+            except Exception:
+                self.energyErrorCalibration.markApplied(None) # configuration running on the test bench is unknown
+                raise
+            if response.getErrorCode() == 0:
+                self.energyErrorCalibration.markApplied(register)
+                self.appliedAt = time.monotonic()
+                return True
+            self.energyErrorCalibration.markApplied(None)
+            return False
+
+    async def waitSettled(self, tolerance:float=0.002, window:int=3, phaseTolerance:float=0.5, timeout:float=30, interval:float=0.2, stream:bool=False) -> float:
+        '''
+            Wait until readback sampling match the applied configuration, see GenyTestBench.waitSettled
+        '''
+        if self.mode == GenyTestBench.Mode.ENERGY_ERROR_CALIBRATION:
+            detector = SettleDetector(self.energyErrorCalibration, tolerance, window, phaseTolerance)
+            start = time.monotonic()
+            since = self.appliedAt if self.appliedAt != None else start
+            deadline = start + timeout
+            if stream:
+                samples = self.streamSamplingData(timeout=timeout)
+                try:
+                    async for sample in samples:
+                        if detector.update(sample):
+                            return time.monotonic() - since
+                        if time.monotonic() > deadline:
+                            break
+                finally:
+                    await samples.aclose()
+            else:
+                while True:
+                    polled = time.monotonic()
+                    if detector.update(await self.readBackSamplingData()):
+                        return time.monotonic() - since
+                    if polled + interval > deadline:
+                        break
+                    await asyncio.sleep(max(interval - (time.monotonic() - polled), 0))
+            raise TimeoutError(f'Test bench not settled after {timeout} s')
+
+    async def readBackSamplingData(self) -> SamplingData:
+        if self.mode == GenyTestBench.Mode.ENERGY_ERROR_CALIBRATION:
+            response = await self.request(self.energyErrorCalibration.readbackSampling())
+            self.lastSampling = self.energyErrorCalibration.readbackSamplingRegister.extractSample(response, time.time())
+            return self.lastSampling
+
+    async def waitForErrorResult(self, power:float=None, margin:float=0.9, timeout:float=None, interval:float=0.1, maxInterval:float=2.0, backoff:float=1.5) -> ErrorSamplingData:
+        '''
+            Wait for a finished error measurement, see GenyTestBench.waitForErrorResult
+        '''
+        if self.mode == GenyTestBench.Mode.ENERGY_ERROR_CALIBRATION:
+            expected, deadline = self.errorResultSchedule(power, timeout)
+            since = self.appliedAt if self.appliedAt != None else time.monotonic()
+            if expected != None:
+                await asyncio.sleep(max(since + margin * expected - time.monotonic(), 0))
+            while True:
+                sample = await self.readBackError()
+                if sample.ValidFlagBit:
+                    return sample
+                if time.monotonic() + interval > deadline:
+                    raise TimeoutError(f'No error result before deadline (expected measurement time {expected} s)')
+                await asyncio.sleep(interval)
+                interval = min(interval * backoff, maxInterval)
+
+    async def readBackError(self) -> ErrorSamplingData:
+        if self.mode == GenyTestBench.Mode.ENERGY_ERROR_CALIBRATION:
+            response = await self.request(self.energyErrorCalibration.readbackErrorSampling())
+            return self.energyErrorCalibration.errorSamplingRegister.extractSample(response, time.time())
+
+    async def readBackSamplingAndError(self, timeout=10) -> tuple:
+        '''
+            Request readback sampling data and readback error sampling concurrently, the transport sends them one after
+            the other. Return (SamplingData, ErrorSamplingData)
+        '''
+        if self.mode == GenyTestBench.Mode.ENERGY_ERROR_CALIBRATION:
+            calibration = self.energyErrorCalibration
+            try:
+                sampling, error = await asyncio.wait_for(asyncio.gather(
+                    self.request(calibration.readbackSampling()),
+                    self.request(calibration.readbackErrorSampling()),
+                ), timeout)
+            except asyncio.TimeoutError:
+                raise TimeoutError
+            timestamp = time.time()
+            return calibration.readbackSamplingRegister.extractSample(sampling, timestamp), calibration.errorSamplingRegister.extractSample(error, timestamp)
+
+    # STREAMING
+    async def startStream(self, command:int, requestForm, register, callback):
+        if command in self.streams:
+            raise RuntimeError(f'Stream of command {hex(command)} is already running')
+
+        def listener(frame:bytes):
+            timestamp = time.time()
+            response = ResponseDataFrame()
+            response.extractDataFrame(frame)
+            if response.getErrorCode() == 0:
+                callback(register.extractSample(response, timestamp))
+
+        self.streams[command] = (requestForm, listener)
+        self.serialMonitor.addListener(command, listener)
+        result = await self.serialMonitor.transaction(requestForm('*'))
+        if result == b'':
+            await self.stopStream(command)
+            raise TimeoutError
+
+    async def startSamplingStream(self, callback):
+        if self.mode == GenyTestBench.Mode.ENERGY_ERROR_CALIBRATION:
+            await self.startStream(
+                EnergyErrorCalibration.Command.READBACK_SAMPLING_DATA,
+                self.energyErrorCalibration.readbackSampling,
+                self.energyErrorCalibration.readbackSamplingRegister,
+                callback
+            )
+
+    async def startErrorStream(self, callback):
+        if self.mode == GenyTestBench.Mode.ENERGY_ERROR_CALIBRATION:
+            await self.startStream(
+                EnergyErrorCalibration.Command.READBACK_ERROR_SAMPLING,
+                self.energyErrorCalibration.readbackErrorSampling,
+                self.energyErrorCalibration.errorSamplingRegister,
+                callback
+            )
+
+    async def stopStream(self, command:int=None):
+        commands = list(self.streams) if command == None else [command]
+        for command in commands:
+            stream = self.streams.pop(command, None)
+            if stream == None:
+                continue
+            requestForm, listener = stream
+            self.serialMonitor.removeListener(command, listener)
+            try:
+                await self.serialMonitor.transaction(requestForm(0))
+            except GenyFaultError:
+                pass # tripped test bench stopped streaming by itself
+
+    def streamSamplingData(self, count:int=None, timeout=10):
+        '''
+            Async generator of SamplingData pushed by test bench in continuous mode
+        '''
+        return self.iterateStream(self.startSamplingStream, EnergyErrorCalibration.Command.READBACK_SAMPLING_DATA, count, timeout)
+
+    def streamError(self, count:int=None, timeout=10):
+        '''
+            Async generator of ErrorSamplingData pushed by test bench in continuous mode
+        '''
+        return self.iterateStream(self.startErrorStream, EnergyErrorCalibration.Command.READBACK_ERROR_SAMPLING, count, timeout)
+
+    async def iterateStream(self, start, command:int, count:int, timeout):
+        samples = asyncio.Queue()
+        await start(samples.put_nowait)
+        onFault = samples.put_nowait # GenyFaultError is queued as sentinel, see GenyTestBench.iterateStream
+        self.serialMonitor.addFaultHandler(onFault)
+        if self.serialMonitor.fault != None:
+            onFault(self.serialMonitor.fault)
+        try:
+            received = 0
+            while count == None or received < count:
+                try:
+                    sample = await asyncio.wait_for(samples.get(), timeout)
+                except asyncio.TimeoutError:
+                    raise TimeoutError
+                if isinstance(sample, GenyFaultError):
+                    raise GenyFaultError(sample.port, sample.frame)
+                received += 1
+                yield sample
+        finally:
+            self.serialMonitor.removeFaultHandler(onFault)
+            await self.stopStream(command)
@@ -0,0 +1,213 @@
+from Util import FrameDecoder, CRC16, ResponseDataFrame
+from ErrorCalibration import EnergyErrorCalibration, SamplingData
+from WireCapture import WireCapture, WireReplay
+from concurrent.futures import ProcessPoolExecutor
+import mmap
+import os
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+class BatchResult:
+    '''
+        Output of BatchDecoder. sampling and error are numpy structured arrays with the frame offset in the buffer
+        followed by the decoded registers (SamplingData and ErrorSamplingData field names)
+    '''
+    def __init__(self, sampling, error, starts, ends, crcErrors:int=0):
+        self.sampling = sampling
+        self.error = error
+        self.starts = starts # offset of every valid frame, all commands
+        self.ends = ends # offset after the EOI of every valid frame
+        self.crcErrors = crcErrors
+
+    @property
+    def frames(self) -> int:
+        return len(self.starts)
+
+    def toDict(self) -> dict:
+        return {
+            'frames': self.frames,
+            'sampling': len(self.sampling),
+            'error': len(self.error),
+            'crcErrors': self.crcErrors,
+        }
+
+class BatchDecoder:
+    '''
+        Vectorised decoder of concatenated response frames (bytes, bytearray or mmap). Frame boundaries, CRC16 and
+        readback payloads are processed with numpy over the whole buffer instead of frame by frame. Require numpy
+    '''
+    DATA_OFFSET = FrameDecoder.HEADER_LENGTH + ResponseDataFrame.COMMAND_BIT_LENGTH + ResponseDataFrame.ERROR_CODE_BIT_LENGTH
+    FRAME_OVERHEAD = FrameDecoder.HEADER_LENGTH + FrameDecoder.TRAILER_LENGTH
+    CHUNK_SIZE = 64 * 1024 * 1024 # bytes per region, bounds the temporary arrays of one decode
+    SAMPLING_DTYPE = [(name, EnergyErrorCalibration.ReadbackSamplingDataRegister.DTYPE) for name, _ in SamplingData.FIELDS]
+    ERROR_DTYPE = EnergyErrorCalibration.ReadBackErrorSamplingDataRegister.DTYPE
+
+    def outputDtype(dataDtype):
+        return np.dtype([('offset', '<i8')] + np.dtype(dataDtype).descr)
+
+    def findFrames(data, start:int=0, end:int=None, maxLength:int=FrameDecoder.MAX_LENGTH) -> tuple:
+        '''
+            Return (starts, ends, crcErrors) of valid frames starting inside data[start:end]. Frames may end after end.
+            Candidates are every SOI with a plausible LEN, matching EOI and CRC16, then overlapping candidates are
+            resolved from the first one like a stream decoder would
+
+            parameters:
+                data (numpy.ndarray) uint8 view of the whole buffer
+        '''
+        end = len(data) if end == None else end
+        starts = np.flatnonzero(data[start:end] == ResponseDataFrame.SOI_CONSTANT) + start
+        starts = starts[starts + FrameDecoder.HEADER_LENGTH <= len(data)]
+        length = np.zeros(len(starts), dtype=np.int64)
+        for i in range(4): # LEN, little endian
+            length |= data[starts + 1 + i].astype(np.int64) << (8 * i)
+        ends = starts + length + BatchDecoder.FRAME_OVERHEAD
+        valid = (length >= FrameDecoder.MIN_RESPONSE_LENGTH) & (length <= maxLength) & (ends <= len(data))
+        starts, ends, length = starts[valid], ends[valid], length[valid]
+        valid = data[ends - 1] == ResponseDataFrame.EOI_CONSTANT
+        starts, ends, length = starts[valid], ends[valid], length[valid]
+
+        crcValid = np.zeros(len(starts), dtype=bool)
+        for size in np.unique(length):
+            group = np.flatnonzero(length == size)
+            rows = data[starts[group, None] + np.arange(FrameDecoder.HEADER_LENGTH, FrameDecoder.HEADER_LENGTH + size)]
+            crc = CRC16.crcRows(rows)
+            crcOffset = starts[group] + FrameDecoder.HEADER_LENGTH + size
+            crcValid[group] = ((data[crcOffset] == (crc >> 8)) & (data[crcOffset + 1] == (crc & 0xFF)))
+
+        keptStarts, keptEnds = BatchDecoder.resolveOverlap(starts[crcValid], ends[crcValid])
+        # CRC failures not hidden inside an accepted frame are real corrupted frames
+        failed = starts[~crcValid]
+        inside = np.searchsorted(keptStarts, failed, side='right') - 1
+        hidden = (inside >= 0) & (failed < keptEnds[np.maximum(inside, 0)])
+        return keptStarts, keptEnds, int(np.count_nonzero(~hidden))
+
+    def resolveOverlap(starts, ends) -> tuple:
+        '''
+            Keep frames in order, dropping every frame starting inside the previous kept one
+        '''
+        if len(starts) < 2 or np.all(starts[1:] >= ends[:-1]):
+            return starts, ends
+        keep = np.zeros(len(starts), dtype=bool)
+        last = -1
+        for i, (start, end) in enumerate(zip(starts.tolist(), ends.tolist())):
+            if start >= last:
+                keep[i] = True
+                last = end
+        return starts[keep], ends[keep]
+
+    def extract(data, starts, ends, command:int, dataDtype):
+        '''
+            Return structured array of the DATA field of every successful frame of command
+        '''
+        dtype = np.dtype(dataDtype)
+        size = dtype.itemsize
+        selected = starts[(data[starts + FrameDecoder.HEADER_LENGTH] == command)
+                          & (data[starts + BatchDecoder.DATA_OFFSET - 1] == 0)
+                          & (ends - starts == BatchDecoder.DATA_OFFSET + size + FrameDecoder.TRAILER_LENGTH)]
+        rows = data[selected[:, None] + np.arange(BatchDecoder.DATA_OFFSET, BatchDecoder.DATA_OFFSET + size)]
+        values = np.ascontiguousarray(rows).view(dtype).reshape(len(selected))
+        output = np.empty(len(selected), dtype=BatchDecoder.outputDtype(dataDtype))
+        output['offset'] = selected
+        for name in dtype.names:
+            output[name] = values[name]
+        return output
+
+    def decode(buffer, start:int=0, end:int=None, maxLength:int=FrameDecoder.MAX_LENGTH) -> BatchResult:
+        '''
+            Decode frames starting inside buffer[start:end] in one process
+
+            parameters:
+                buffer (bytes|bytearray|mmap|memoryview) concatenated received bytes
+        '''
+        if np == None:
+            raise ImportError('numpy is required for BatchDecoder')
+        data = np.frombuffer(buffer, dtype=np.uint8)
+        starts, ends, crcErrors = BatchDecoder.findFrames(data, start, end, maxLength)
+        return BatchResult(
+            BatchDecoder.extract(data, starts, ends, EnergyErrorCalibration.Command.READBACK_SAMPLING_DATA, BatchDecoder.SAMPLING_DTYPE),
+            BatchDecoder.extract(data, starts, ends, EnergyErrorCalibration.Command.READBACK_ERROR_SAMPLING, BatchDecoder.ERROR_DTYPE),
+            starts, ends, crcErrors,
+        )
+
+    def decodeFileRegions(path:str, regions:list, maxLength:int=FrameDecoder.MAX_LENGTH) -> list:
+        '''
+            Map the file once and decode the frames starting inside every (start, end) region, one region at a time.
+            Return list of BatchResult
+        '''
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            results = [BatchDecoder.decode(buffer, start, end, maxLength) for start, end in regions]
+            del buffer # numpy views shall be gone before the mapping closes
+        return results
+
+    def decodeFileRegion(path:str, start:int, end:int, maxLength:int=FrameDecoder.MAX_LENGTH) -> BatchResult:
+        '''
+            Process pool job: map the file and decode frames starting inside [start, end)
+        '''
+        return BatchDecoder.decodeFileRegions(path, [(start, end)], maxLength)[0]
+
+    def merge(results:list) -> BatchResult:
+        '''
+            Join results of consecutive regions, a frame found by two regions is kept once
+        '''
+        starts, ends = BatchDecoder.resolveOverlap(
+            np.concatenate([result.starts for result in results]),
+            np.concatenate([result.ends for result in results]),
+        )
+        sampling = np.concatenate([result.sampling for result in results])
+        error = np.concatenate([result.error for result in results])
+        return BatchResult(
+            sampling[np.isin(sampling['offset'], starts)],
+            error[np.isin(error['offset'], starts)],
+            starts, ends, sum(result.crcErrors for result in results),
+        )
+
+    def decodeFile(path:str, processes:int=None, chunkSize:int=CHUNK_SIZE, maxLength:int=FrameDecoder.MAX_LENGTH) -> BatchResult:
+        '''
+            Decode a file of concatenated received bytes. The file is split in chunkSize regions so the temporary arrays
+            never cover the whole file, regions are decoded one after the other in this process or, with processes > 1,
+            in a process pool where every worker maps the file itself
+
+            parameters:
+                path (str) raw byte file (see BatchDecoder.exportCapture for WireCapture logs)
+                processes (int) number of worker processes, None or 1 to decode in this process
+                chunkSize (int) bytes per region
+        '''
+        size = os.path.getsize(path)
+        if size == 0:
+            return BatchDecoder.decode(b'')
+        regions = [(offset, min(offset + chunkSize, size)) for offset in range(0, size, chunkSize)]
+        if processes == None or processes <= 1 or len(regions) == 1:
+            results = BatchDecoder.decodeFileRegions(path, regions, maxLength)
+        else:
+            with ProcessPoolExecutor(max_workers=processes) as executor:
+                results = list(executor.map(BatchDecoder.decodeFileRegion, *zip(*[(path, a, b, maxLength) for a, b in regions])))
+        return results[0] if len(results) == 1 else BatchDecoder.merge(results)
+
+    def exportCapture(capturePath:str, outputPath:str, direction:int=WireCapture.RX) -> int:
+        '''
+            Write the bytes of one direction of a WireCapture log back to back into outputPath. Return number of bytes
+        '''
+        written = 0
+        with WireReplay(capturePath) as replay, open(outputPath, 'wb') as output:
+            for _, _, chunk in replay.records(direction=direction):
+                output.write(chunk)
+                written += len(chunk)
+                chunk.release()
+        return written
+
+if __name__ == '__main__':
+    import json
+    import sys
+    import time
+
+    if len(sys.argv) < 2:
+        print('usage: python BatchDecoder.py <raw bytes file> [processes]')
+        exit(1)
+    start = time.perf_counter()
+    result = BatchDecoder.decodeFile(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else None)
+    report = result.toDict()
+    report['seconds'] = time.perf_counter() - start
+    print(json.dumps(report, indent=2))
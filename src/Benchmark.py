@@ -0,0 +1,161 @@
+from Util import Util, CommmandDataFrame, ResponseDataFrame, FrameDecoder, FrameEncoder, CRC16
+from ErrorCalibration import EnergyErrorCalibration
+from GenySimulator import GenySimulator
+from SerialMonitor import SerialMonitor
+from GenySystemCommand import GenySys
+import argparse
+import contextlib
+import json
+import platform
+import struct
+import sys
+import time
+
+class Benchmark:
+    '''
+        Micro benchmarks of the serial stack hot paths. Every case is timed call by call, the report is JSON
+        (python Benchmark.py --help)
+    '''
+    PERCENTILES = (50, 90, 99)
+
+    def __init__(self, iterations:int=20000, roundTrips:int=500, warmup:int=100):
+        '''
+            params:
+                iterations (int) calls per in-memory case
+                roundTrips (int) transactions per serial round trip case
+                warmup (int) untimed calls before each case
+        '''
+        self.iterations = iterations
+        self.roundTrips = roundTrips
+        self.warmup = warmup
+        self.results = {}
+
+    def measure(self, name:str, function, iterations:int=None) -> dict:
+        '''
+            Time function() call by call. Return and record ops/sec and latency percentiles in microsecond
+        '''
+        iterations = self.iterations if iterations == None else iterations
+        for _ in range(self.warmup):
+            function()
+        clock = time.perf_counter_ns
+        samples = [0] * iterations
+        start = clock()
+        for i in range(iterations):
+            t = clock()
+            function()
+            samples[i] = clock() - t
+        total = clock() - start
+        samples.sort()
+        result = {
+            'iterations': iterations,
+            'opsPerSec': iterations * 1e9 / total,
+            'meanUs': sum(samples) / iterations / 1000,
+            'minUs': samples[0] / 1000,
+            'maxUs': samples[-1] / 1000,
+        }
+        for percentile in Benchmark.PERCENTILES:
+            result[f'p{percentile}Us'] = samples[min(iterations * percentile // 100, iterations - 1)] / 1000
+        self.results[name] = result
+        return result
+
+    def legacyCRC(data_frame) -> list:
+        '''
+            Byte-by-byte table CRC of the first Util.calc_CRC, kept as the 'crc.legacy' reference now that
+            Util.calc_CRC delegates to CRC16. Return [Low Byte CRC, High Byte CRC]
+        '''
+        l_CRCHi = 0xFF
+        l_CRCLo = 0xFF
+        l_Index = 0
+        for i in data_frame:
+            l_Index = l_CRCHi ^ i
+            l_CRCHi = l_CRCLo ^ Util.ct_ArrayCRCHi[l_Index]
+            l_CRCLo = Util.ct_ArrayCRCLo[l_Index]
+        return [l_CRCLo, l_CRCHi]
+
+    #
+    # Cases
+    #
+    def frames(self) -> tuple:
+        '''
+            Return (test command frame, sampling response frame) used by the in-memory cases
+        '''
+        calibration = EnergyErrorCalibration()
+        calibration.setVoltage(220.0)
+        calibration.setCurrent(5.0)
+        command = calibration.setTestCommandForm()
+        body = bytes((EnergyErrorCalibration.Command.READBACK_SAMPLING_DATA, 0x00, 0x00)) + struct.pack('<20f', *range(20))
+        response = ResponseDataFrame.HEADER_STRUCT.pack(ResponseDataFrame.SOI_CONSTANT, len(body)) + body + CRC16.calc(body) + bytes((ResponseDataFrame.EOI_CONSTANT,))
+        return command, response
+
+    def runCodec(self):
+        command, response = self.frames()
+        payload = list(command[FrameDecoder.HEADER_LENGTH:-FrameDecoder.TRAILER_LENGTH])
+        data = payload[CommmandDataFrame.COMMAND_BIT_LENGTH:]
+        commandFrame = CommmandDataFrame()
+        responseFrame = ResponseDataFrame()
+        decodedResponse = ResponseDataFrame()
+        decodedResponse.extractDataFrame(response)
+        calibration = EnergyErrorCalibration()
+        encoder = FrameEncoder(EnergyErrorCalibration.Command.TEST_COMMAND, EnergyErrorCalibration.TEST_COMMAND_LAYOUT)
+        register = calibration.getRegister()
+        decoder = FrameDecoder(checkCRC=True)
+        stream = response * 16
+
+        self.measure('crc.legacy', lambda: Benchmark.legacyCRC(payload))
+        self.measure('crc.calc_CRC', lambda: Util.calc_CRC(payload))
+        self.measure('crc.CRC16.calc', lambda: CRC16.calc(command[FrameDecoder.HEADER_LENGTH:-FrameDecoder.TRAILER_LENGTH]))
+        self.measure('encode.genDataFrame', lambda: commandFrame.genDataFrame(EnergyErrorCalibration.Command.TEST_COMMAND, data))
+        self.measure('encode.FrameEncoder', lambda: encoder.encode(*register))
+        self.measure('encode.setTestCommandForm', calibration.setTestCommandForm)
+        self.measure('decode.CommmandDataFrame.extractDataFrame', lambda: commandFrame.extractDataFrame(command))
+        self.measure('decode.ResponseDataFrame.extractDataFrame', lambda: responseFrame.extractDataFrame(response))
+        self.measure('decode.FrameDecoder.feed16', lambda: decoder.feed(stream), self.iterations // 16 or 1)
+        self.measure('register.extractResponseDataFrame', lambda: calibration.readbackSamplingRegister.extractResponseDataFrame(decodedResponse))
+        self.measure('register.extractSample', lambda: calibration.readbackSamplingRegister.extractSample(decodedResponse))
+
+    def runRoundTrip(self, latency:float=0.0, baudrate:int=0, maxInFlight:int=1):
+        '''
+            Time SerialMonitor.transaction against GenySimulator
+        '''
+        name = f'roundtrip.transaction[latency={latency},baudrate={baudrate}]'
+        calibration = EnergyErrorCalibration()
+        request = calibration.readbackSampling()
+        with contextlib.redirect_stdout(sys.stderr), GenySimulator(baudrate=baudrate, latency=latency) as simulator: # keep stdout for the report
+            monitor = SerialMonitor(simulator.port, 115200, None, maxInFlight=maxInFlight, verbose=False)
+            monitor.startMonitor()
+            transaction = monitor.transaction
+            try:
+                transaction(GenySys().connect())
+                self.measure(name, lambda: transaction(request), self.roundTrips)
+            finally:
+                monitor.stopMonitor()
+
+    def report(self) -> dict:
+        return {
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'timestamp': time.time(),
+            'results': self.results,
+        }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='GENY serial stack benchmark, print JSON report')
+    parser.add_argument('--iterations', type=int, default=20000, help='calls per in-memory case')
+    parser.add_argument('--round-trips', type=int, default=500, help='transactions per round trip case')
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated bench latency in second')
+    parser.add_argument('--baudrate', type=int, default=0, help='simulated line speed, 0 for unpaced')
+    parser.add_argument('--skip-roundtrip', action='store_true', help='only run in-memory cases')
+    parser.add_argument('--output', default=None, help='write report to file instead of stdout')
+    args = parser.parse_args()
+
+    benchmark = Benchmark(args.iterations, args.round_trips)
+    benchmark.runCodec()
+    if not args.skip_roundtrip and not sys.platform.startswith('win'):
+        benchmark.runRoundTrip(args.latency, args.baudrate)
+    report = json.dumps(benchmark.report(), indent=2)
+    if args.output != None:
+        with open(args.output, 'w') as f:
+            f.write(report)
+    else:
+        print(report)
@@ -0,0 +1,234 @@
+from Util import VoltageRange, CurrentRange, ElementSelector
+from Util import VoltageRangeError, CurrentRangeError
+from ErrorCalibration import EnergyErrorCalibration, SamplingData, ErrorSamplingData
+from GenyTestBench import GenyTestBench
+import time
+
+class TestPoint:
+    '''
+        One operating point of a calibration sweep. voltageRange and currentRange are filled by CalibrationSweep.plan()
+    '''
+    def __init__(self, voltage:float, current:float, powerFactor:float=1.0,
+                 element=ElementSelector.EnergyErrorCalibration._COMBINE_ALL,
+                 powerFactorUnit:int=EnergyErrorCalibration.PFUnit._L, frequency:float=50, name:str=None):
+        '''
+            params:
+                voltage (float) voltage amplitude
+                current (float) current amplitude
+                powerFactor (float) power factor
+                element (ElementSelector.EnergyErrorCalibration) element selection
+                powerFactorUnit (int|EnergyErrorCalibration.PFUnit) power factor characteristic
+                frequency (float) signal frequency
+                name (str) optional label reported back in SweepResult
+        '''
+        self.voltage = voltage
+        self.current = current
+        self.powerFactor = powerFactor
+        self.element = element
+        self.powerFactorUnit = powerFactorUnit
+        self.frequency = frequency
+        self.name = name
+        self.voltageRange = None
+        self.currentRange = None
+
+    def __repr__(self):
+        label = f'{self.name} ' if self.name != None else ''
+        return f'TestPoint({label}element={self.element.enum}, V={self.voltage}, I={self.current}, PF={self.powerFactor})'
+
+class SweepResult:
+    '''
+        Outcome of one test point
+    '''
+    def __init__(self, point:TestPoint, applied:bool, sampling:SamplingData=None, error:ErrorSamplingData=None, duration:float=0.0):
+        self.point = point
+        self.applied = applied
+        self.sampling = sampling
+        self.error = error
+        self.duration = duration # second spent on the point, apply and readback included
+
+class CalibrationSweep:
+    '''
+        Run a set of test points on one test bench. Each point gets the smallest range covering its amplitude and
+        points are reordered so that voltage range relay and element selection switch as few times as possible, and
+        consecutive amplitudes stay close to each other (those changes go through ONLINE_ADJUST_COMMAND).
+    '''
+    # Cost of switching between two consecutive points, amplitude jumps are added as fraction of the range nominal.
+    # Current range is not part of TEST_COMMAND (the bench selects it), so switching it costs nothing here
+    VOLTAGE_RANGE_SWITCH_COST = 100.0
+    ELEMENT_SWITCH_COST = 10.0
+
+    def __init__(self, bench:GenyTestBench, voltageRanges=VoltageRange.YC99T_5C, currentRanges=CurrentRange.YC99T_5C):
+        '''
+            params:
+                bench (GenyTestBench) opened test bench
+                voltageRanges (VoltageRange.YC99T_5C|VoltageRange.YC99T_3C) available voltage ranges
+                currentRanges (CurrentRange.YC99T_5C) available current ranges
+        '''
+        self.bench = bench
+        self.voltageLevels = EnergyErrorCalibration.rangeLevels(voltageRanges)
+        self.currentLevels = EnergyErrorCalibration.rangeLevels(currentRanges)
+        if len(self.voltageLevels) == 0:
+            raise VoltageRangeError(f'No RangeLevel found in {voltageRanges.__name__}')
+        if len(self.currentLevels) == 0:
+            raise CurrentRangeError(f'No RangeLevel found in {currentRanges.__name__}')
+
+    def selectRange(levels:list, amplitude:float):
+        '''
+            Return smallest RangeLevel with nominal covering amplitude, None if amplitude exceed every range
+        '''
+        for level in levels:
+            if abs(amplitude) <= level.nominal:
+                return level
+        return None
+
+    def resolve(self, point:TestPoint) -> TestPoint:
+        '''
+            Fill voltageRange and currentRange of point. Raise VoltageRangeError or CurrentRangeError if no range cover it
+        '''
+        point.voltageRange = CalibrationSweep.selectRange(self.voltageLevels, point.voltage)
+        if point.voltageRange == None:
+            raise VoltageRangeError(f'Voltage {point.voltage} exceed every voltage range of {point}')
+        point.currentRange = CalibrationSweep.selectRange(self.currentLevels, point.current)
+        if point.currentRange == None:
+            raise CurrentRangeError(f'Current {point.current} exceed every current range of {point}')
+        return point
+
+    def cost(previous:TestPoint, point:TestPoint) -> float:
+        '''
+            Return cost of moving test bench from previous to point
+        '''
+        cost = 0.0
+        if previous.voltageRange is not point.voltageRange:
+            cost += CalibrationSweep.VOLTAGE_RANGE_SWITCH_COST
+        if previous.element is not point.element:
+            cost += CalibrationSweep.ELEMENT_SWITCH_COST
+        cost += abs(point.voltage - previous.voltage) / point.voltageRange.nominal
+        cost += abs(point.current - previous.current) / point.currentRange.nominal
+        cost += abs(point.powerFactor - previous.powerFactor)
+        return cost
+
+    def currentPoint(self) -> TestPoint:
+        '''
+            Return configuration held by the bench as TestPoint, used as start of the ordering
+        '''
+        calibration = self.bench.energyErrorCalibration
+        point = TestPoint(calibration.voltage, calibration.current, calibration.powerFactor, calibration.elementSelector,
+                          calibration.powerFactorUnit, calibration.frequency)
+        point.voltageRange = calibration.voltageRange
+        point.currentRange = calibration.currentRange
+        return point
+
+    def plan(self, points:list) -> list:
+        '''
+            Resolve ranges of every point and return them in execution order. The order is built greedily, always
+            moving to the cheapest remaining point (see cost()) starting from the bench configuration
+        '''
+        remaining = [self.resolve(point) for point in points]
+        ordered = []
+        previous = self.currentPoint()
+        while remaining:
+            index = min(range(len(remaining)), key=lambda i: CalibrationSweep.cost(previous, remaining[i]))
+            previous = remaining.pop(index)
+            ordered.append(previous)
+        return ordered
+
+    def switchCount(self, points:list) -> dict:
+        '''
+            Return number of voltage range, current range and element switches needed to run points in the given order
+        '''
+        count = {'voltageRange': 0, 'currentRange': 0, 'element': 0}
+        previous = self.currentPoint()
+        for point in points:
+            if point.voltageRange == None:
+                self.resolve(point)
+            count['voltageRange'] += previous.voltageRange is not point.voltageRange
+            count['currentRange'] += previous.currentRange is not point.currentRange
+            count['element'] += previous.element is not point.element
+            previous = point
+        return count
+
+    def configure(self, point:TestPoint):
+        '''
+            Load point into bench registers. Amplitude and range are set in the order accepted by the range checks
+        '''
+        bench = self.bench
+        calibration = bench.energyErrorCalibration
+        bench.setElementSelector(point.element)
+        if point.voltage <= calibration.voltageRange.nominal:
+            bench.setVoltage(point.voltage)
+            bench.setVoltageRange(point.voltageRange)
+        else:
+            bench.setVoltageRange(point.voltageRange)
+            bench.setVoltage(point.voltage)
+        if point.current <= calibration.currentRange.nominal:
+            bench.setCurrent(point.current)
+            bench.setCurrentRange(point.currentRange)
+        else:
+            bench.setCurrentRange(point.currentRange)
+            bench.setCurrent(point.current)
+        bench.setPowerFactor(point.powerFactor)
+        bench.setPowerFactorUnit(point.powerFactorUnit)
+        bench.setFrequency(point.frequency)
+
+    def run(self, points:list, settleTime:float=0.0, readbackError:bool=False, callback=None, stopOnFailure:bool=True) -> list:
+        '''
+            Plan and run points. Return list of SweepResult in execution order
+
+            parameters:
+                points (list) TestPoint to run
+                settleTime (float) second to wait after apply before readback
+                readbackError (bool) If true readback error sampling together with sampling data
+                callback (function) called with SweepResult after each point
+                stopOnFailure (bool) If true stop the sweep when the bench refuse a configuration
+        '''
+        results = []
+        for point in self.plan(points):
+            start = time.monotonic()
+            self.configure(point)
+            applied = self.bench.apply()
+            result = SweepResult(point, applied)
+            if applied:
+                if settleTime > 0:
+                    time.sleep(settleTime)
+                if readbackError:
+                    result.sampling, result.error = self.bench.readBackSamplingAndError()
+                else:
+                    result.sampling = self.bench.readBackSamplingData()
+            else:
+                print(f'[CalibrationSweep] Test bench refused {point}')
+            result.duration = time.monotonic() - start
+            results.append(result)
+            if callback != None:
+                callback(result)
+            if not applied and stopOnFailure:
+                break
+        return results
+
+if __name__ == '__main__':
+    def plan_only():
+        class PlanningBench:
+            energyErrorCalibration = EnergyErrorCalibration()
+
+        elements = (
+            ElementSelector.EnergyErrorCalibration._A_ELEMENT,
+            ElementSelector.EnergyErrorCalibration._B_ELEMENT,
+            ElementSelector.EnergyErrorCalibration._C_ELEMENT,
+            ElementSelector.EnergyErrorCalibration._COMBINE_ALL
+        )
+        points = [
+            TestPoint(voltage, current, powerFactor, element)
+            for powerFactor in (1.0, 0.5)
+            for current in (0.1, 1.0, 5.0, 10.0)
+            for voltage in (57.7, 220.0)
+            for element in elements
+        ]
+        sweep = CalibrationSweep(PlanningBench())
+        for point in points:
+            sweep.resolve(point)
+        print(f'[plan_only] as written: {sweep.switchCount(points)}')
+        ordered = sweep.plan(points)
+        print(f'[plan_only] planned   : {sweep.switchCount(ordered)}')
+        for point in ordered:
+            print(f'[plan_only] {point} range V={point.voltageRange.nominal} I={point.currentRange.nominal}')
+
+    plan_only()
@@ -1,6 +1,14 @@
 from typing import Union, Tuple
-from Util import Util, ResponseDataFrame, CommmandDataFrame, VoltageRange, CurrentRange, PowerSelector, ElementSelector
+from Util import Util, ResponseDataFrame, CommmandDataFrame, FrameEncoder, FrameTemplate, VoltageRange, CurrentRange, PowerSelector, ElementSelector, RangeLevel
 from Util import VoltageRangeError, CurrentRangeError, DatFrameError
+from collections import deque
+import struct
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 class Register:
     def __init__(self, name, dtype, size):
@@ -21,16 +29,156 @@ class Register:
         '''
             transform raw value to specified data type
         '''
-        if isinstance(self.rawValue, list):
+        if isinstance(self.rawValue, (list, bytes, bytearray)):
             if self.dtype == float:
                 return Util.Hex2float(value=self.rawValue, size=self.size)
             elif self.dtype == int:
                 return Util.Hex2uint(value=self.rawValue, size=self.size)
             elif self.dtype == bool:
-                return False if self.rawValue == [0] else True
+                return False if list(self.rawValue) == [0] else True
             
+class Snapshot:
+    '''
+        Immutable record of one readback. It keeps the raw DATA bytes with its capture timestamp and decode each field on access,
+        so storing a long history costs only the frame payload.
+    '''
+    __slots__ = ('data', 'timestamp')
+    FIELDS = () # (name, struct format) in DATA order
+    LAYOUT = None
+    
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.LAYOUT = struct.Struct('<' + ''.join(fmt for _, fmt in cls.FIELDS))
+        offset = 0
+        for name, fmt in cls.FIELDS:
+            field = struct.Struct('<' + fmt)
+            setattr(cls, name, property(lambda self, field=field, offset=offset: field.unpack_from(self.data, offset)[0]))
+            offset += field.size
+    
+    def __init__(self, data:bytes, timestamp:float=None):
+        '''
+            params:
+                data (bytes) DATA field of response data frame
+                timestamp (float) capture time in second since epoch, default is now
+        '''
+        if len(data) < self.LAYOUT.size:
+            raise DatFrameError(f'Dataframe length not comply {self.LAYOUT.size}')
+        object.__setattr__(self, 'data', bytes(data))
+        object.__setattr__(self, 'timestamp', time.time() if timestamp == None else timestamp)
+    
+    def __setattr__(self, name, value):
+        raise AttributeError(f'{type(self).__name__} is immutable')
+    
+    def __reduce__(self):
+        return (type(self), (self.data, self.timestamp))
+    
+    def __eq__(self, other):
+        return type(self) == type(other) and self.data == other.data and self.timestamp == other.timestamp
+    
+    def __hash__(self):
+        return hash((self.data, self.timestamp))
+    
+    def __repr__(self):
+        fields = ', '.join(f'{name}={value}' for name, value in self.items())
+        return f'{type(self).__name__}({fields}, timestamp={self.timestamp})'
+    
+    def values(self) -> tuple:
+        '''
+            Return all field values in DATA order
+        '''
+        return self.LAYOUT.unpack_from(self.data, 0)
+    
+    def items(self):
+        return zip((name for name, _ in self.FIELDS), self.values())
+    
+    def toDict(self) -> dict:
+        result = dict(self.items())
+        result['timestamp'] = self.timestamp
+        return result
+
+class SamplingData(Snapshot):
+    '''
+        Snapshot of Energy Error Calibration readback sampling data
+    '''
+    __slots__ = ()
+    FIELDS = tuple((name, 'f') for name in (
+        'Voltage_A', 'VoltagePhase_A', 'Current_A', 'CurrentPhase_A', 'PowerActive_A', 'PowerReactive_A',
+        'Voltage_B', 'VoltagePhase_B', 'Current_B', 'CurrentPhase_B', 'PowerActive_B', 'PowerReactive_B',
+        'Voltage_C', 'VoltagePhase_C', 'Current_C', 'CurrentPhase_C', 'PowerActive_C', 'PowerReactive_C',
+        'TotalPowerActive', 'TotalPowerReactive',
+    ))
+
+class ErrorSamplingData(Snapshot):
+    '''
+        Snapshot of Energy Error Calibration readback error sampling
+    '''
+    __slots__ = ()
+    FIELDS = (
+        ('ValidFlagBit', '?'),
+        ('MeterError1', 'f'),
+        ('MeterError2', 'f'),
+        ('MeterError3', 'f'),
+    )
+
+class SettleDetector:
+    '''
+        Sliding window settle check on SamplingData. Settled once the last `window` samples all have voltage and current of
+        the selected elements within tolerance of the setpoint, and their voltage/current phase moved less than
+        phaseTolerance degree across the window
+    '''
+    # elementSelector enum -> phases driven by the test bench
+    PHASES = {0x00: 'ABC', 0x01: 'A', 0x02: 'B', 0x03: 'C', 0x04: 'ABC', 0x05: 'AB', 0x06: 'A'}
+    # amplitude tolerance never goes below this fraction of the range nominal (setpoint close to zero)
+    RANGE_FLOOR = 0.01
+    
+    def __init__(self, calibration, tolerance:float=0.002, window:int=3, phaseTolerance:float=0.5):
+        '''
+            params:
+                calibration (EnergyErrorCalibration) configuration holding the setpoints
+                tolerance (float) allowed relative amplitude deviation (0.002 is 0.2%)
+                window (int) number of consecutive samples that shall match
+                phaseTolerance (float) allowed phase movement in degree across the window
+        '''
+        phases = SettleDetector.PHASES.get(calibration.elementSelector.enum, 'ABC')
+        voltageAllowed = tolerance * max(abs(calibration.voltage), SettleDetector.RANGE_FLOOR * calibration.voltageRange.nominal)
+        currentAllowed = tolerance * max(abs(calibration.current), SettleDetector.RANGE_FLOOR * calibration.currentRange.nominal)
+        self.targets = tuple(
+            target for phase in phases for target in (
+                (f'Voltage_{phase}', calibration.voltage, voltageAllowed),
+                (f'Current_{phase}', calibration.current, currentAllowed),
+            )
+        )
+        self.phaseFields = tuple(name for phase in phases for name in (f'VoltagePhase_{phase}', f'CurrentPhase_{phase}'))
+        self.phaseTolerance = phaseTolerance
+        self.samples = deque(maxlen=window)
+    
+    def reset(self):
+        self.samples.clear()
+    
+    def update(self, sample:SamplingData) -> bool:
+        '''
+            Push next sample. Return True when settled
+        '''
+        for name, target, allowed in self.targets:
+            if not abs(getattr(sample, name) - target) <= allowed:
+                self.samples.clear()
+                return False
+        self.samples.append(sample)
+        if len(self.samples) < self.samples.maxlen:
+            return False
+        first = self.samples[0]
+        for name in self.phaseFields:
+            reference = getattr(first, name)
+            for other in self.samples:
+                if abs((getattr(other, name) - reference + 180.0) % 360.0 - 180.0) > self.phaseTolerance:
+                    return False
+        return True
+
 class EnergyErrorCalibration:
     class ReadbackSamplingDataRegister(Register):
+        LAYOUT = SamplingData.LAYOUT
+        DTYPE = '<f4'
+        
         def __init__(self):
             self.Voltage_A = Register('Voltage_A', float, 4)
             self.VoltagePhase_A = Register('VoltagePhase_A', float, 4)
@@ -84,17 +232,43 @@ class EnergyErrorCalibration:
                 raise TypeError(f'dataFrame expect ResponseDataFrame not {type(dataFrame)}')
             
             data = dataFrame.DATA
-            if len(data) == len(self.registerList)*4:
+            if len(data) == self.LAYOUT.size:
                 pass
             else:
-                raise DatFrameError(f'Dataframe length not comply {len(self.registerList)*4}')
+                raise DatFrameError(f'Dataframe length not comply {self.LAYOUT.size}')
             
-            values = [data[i:i+4] for i in range(0, len(data), 4)]
-            for reg, val in zip(self.registerList, values):
-                reg.value = Util.Hex2float(val, size=reg.size)
+            for reg, val in zip(self.registerList, self.LAYOUT.unpack(data)):
+                reg.value = val
             return self.getValue()
         
+        def extractSample(self, dataFrame:ResponseDataFrame, timestamp:float=None) -> SamplingData:
+            '''
+                Return immutable snapshot of the readback, registers are not touched
+            '''
+            if not isinstance(dataFrame, ResponseDataFrame):
+                raise TypeError(f'dataFrame expect ResponseDataFrame not {type(dataFrame)}')
+            if len(dataFrame.DATA) != self.LAYOUT.size:
+                raise DatFrameError(f'Dataframe length not comply {self.LAYOUT.size}')
+            return SamplingData(dataFrame.DATA, timestamp)
+        
+        def extractArray(self, dataFrame:ResponseDataFrame):
+            '''
+                Decode all registers into numpy float32 array, ordered as registerList. Require numpy
+            '''
+            if np == None:
+                raise ImportError('numpy is required for extractArray')
+            if not isinstance(dataFrame, ResponseDataFrame):
+                raise TypeError(f'dataFrame expect ResponseDataFrame not {type(dataFrame)}')
+            
+            data = dataFrame.DATA
+            if len(data) != self.LAYOUT.size:
+                raise DatFrameError(f'Dataframe length not comply {self.LAYOUT.size}')
+            return np.frombuffer(data, dtype=self.DTYPE)
+        
     class ReadBackErrorSamplingDataRegister(Register):
+        LAYOUT = ErrorSamplingData.LAYOUT
+        DTYPE = [('ValidFlagBit', 'u1'), ('MeterError1', '<f4'), ('MeterError2', '<f4'), ('MeterError3', '<f4')]
+        
         def __init__(self):
             self.ValidFlagBit = Register('Valid Flag Bit', bool, 1)
             self.MeterError1 = Register('Meter 1 Error', float, 4)
@@ -113,20 +287,40 @@ class EnergyErrorCalibration:
                 raise TypeError(f'dataFrame expect ResponseDataFrame not {type(dataFrame)}')
             
             data = dataFrame.DATA
-            requiredDataLenght = sum([reg.size for reg in self.registerList])
+            requiredDataLenght = self.LAYOUT.size
             if len(data) >= requiredDataLenght:
                 pass
             else:
                 raise DatFrameError(f'Dataframe length not comply {requiredDataLenght}')
             
-            for register in self.registerList:
-                temp = []
-                for i in range(register.size):
-                    temp.append(data.pop(0))
-                print(f'Set register {register.name} raw data: {temp}')
-                register.setRawValue(temp)
+            validFlag, *meterErrors = self.LAYOUT.unpack_from(data, 0)
+            self.ValidFlagBit.value = validFlag != 0
+            for register, value in zip(self.registerList[1:], meterErrors):
+                register.value = value
                 
             return self.registerList
+        
+        def extractSample(self, dataFrame:ResponseDataFrame, timestamp:float=None) -> ErrorSamplingData:
+            '''
+                Return immutable snapshot of the readback, registers are not touched
+            '''
+            if not isinstance(dataFrame, ResponseDataFrame):
+                raise TypeError(f'dataFrame expect ResponseDataFrame not {type(dataFrame)}')
+            return ErrorSamplingData(dataFrame.DATA[:self.LAYOUT.size], timestamp)
+        
+        def extractArray(self, dataFrame:ResponseDataFrame):
+            '''
+                Decode all registers into numpy structured array with one record. Require numpy
+            '''
+            if np == None:
+                raise ImportError('numpy is required for extractArray')
+            if not isinstance(dataFrame, ResponseDataFrame):
+                raise TypeError(f'dataFrame expect ResponseDataFrame not {type(dataFrame)}')
+            
+            data = dataFrame.DATA
+            if len(data) < self.LAYOUT.size:
+                raise DatFrameError(f'Dataframe length not comply {self.LAYOUT.size}')
+            return np.frombuffer(data, dtype=self.DTYPE, count=1)
             
     class Buffer:
         def __init__(self):
@@ -148,6 +342,23 @@ class EnergyErrorCalibration:
         READBACK_SAMPLING_DATA = 0xd2
         READBACK_ERROR_SAMPLING = 0xd5
             
+    # DATA layout of TEST_COMMAND and ONLINE_ADJUST_COMMAND, register size (1,1,1,4,4,4,1,4,4,2)
+    TEST_COMMAND_LAYOUT = '<BBBfffBffH'
+    REGISTER_FIELDS = (
+        'powerSelector', 'elementSelector', 'voltageRange', 'voltage', 'current',
+        'powerFactor', 'powerFactorUnit', 'frequency', 'meterConstant', 'calibMeasurementCycle',
+    )
+    # PowerSelector enum measuring reactive energy
+    REACTIVE_POWER_SELECTORS = (
+        PowerSelector._3P4W_REAL_REACTIVE.enum,
+        PowerSelector._3P3W_REAL_REACTIVE.enum,
+        PowerSelector._2_ELEMENTS_60_REACTIVE.enum,
+        PowerSelector._2_ELEMENTS_90_REACTIVE.enum,
+        PowerSelector._3_ELEMENTS_90_REACTIVE.enum,
+    )
+    # Fields that can be changed with ONLINE_ADJUST_COMMAND without re-settling the source
+    ONLINE_ADJUSTABLE_FIELDS = {'voltage', 'current', 'powerFactor', 'powerFactorUnit', 'frequency'}
+            
     class PFUnit:
         _NO_UNIT    = 0x00
         _L          = 0x01
@@ -167,6 +378,9 @@ class EnergyErrorCalibration:
         self.calibMeasurementCycle = 0
         
         self.commandDataFrame = CommmandDataFrame()
+        self.testCommandEncoder = FrameEncoder(EnergyErrorCalibration.Command.TEST_COMMAND, EnergyErrorCalibration.TEST_COMMAND_LAYOUT)
+        self.onlineAdjustEncoder = FrameEncoder(EnergyErrorCalibration.Command.ONLINE_ADJUST_COMMAND, EnergyErrorCalibration.TEST_COMMAND_LAYOUT)
+        self.appliedRegister = None # register accepted by the test bench on last apply
         self.readbackSamplingRegister = EnergyErrorCalibration.ReadbackSamplingDataRegister()
         self.errorSamplingRegister = EnergyErrorCalibration.ReadBackErrorSamplingDataRegister()
     
@@ -309,15 +523,11 @@ class EnergyErrorCalibration:
         print(f"Meter Constant              : {self.meterConstant}")
         print(f"Calibratino Measure Cycle   : {self.calibMeasurementCycle}")
     
-    def setTestCommandForm(self, verbose= False):
+    def getRegister(self) -> tuple:
         '''
-            Set test command form
-            # return data frame in list for test command GENY mode Energy Error Calibration. Refer to Energy Error Calibration test command in Geny documentation.
+            Return current configuration in the order of TEST_COMMAND DATA field (see REGISTER_FIELDS)
         '''
-        if verbose:
-            self.info()
-            
-        register = ( # NOTE: Please don't change the arrangemet
+        return ( # NOTE: Please don't change the arrangemet
             self.powerSelector.enum,
             self.elementSelector.enum,
             self.voltageRange.enum,
@@ -329,19 +539,88 @@ class EnergyErrorCalibration:
             self.meterConstant,
             self.calibMeasurementCycle,
         )
-        registerSize = (1,1,1,4,4,4,1,4,4,2)
-        apdu = []
-        for reg, regSize in zip(register, registerSize):
-            if regSize == 1:
-                apdu.append(reg)
-            elif regSize == 2:
-                apdu.extend(Util.uint2byteList(reg, regSize))
-            else:
-                apdu.extend(Util.float2byte(reg, regSize))
-        
-        dataFrame = self.commandDataFrame.genDataFrame(EnergyErrorCalibration.Command.TEST_COMMAND, apdu)
+    
+    def setTestCommandForm(self, verbose= False):
+        '''
+            Set test command form
+            # return data frame in bytes for test command GENY mode Energy Error Calibration. Refer to Energy Error Calibration test command in Geny documentation.
+        '''
+        if verbose:
+            self.info()
+            
+        dataFrame = self.testCommandEncoder.encode(*self.getRegister())
         return dataFrame
     
+    def changedFields(self) -> set:
+        '''
+            Return name of fields (see REGISTER_FIELDS) changed since last applied configuration
+        '''
+        if self.appliedRegister == None:
+            return set(EnergyErrorCalibration.REGISTER_FIELDS)
+        return {
+            name for name, current, applied in zip(EnergyErrorCalibration.REGISTER_FIELDS, self.getRegister(), self.appliedRegister)
+            if current != applied
+        }
+    
+    def applyCommandForm(self, force:bool=False, verbose:bool=False) -> tuple:
+        '''
+            Return (data frame, register) needed to bring the test bench to current configuration.
+            Data frame is None when nothing changed, ONLINE_ADJUST_COMMAND when only online adjustable fields changed,
+            otherwise TEST_COMMAND. Call markApplied(register) once the test bench accepted the data frame.
+            
+            parameters:
+                force (bool) If true always return TEST_COMMAND
+                verbose (bool) If true will show configuration summary
+        '''
+        if verbose:
+            self.info()
+        
+        register = self.getRegister()
+        changed = self.changedFields()
+        if force or not changed.issubset(EnergyErrorCalibration.ONLINE_ADJUSTABLE_FIELDS):
+            return self.testCommandEncoder.encode(*register), register
+        if len(changed) == 0:
+            return None, register
+        return self.onlineAdjustEncoder.encode(*register), register
+    
+    def markApplied(self, register:tuple=None):
+        '''
+            Remember register as configuration running on the test bench. None means unknown (next apply is a full TEST_COMMAND)
+        '''
+        self.appliedRegister = register
+    
+    def rangeLevels(rangeClass) -> list:
+        '''
+            Return RangeLevel of a range class (VoltageRange.YC99T_5C, CurrentRange.YC99T_5C, ...) sorted by nominal
+        '''
+        levels = [value for value in vars(rangeClass).values() if isinstance(value, RangeLevel)]
+        return sorted(levels, key=lambda level: level.nominal)
+    
+    def isReactive(self) -> bool:
+        '''
+            Return True when power selection measure reactive energy
+        '''
+        return self.powerSelector.enum in EnergyErrorCalibration.REACTIVE_POWER_SELECTORS
+    
+    def estimateMeasurementTime(self, power:float=None) -> float:
+        '''
+            Return expected duration in second of one error measurement: calibMeasurementCycle pulses of a meter with
+            meterConstant (pulse per kWh or kvarh) at power. Return None if it can not be estimated
+            
+            parameters:
+                power (float) measured power in W (var for reactive power selection), default estimated from setpoints
+        '''
+        if power == None:
+            phases = len(SettleDetector.PHASES.get(self.elementSelector.enum, 'ABC'))
+            powerFactor = min(abs(self.powerFactor), 1.0)
+            if self.isReactive():
+                powerFactor = (1.0 - powerFactor ** 2) ** 0.5
+            power = phases * self.voltage * self.current * powerFactor
+        power = abs(power)
+        if self.meterConstant <= 0 or self.calibMeasurementCycle <= 0 or power == 0:
+            return None
+        return self.calibMeasurementCycle * 3600.0 * 1000.0 / (self.meterConstant * power)
+    
     def stopCommand(self) -> list:
         '''
             return data frame to stop Energy Error Calibration source in list structure
@@ -350,9 +629,9 @@ class EnergyErrorCalibration:
         df = Util.genDataFrame(EnergyErrorCalibration.Command.STOP_TEST_COMMAND, [])      # Generate data frame
         return df.copy()
     
-    def readbackSampling(self,count:int=1) -> list:
+    def readbackSampling(self,count:int=1) -> bytes:
         '''
-            return data frame in list to request test bench feedback
+            return data frame in bytes to request test bench feedback
         '''
         df = [] # for storing dataframe that will be send
         control_flag_bit = 0
@@ -363,14 +642,14 @@ class EnergyErrorCalibration:
             control_flag_bit = 2
 
         df.append(control_flag_bit)
-        df = self.commandDataFrame.genDataFrame(EnergyErrorCalibration.Command.READBACK_SAMPLING_DATA, df)
+        df = FrameTemplate.get(EnergyErrorCalibration.Command.READBACK_SAMPLING_DATA, df).frame
         return df
     
-    def readbackErrorSampling(self, count:int=1) -> list:
+    def readbackErrorSampling(self, count:int=1) -> bytes:
         '''
             NOTE: I still not understand, is there a miss understanding. In the documentation error sampling readback is 0xd4 not 0xd5
             
-            return data frame in list to request test bench feedback
+            return data frame in bytes to request test bench feedback
         '''
         data = []
         control_flag_bit = 0
@@ -381,5 +660,5 @@ class EnergyErrorCalibration:
             control_flag_bit = 2
 
         data.append(control_flag_bit)
-        df = self.commandDataFrame.genDataFrame(EnergyErrorCalibration.Command.READBACK_ERROR_SAMPLING, data)
+        df = FrameTemplate.get(EnergyErrorCalibration.Command.READBACK_ERROR_SAMPLING, data).frame
         return df
\ No newline at end of file
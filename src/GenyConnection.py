@@ -0,0 +1,216 @@
+from concurrent.futures import ThreadPoolExecutor
+from GenyTestBench import GenyTestBench
+from SerialMonitor import SerialReactor
+from Metrics import Metrics
+import threading
+import time
+
+class BenchHealth:
+    '''
+        Health record of one test bench managed by GenyConnection
+    '''
+    IDLE = 'idle'
+    BUSY = 'busy'
+    ERROR = 'error'
+    CLOSED = 'closed'
+
+    def __init__(self, port:str):
+        self.port = port
+        self.state = BenchHealth.CLOSED
+        self.commands = 0
+        self.errors = 0
+        self.consecutiveErrors = 0
+        self.lastError = None
+        self.lastSuccess = None # time.time() of last successful command
+        self.lastDuration = None # duration in second of last command
+
+    def onFault(self, fault):
+        '''
+            Fault handler registered on the bench serial monitor
+        '''
+        self.state = BenchHealth.ERROR
+        self.lastError = f'{type(fault).__name__}: {fault}'
+
+    def toDict(self) -> dict:
+        return {
+            'port' : self.port,
+            'state' : self.state,
+            'commands' : self.commands,
+            'errors' : self.errors,
+            'consecutiveErrors' : self.consecutiveErrors,
+            'lastError' : self.lastError,
+            'lastSuccess' : self.lastSuccess,
+            'lastDuration' : self.lastDuration,
+        }
+
+class GenyConnection:
+    '''
+        Manager for many GENY test benches identified by their port. A bench is opened on first use,
+        commands on different benches run in parallel while commands on the same bench are serialized.
+    '''
+    def __init__(self, baudrate:int=115200, benchFactory=GenyTestBench, maxWorkers:int=None, reactor:SerialReactor=None, metrics:Metrics=None):
+        '''
+            params:
+                baudrate (int) default baudrate of every bench
+                benchFactory (function) called with (port, baudrate, metrics=...) to create a bench, default GenyTestBench
+                maxWorkers (int) maximum number of benches driven at the same time, default one thread per bench
+                reactor (SerialReactor) if set, every bench is read by this shared reactor (passed as reactor keyword to benchFactory)
+                metrics (Metrics) registry shared by every bench, default a new one
+        '''
+        self.baudrate = baudrate
+        self.benchFactory = benchFactory
+        self.maxWorkers = maxWorkers
+        self.reactor = reactor
+        self.metrics = Metrics() if metrics == None else metrics
+        self.benches = {} # port -> bench instance, only for opened benches
+        self.baudrates = {} # port -> baudrate, for every registered bench
+        self.locks = {} # port -> lock serializing commands on the bench
+        self.healths = {} # port -> BenchHealth
+        self.lock = threading.Lock()
+        self.executor = None
+        self.executorWorkers = 0
+        self.retiredExecutors = [] # outgrown pools finishing their queued jobs
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.closeAll()
+
+    def add(self, port:str, baudrate:int=None):
+        '''
+            Register bench without opening it
+        '''
+        with self.lock:
+            if port not in self.baudrates:
+                self.baudrates[port] = self.baudrate if baudrate == None else baudrate
+                self.locks[port] = threading.RLock()
+                self.healths[port] = BenchHealth(port)
+
+    def ports(self) -> list:
+        return list(self.baudrates)
+
+    def get(self, port:str) -> GenyTestBench:
+        '''
+            Return bench of port, the serial port is opened and monitored on first call
+        '''
+        self.add(port)
+        with self.locks[port]:
+            bench = self.benches.get(port)
+            if bench == None:
+                if self.reactor != None:
+                    bench = self.benchFactory(port, self.baudrates[port], reactor=self.reactor, metrics=self.metrics)
+                else:
+                    bench = self.benchFactory(port, self.baudrates[port], metrics=self.metrics)
+                bench.serialMonitor.addFaultHandler(self.healths[port].onFault)
+                self.benches[port] = bench
+                self.healths[port].state = BenchHealth.IDLE
+            return bench
+
+    def release(self, port:str):
+        '''
+            Stop serial monitor of the bench and close its port. The bench is opened again on next use
+        '''
+        if port not in self.locks:
+            return
+        with self.locks[port]:
+            bench = self.benches.pop(port, None)
+            if bench != None:
+                bench.serialMonitor.stopMonitor()
+            self.healths[port].state = BenchHealth.CLOSED
+
+    def closeAll(self):
+        '''
+            Release every bench and stop worker threads
+        '''
+        for port in self.ports():
+            self.release(port)
+        with self.lock:
+            executors = self.retiredExecutors + ([self.executor] if self.executor != None else [])
+            self.executor = None
+            self.executorWorkers = 0
+            self.retiredExecutors = []
+        for executor in executors:
+            executor.shutdown(wait=True)
+
+    def run(self, port:str, function, *args, **kwargs):
+        '''
+            Run function(bench, *args, **kwargs) on the bench of port and record its health
+
+            parameters:
+                port (str) bench port
+                function (function) job receiving the bench as first argument
+        '''
+        bench = self.get(port)
+        health = self.healths[port]
+        with self.locks[port]:
+            health.state = BenchHealth.BUSY
+            start = time.monotonic()
+            try:
+                result = function(bench, *args, **kwargs)
+            except Exception as e:
+                health.errors += 1
+                health.consecutiveErrors += 1
+                health.lastError = f'{type(e).__name__}: {e}'
+                health.state = BenchHealth.ERROR
+                raise
+            finally:
+                health.commands += 1
+                health.lastDuration = time.monotonic() - start
+            health.consecutiveErrors = 0
+            health.lastSuccess = time.time()
+            health.state = BenchHealth.IDLE
+            return result
+
+    def submit(self, port:str, function, *args, **kwargs):
+        '''
+            Same as run() in worker thread. Return concurrent.futures.Future.
+            Without maxWorkers the pool is replaced by a bigger one when benches are added after first use, so every
+            bench keeps its own thread
+        '''
+        self.add(port)
+        with self.lock:
+            workers = self.maxWorkers or max(len(self.baudrates), 1)
+            if self.executor == None or workers > self.executorWorkers:
+                if self.executor != None:
+                    self.executor.shutdown(wait=False)
+                    self.retiredExecutors.append(self.executor)
+                self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='GenyConnection')
+                self.executorWorkers = workers
+            return self.executor.submit(self.run, port, function, *args, **kwargs)
+
+    def runAll(self, function, ports:list=None, *args, **kwargs) -> dict:
+        '''
+            Run function on many benches in parallel and wait all of them
+
+            parameters:
+                function (function) job receiving the bench as first argument
+                ports (list) benches to run, default every registered bench
+            return:
+                dict of port -> function result, or the exception raised by the function
+        '''
+        ports = self.ports() if ports == None else ports
+        for port in ports:
+            self.add(port)
+        futures = {port: self.submit(port, function, *args, **kwargs) for port in ports}
+        results = {}
+        for port, future in futures.items():
+            try:
+                results[port] = future.result()
+            except Exception as e:
+                results[port] = e
+        return results
+
+    def prometheus(self) -> str:
+        '''
+            Return latency histograms and counters of every bench in Prometheus text format
+        '''
+        return self.metrics.prometheus()
+
+    def health(self, port:str=None) -> dict:
+        '''
+            Return health of a bench as dict, or dict of port -> health of every bench if port is None
+        '''
+        if port != None:
+            return self.healths[port].toDict()
+        return {port: health.toDict() for port, health in self.healths.items()}
@@ -0,0 +1,334 @@
+from Util import ResponseDataFrame, FrameDecoder, CRC16, VoltageRange, RangeLevel
+from ErrorCalibration import EnergyErrorCalibration, SamplingData, SettleDetector
+from GenySystemCommand import GenySys
+import itertools
+import math
+import os
+import queue
+import random
+import select
+import struct
+import sys
+import threading
+import time
+
+class GenySimulator:
+    '''
+        YC99T test bench simulator on a pseudo terminal (Linux/macOS). GenyTestBench can open simulator.port in place of
+        the real serial port. Responses follow the GENY data frame format, they are delayed by the configured latency and
+        jitter and written at the configured baudrate. Faults, dropped responses and corrupted CRC can be injected.
+    '''
+    class ErrorCode:
+        OK = 0x00
+        INVALID_DATA = 0x01 # simulator specific error codes
+        UNKNOWN_COMMAND = 0x02
+        NOT_ONLINE = 0x03
+        TRIPPED = 0x04 # source off after a fault, refused until next ONLINE command
+
+    BITS_PER_BYTE = 10 # 8N1
+    PHASE_ANGLES = {'A': 0.0, 'B': 240.0, 'C': 120.0}
+    TEST_COMMAND_LAYOUT = struct.Struct(EnergyErrorCalibration.TEST_COMMAND_LAYOUT)
+    SAMPLING_FIELDS = tuple(name for name, _ in SamplingData.FIELDS)
+    SAMPLING_LAYOUT = EnergyErrorCalibration.ReadbackSamplingDataRegister.LAYOUT
+    ERROR_LAYOUT = EnergyErrorCalibration.ReadBackErrorSamplingDataRegister.LAYOUT
+
+    def __init__(self, baudrate:int=115200, latency:float=0.005, jitter:float=0.0, settleTime:float=0.3,
+                 noise:float=0.0002, meterError:float=0.05, faultRate:float=0.0, dropRate:float=0.0,
+                 corruptRate:float=0.0, streamInterval:float=0.1, seed:int=None):
+        '''
+            params:
+                baudrate (int) simulated line speed, 0 to write without pacing
+                latency (float) processing time in second before each response
+                jitter (float) maximum random extra delay in second added to latency
+                settleTime (float) time constant in second of the source reaching a new setpoint
+                noise (float) relative gaussian noise of sampled amplitudes
+                meterError (float) standard deviation in percent of simulated meter errors
+                faultRate (float) probability that a command is answered with a SOURCE_FEEDBACK fault frame
+                dropRate (float) probability that a response is never sent
+                corruptRate (float) probability that a response has a wrong CRC16
+                streamInterval (float) period in second of continuous readback
+                seed (int) random seed, for repeatable runs
+        '''
+        self.baudrate = baudrate
+        self.latency = latency
+        self.jitter = jitter
+        self.settleTime = settleTime
+        self.noise = noise
+        self.meterError = meterError
+        self.faultRate = faultRate
+        self.dropRate = dropRate
+        self.corruptRate = corruptRate
+        self.streamInterval = streamInterval
+        self.random = random.Random(seed)
+
+        self.master = None
+        self.slave = None
+        self.port = None
+        self.runService = False
+        self.services = []
+        self.decoder = FrameDecoder(self.onFrame, checkCRC=True, minLength=FrameDecoder.MIN_COMMAND_LENGTH)
+        self.outgoing = queue.PriorityQueue() # (send time, sequence, frame)
+        self.sequence = itertools.count()
+        self.lastSendAt = 0.0
+        self.lock = threading.Lock()
+
+        self.online = False
+        self.tripped = False
+        self.streams = set() # command codes in continuous readback
+        self.received = 0 # number of decoded command frames
+        self.sent = 0 # number of written response frames
+
+        self.register = None # decoded TEST_COMMAND DATA field, None when source is off
+        self.changedAt = 0.0
+        self.startVoltage = 0.0
+        self.startCurrent = 0.0
+        self.meterErrors = (0.0, 0.0, 0.0)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self) -> str:
+        '''
+            Open the pseudo terminal and start answering. Return port path to give to GenyTestBench
+        '''
+        import tty
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.runService = True
+        self.services = [
+            threading.Thread(target=self.readerLoop, daemon=True),
+            threading.Thread(target=self.writerLoop, daemon=True),
+            threading.Thread(target=self.streamLoop, daemon=True),
+        ]
+        for service in self.services:
+            service.start()
+        print(f'[GenySimulator] listening on {self.port}')
+        return self.port
+
+    def stop(self):
+        '''
+            Stop answering and close the pseudo terminal
+        '''
+        self.runService = False
+        self.outgoing.put((0.0, next(self.sequence), None))
+        for service in self.services:
+            service.join()
+        self.services = []
+        for fd in (self.master, self.slave):
+            if fd != None:
+                os.close(fd)
+        self.master = self.slave = None
+
+    #
+    # I/O
+    #
+    def readerLoop(self):
+        while self.runService:
+            ready, _, _ = select.select([self.master], [], [], 0.1)
+            if ready:
+                try:
+                    data = os.read(self.master, 4096)
+                except OSError:
+                    break
+                self.decoder.feed(data)
+
+    def writerLoop(self):
+        while self.runService:
+            sendAt, _, frame = self.outgoing.get()
+            if frame == None:
+                continue
+            delay = sendAt - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            os.write(self.master, frame)
+            self.sent += 1
+            if self.baudrate > 0:
+                time.sleep(len(frame) * GenySimulator.BITS_PER_BYTE / self.baudrate)
+
+    def streamLoop(self):
+        while self.runService:
+            time.sleep(self.streamInterval)
+            for command in tuple(self.streams):
+                self.send(self.responseFrame(command, GenySimulator.ErrorCode.OK, self.readbackData(command)), delay=0.0)
+
+    def send(self, frame:bytes, delay:float=None):
+        '''
+            Queue frame for writing after delay (default latency and jitter). Frames keep their sending order
+        '''
+        if delay == None:
+            delay = self.latency + self.random.uniform(0.0, self.jitter)
+        with self.lock:
+            sendAt = max(time.monotonic() + delay, self.lastSendAt)
+            self.lastSendAt = sendAt
+            self.outgoing.put((sendAt, next(self.sequence), frame))
+
+    def responseFrame(self, command:int, errorCode:int=0, data:bytes=b'') -> bytes:
+        '''
+            Return complete response data frame
+        '''
+        body = bytes((command, 0x00, errorCode)) + data
+        crc = CRC16.calc(body)
+        if self.corruptRate > 0 and self.random.random() < self.corruptRate:
+            crc = bytes((crc[0] ^ 0xFF, crc[1]))
+        return ResponseDataFrame.HEADER_STRUCT.pack(ResponseDataFrame.SOI_CONSTANT, len(body)) + body + crc + bytes((ResponseDataFrame.EOI_CONSTANT,))
+
+    def injectFault(self, errorCode:int=0x01):
+        '''
+            Send SOURCE_FEEDBACK fault frame now and switch the source off until next ONLINE command
+        '''
+        self.tripped = True
+        self.register = None
+        self.streams.clear()
+        self.send(self.responseFrame(GenySys.Command.SOURCE_FEEDBACK, errorCode), delay=0.0)
+
+    #
+    # Command handling
+    #
+    def onFrame(self, frame:bytes):
+        self.received += 1
+        command = frame[FrameDecoder.HEADER_LENGTH]
+        data = frame[FrameDecoder.HEADER_LENGTH + 2:-FrameDecoder.TRAILER_LENGTH]
+        if self.faultRate > 0 and self.random.random() < self.faultRate:
+            self.injectFault()
+            return
+        response = self.handle(command, data)
+        if response == None or (self.dropRate > 0 and self.random.random() < self.dropRate):
+            return
+        errorCode, payload = response
+        # the request itself needs time on the wire before the bench can answer
+        wire = len(frame) * GenySimulator.BITS_PER_BYTE / self.baudrate if self.baudrate > 0 else 0.0
+        self.send(self.responseFrame(command, errorCode, payload), wire + self.latency + self.random.uniform(0.0, self.jitter))
+
+    def handle(self, command:int, data:bytes) -> tuple:
+        '''
+            Return (error code, DATA) answering command, or None for no response
+        '''
+        Command = EnergyErrorCalibration.Command
+        if command == GenySys.Command.ONLINE:
+            self.online = True
+            self.tripped = False
+            return GenySimulator.ErrorCode.OK, b''
+        if command == GenySys.Command.DISCONNECT_ONLINE:
+            self.online = False
+            self.register = None
+            self.streams.clear()
+            return GenySimulator.ErrorCode.OK, b''
+        if not self.online:
+            return GenySimulator.ErrorCode.NOT_ONLINE, b''
+        if self.tripped:
+            return GenySimulator.ErrorCode.TRIPPED, b''
+        if command in (Command.TEST_COMMAND, Command.ONLINE_ADJUST_COMMAND):
+            return self.setRegister(data), b''
+        if command == Command.STOP_TEST_COMMAND:
+            self.register = None
+            return GenySimulator.ErrorCode.OK, b''
+        if command in (Command.READBACK_SAMPLING_DATA, Command.READBACK_ERROR_SAMPLING):
+            controlFlag = data[0] if len(data) > 0 else 1
+            if controlFlag == 2:
+                self.streams.add(command)
+                return None # stream frames are the answer
+            if controlFlag == 0:
+                self.streams.discard(command)
+                return GenySimulator.ErrorCode.OK, b''
+            return GenySimulator.ErrorCode.OK, self.readbackData(command)
+        return GenySimulator.ErrorCode.UNKNOWN_COMMAND, b''
+
+    def rangeNominal(rangeClass, enum:int) -> float:
+        for value in vars(rangeClass).values():
+            if isinstance(value, RangeLevel) and value.enum == enum:
+                return value.nominal
+        return None
+
+    def setRegister(self, data:bytes) -> int:
+        if len(data) != GenySimulator.TEST_COMMAND_LAYOUT.size:
+            return GenySimulator.ErrorCode.INVALID_DATA
+        register = dict(zip(EnergyErrorCalibration.REGISTER_FIELDS, GenySimulator.TEST_COMMAND_LAYOUT.unpack(data)))
+        nominal = GenySimulator.rangeNominal(VoltageRange.YC99T_3C, register['voltageRange'])
+        if nominal == None or register['voltage'] > nominal or abs(register['powerFactor']) > 1 or register['frequency'] <= 0:
+            return GenySimulator.ErrorCode.INVALID_DATA
+        now = time.monotonic()
+        self.startVoltage, self.startCurrent = self.amplitude(now)
+        self.register = register
+        self.changedAt = now
+        self.meterErrors = tuple(self.random.gauss(0.0, self.meterError) for _ in range(3))
+        return GenySimulator.ErrorCode.OK
+
+    #
+    # Source model
+    #
+    def amplitude(self, now:float) -> tuple:
+        '''
+            Return (voltage, current) of the source, first order response toward the setpoint
+        '''
+        if self.register == None:
+            return 0.0, 0.0
+        k = math.exp(-(now - self.changedAt) / self.settleTime) if self.settleTime > 0 else 0.0
+        voltage = self.register['voltage'] + (self.startVoltage - self.register['voltage']) * k
+        current = self.register['current'] + (self.startCurrent - self.register['current']) * k
+        return voltage, current
+
+    def readbackData(self, command:int) -> bytes:
+        if command == EnergyErrorCalibration.Command.READBACK_SAMPLING_DATA:
+            return self.samplingData()
+        return self.errorSamplingData()
+
+    def samplingData(self) -> bytes:
+        values = [0.0] * len(GenySimulator.SAMPLING_FIELDS)
+        totalActive = totalReactive = 0.0
+        if self.register != None:
+            voltage, current = self.amplitude(time.monotonic())
+            powerFactor = self.register['powerFactor']
+            phi = math.degrees(math.acos(max(-1.0, min(1.0, powerFactor))))
+            if self.register['powerFactorUnit'] == EnergyErrorCalibration.PFUnit._C:
+                phi = -phi
+            for phase in SettleDetector.PHASES.get(self.register['elementSelector'], 'ABC'):
+                v = voltage * (1.0 + self.random.gauss(0.0, self.noise))
+                i = current * (1.0 + self.random.gauss(0.0, self.noise))
+                angle = GenySimulator.PHASE_ANGLES[phase]
+                active = v * i * math.cos(math.radians(phi))
+                reactive = v * i * math.sin(math.radians(phi))
+                offset = GenySimulator.SAMPLING_FIELDS.index(f'Voltage_{phase}')
+                values[offset:offset + 6] = (v, angle, i, (angle - phi) % 360.0, active, reactive)
+                totalActive += active
+                totalReactive += reactive
+        values[-2] = totalActive
+        values[-1] = totalReactive
+        return GenySimulator.SAMPLING_LAYOUT.pack(*values)
+
+    def measurementTime(self) -> float:
+        '''
+            Return second needed by the simulated meters to give calibMeasurementCycle pulses, None if never
+        '''
+        register = self.register
+        if register == None or register['meterConstant'] <= 0:
+            return None
+        phases = len(SettleDetector.PHASES.get(register['elementSelector'], 'ABC'))
+        powerFactor = abs(register['powerFactor'])
+        if register['powerSelector'] in EnergyErrorCalibration.REACTIVE_POWER_SELECTORS:
+            powerFactor = (1.0 - powerFactor ** 2) ** 0.5
+        power = phases * register['voltage'] * register['current'] * powerFactor
+        if power <= 0:
+            return None
+        return register['calibMeasurementCycle'] * 3600.0 * 1000.0 / (register['meterConstant'] * power)
+
+    def errorSamplingData(self) -> bytes:
+        expected = self.measurementTime()
+        valid = expected != None and time.monotonic() - self.changedAt >= self.settleTime + expected
+        errors = self.meterErrors if valid else (0.0, 0.0, 0.0)
+        return GenySimulator.ERROR_LAYOUT.pack(valid, *errors)
+
+if __name__ == '__main__':
+    simulator = GenySimulator(latency=float(sys.argv[1]) if len(sys.argv) > 1 else 0.005)
+    simulator.start()
+    print(f'[GenySimulator] use GenyTestBench(\'{simulator.port}\'), Ctrl+C to stop')
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        simulator.stop()
@@ -1,7 +1,7 @@
 # from . import Util
 
 from typing import Union
-from Util import Util, CommmandDataFrame, VoltageRange, CurrentRange, PowerSelector, ElementSelector
+from Util import Util, CommmandDataFrame, FrameTemplate, VoltageRange, CurrentRange, PowerSelector, ElementSelector
 from Util import VoltageRangeError, CurrentRangeError
 import math
 
@@ -17,17 +17,17 @@ class GenySys:
         self.commandDataFrame = CommmandDataFrame()
 
     # ONLINE
-    def connect(self) -> list:
+    def connect(self) -> bytes:
         '''
             Return data frame to login to test bench
         '''
-        dataFrame = self.commandDataFrame.genDataFrame(GenySys.Command.ONLINE, [])
+        dataFrame = FrameTemplate.get(GenySys.Command.ONLINE).frame
         return dataFrame
 
     # DISCONNECT ONLINE
-    def disconnect(self) -> list:
+    def disconnect(self) -> bytes:
         '''
             Return data frame to logout from test bench
         '''
-        dataframe = self.commandDataFrame.genDataFrame(GenySys.Command.DISCONNECT_ONLINE, [])
+        dataframe = FrameTemplate.get(GenySys.Command.DISCONNECT_ONLINE).frame
         return dataframe
\ No newline at end of file
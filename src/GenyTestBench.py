@@ -1,28 +1,50 @@
 from typing import Union
-from Util import Util, VoltageRange, VoltageRangeError, ElementSelector, PowerSelector
-from Util import ResponseDataFrame
-from SerialMonitor import SerialMonitor
-from ErrorCalibration import EnergyErrorCalibration
+from Util import Util, VoltageRange, VoltageRangeError, CurrentRange, CurrentRangeError, ElementSelector, PowerSelector
+from Util import ResponseDataFrame, FrameDecoder, GenyFaultError
+from SerialMonitor import SerialMonitor, SerialReactor
+from ErrorCalibration import EnergyErrorCalibration, SamplingData, ErrorSamplingData, SettleDetector
 from GenySystemCommand import GenySys
+from Metrics import Metrics
 import math
+import time
+import queue
+from concurrent.futures import TimeoutError as FutureTimeoutError
 
 class GenyTestBench(GenySys):
     class Mode:
         ENERGY_ERROR_CALIBRATION = 1
+    
+    ERROR_RESULT_TIMEOUT = 60 # second, waitForErrorResult timeout when measurement time can not be estimated
             
-    def __init__(self, usbport, baudrate:int=115200):
+    def __init__(self, usbport, baudrate:int=115200, reactor:SerialReactor=None, maxInFlight:int=1, metrics:Metrics=None, verbose:bool=True):
+        '''
+            params:
+                usbport (str) USB path attached to GENY test bench
+                baudrate (int) Baudrate used to communicate with the test bench
+                reactor (SerialReactor) optional shared reactor reading the serial port instead of a dedicated thread
+                maxInFlight (int) number of pipelined commands allowed, keep 1 if the bench does not accept pipelining
+                metrics (Metrics) registry receiving latency histograms and counters, share one registry for a whole rack
+                verbose (bool) If false do not print frames and configuration summary on every call
+        '''
         super().__init__()
         
         self.response = ResponseDataFrame()
         
         self.usbport = usbport
         self.baudrate = baudrate
+        self.reactor = reactor
+        self.maxInFlight = maxInFlight
+        self.metrics = Metrics() if metrics == None else metrics
+        self.verbose = verbose
         
         self.mode = GenyTestBench.Mode.ENERGY_ERROR_CALIBRATION
-        self.serialMonitor = SerialMonitor(self.usbport, self.baudrate, self.onSerialReceived)
+        self.serialMonitor = self.createSerialMonitor()
         self.energyErrorCalibration = EnergyErrorCalibration()
         
         self.documentation = {}
+        self.streams = {} # command code -> (request form, serial listener) of running continuous readback
+        self.appliedAt = None # time.monotonic() of last configuration accepted by the test bench
+        self.lastSampling = None # last SamplingData received by readBackSamplingData since last apply()
         
         # Set mode
         self.setMode(self.mode)
@@ -30,6 +52,12 @@ class GenyTestBench(GenySys):
         self.serialMonitor.startMonitor()
         
     
+    def createSerialMonitor(self):
+        '''
+            Return serial handler used by this test bench
+        '''
+        return SerialMonitor(self.usbport, self.baudrate, self.onSerialReceived, self.reactor, self.maxInFlight, self.metrics, verbose=self.verbose)
+    
     def setMode(self, mode:Mode):
         self.mode = mode
         if self.mode == GenyTestBench.Mode.ENERGY_ERROR_CALIBRATION:
@@ -42,8 +70,21 @@ class GenyTestBench(GenySys):
         pass
 
 
+    def recordCall(self, method:str, start:float, encoded:float, received:float, decoded:float, errorCode:int=0):
+        '''
+            Observe API call phases: encode (start..encoded), decode (received..decoded) and total. Transaction phases
+            between encoded and received are recorded by SerialMonitor
+        '''
+        self.metrics.observe('api_seconds', encoded - start, port=self.usbport, method=method, phase='encode')
+        self.metrics.observe('api_seconds', decoded - received, port=self.usbport, method=method, phase='decode')
+        self.metrics.observe('api_seconds', decoded - start, port=self.usbport, method=method, phase='total')
+        if errorCode != 0:
+            self.metrics.increment('api_errors_total', port=self.usbport, method=method)
+
     # API
     def open(self):
+        self.energyErrorCalibration.markApplied(None)
+        self.serialMonitor.clearFault() # login again is the way back from a fault
         buffer = self.connect()
         result = self.serialMonitor.transaction(buffer)
         if result == b'':
@@ -55,6 +96,7 @@ class GenyTestBench(GenySys):
         return False
     
     def close(self):
+        self.energyErrorCalibration.markApplied(None)
         buffer = self.disconnect()
         result = self.serialMonitor.transaction(buffer)
         self.response.extractDataFrame(result)
@@ -101,6 +143,18 @@ class GenyTestBench(GenySys):
                 raise VoltageRangeError(f'Voltage set should not exceed {voltageRangeNominal}, or you could set the voltage range larger')            
             self.energyErrorCalibration.setVoltage(voltage)
 
+    def setCurrentRange(self, currentRange:Union[CurrentRange.YC99T_5C, CurrentRange.YC99T_3C]):
+        '''
+            Set current range
+            
+            parameters:
+                currentRange (CurrentRange) current range. if current register is exceed current range, it will raise exception
+        '''
+        if self.mode == GenyTestBench.Mode.ENERGY_ERROR_CALIBRATION:
+            if self.energyErrorCalibration.current > currentRange.nominal:
+                raise CurrentRangeError(f'Current range is exceed from current you had set. Consider to set current first before set the current range')
+            self.energyErrorCalibration.setCurrentRange(currentRange)
+    
     def setCurrent(self, current:float):
         '''
             Set current amplitude to corresponding mode
@@ -120,7 +174,8 @@ class GenyTestBench(GenySys):
             parameters:
                 frequency (float) the signal frequency
         '''
-        self.frequency = frequency
+        if self.mode == GenyTestBench.Mode.ENERGY_ERROR_CALIBRATION:
+            self.energyErrorCalibration.setFrequency(frequency)
     
     def setPowerFactor(self, value:float, inDegree:bool=False):
         '''
@@ -151,53 +206,323 @@ class GenyTestBench(GenySys):
         if self.mode == GenyTestBench.Mode.ENERGY_ERROR_CALIBRATION:
             self.energyErrorCalibration.setCalibrationConstants(meterConstant, cycle)
         
-    def apply(self):
+    def apply(self, force:bool=False):
         '''
-            Apply configuration on test bench
+            Apply configuration on test bench. Nothing is sent if the configuration did not change since last apply,
+            and ONLINE_ADJUST_COMMAND is used when only voltage, current, power factor, power factor unit or frequency changed.
+            Raise TimeoutError without response and GenyFaultError if the test bench tripped, next apply is then a full TEST_COMMAND
+            
+            parameters:
+                force (bool) If true always send full TEST_COMMAND
         '''
         if self.mode == GenyTestBench.Mode.ENERGY_ERROR_CALIBRATION:
-            buffer = self.energyErrorCalibration.setTestCommandForm(verbose=True)
-            result = self.serialMonitor.transaction(buffer)
+            start = time.monotonic()
+            buffer, register = self.energyErrorCalibration.applyCommandForm(force, verbose=self.verbose)
+            if buffer == None:
+                if self.verbose:
+                    print('[GenyTestBench] Configuration unchanged, nothing to apply')
+                return True
+            encoded = time.monotonic()
+            self.lastSampling = None # sampled power of the previous point, no longer valid for errorResultSchedule
+            try:
+                result = self.serialMonitor.transaction(buffer)
+                if result == b'':
+                    raise TimeoutError(f'No response to apply command {hex(buffer[FrameDecoder.HEADER_LENGTH])}')
+            except Exception:
+                self.energyErrorCalibration.markApplied(None) # configuration running on the test bench is unknown
+                raise
+            received = time.monotonic()
             self.response.extractDataFrame(result)
+            self.recordCall('apply', start, encoded, received, time.monotonic(), self.response.getErrorCode())
             if self.response.getErrorCode() == 0:
+                self.energyErrorCalibration.markApplied(register)
+                self.appliedAt = time.monotonic()
                 return True
+            self.energyErrorCalibration.markApplied(None)
             return False
+    
+    def waitSettled(self, tolerance:float=0.002, window:int=3, phaseTolerance:float=0.5, timeout:float=30, interval:float=0.2, stream:bool=False) -> float:
+        '''
+            Wait until readback sampling match the applied configuration (see SettleDetector) instead of a fixed sleep.
+            Return settle time in second, counted from last apply() when known. Raise TimeoutError if not settled in time
+            
+            parameters:
+                tolerance (float) allowed relative amplitude deviation of voltage and current
+                window (int) number of consecutive samples that shall be within tolerance
+                phaseTolerance (float) allowed phase movement in degree across the window
+                timeout (float) maximum waiting time in second
+                interval (float) polling period in second, not used in stream mode
+                stream (bool) If true use continuous readback instead of polling
+        '''
+        if self.mode == GenyTestBench.Mode.ENERGY_ERROR_CALIBRATION:
+            detector = SettleDetector(self.energyErrorCalibration, tolerance, window, phaseTolerance)
+            start = time.monotonic()
+            since = self.appliedAt if self.appliedAt != None else start
+            deadline = start + timeout
+            if stream:
+                samples = self.streamSamplingData(timeout=timeout)
+                try:
+                    for sample in samples:
+                        if detector.update(sample):
+                            return self.recordSettled(since)
+                        if time.monotonic() > deadline:
+                            break
+                finally:
+                    samples.close() # stop the stream now instead of when the generator is collected
+            else:
+                while True:
+                    polled = time.monotonic()
+                    if detector.update(self.readBackSamplingData()):
+                        return self.recordSettled(since)
+                    if polled + interval > deadline:
+                        break
+                    time.sleep(max(interval - (time.monotonic() - polled), 0))
+            self.metrics.increment('settle_timeouts_total', port=self.usbport)
+            raise TimeoutError(f'Test bench not settled after {timeout} s')
+    
+    def recordSettled(self, since:float) -> float:
+        settled = time.monotonic() - since
+        self.metrics.observe('settle_seconds', settled, port=self.usbport)
+        return settled
         
-    def readBackSamplingData(self, verbose=False):
+    def readBackSamplingData(self, verbose=False) -> SamplingData:
+        '''
+            Request one readback sampling data. Return immutable SamplingData snapshot
+        '''
         if self.mode == GenyTestBench.Mode.ENERGY_ERROR_CALIBRATION:
+            start = time.monotonic()
             buffer = self.energyErrorCalibration.readbackSampling()
+            encoded = time.monotonic()
             result = self.serialMonitor.transaction(buffer)
+            if result == b'':
+                raise TimeoutError
+            received = time.monotonic()
+            timestamp = time.time()
             self.response.extractDataFrame(result)
                 
-            samplingRegister = self.energyErrorCalibration.readbackSamplingRegister.extractResponseDataFrame(self.response)
+            sample = self.energyErrorCalibration.readbackSamplingRegister.extractSample(self.response, timestamp)
+            self.lastSampling = sample
+            self.recordCall('readBackSamplingData', start, encoded, received, time.monotonic(), self.response.getErrorCode())
             
             if verbose == True:
                 print('================================')
                 print('READ BACK SAMPLING')
                 print('================================')
-                for reg in samplingRegister:
-                    print(f'{reg.name} -> {reg.value}')
-            return samplingRegister
+                for name, value in sample.items():
+                    print(f'{name} -> {value}')
+            return sample
         
-    def readBackError(self, verbose=False):
+    def readBackError(self, verbose=False) -> ErrorSamplingData:
+        '''
+            Request one readback error sampling. Return immutable ErrorSamplingData snapshot
+        '''
         if self.mode == GenyTestBench.Mode.ENERGY_ERROR_CALIBRATION:
+            start = time.monotonic()
             buffer = self.energyErrorCalibration.readbackErrorSampling()
+            encoded = time.monotonic()
             result = self.serialMonitor.transaction(buffer)
+            if result == b'':
+                raise TimeoutError
+            received = time.monotonic()
+            timestamp = time.time()
             self.response.extractDataFrame(result)
-            print(f'Response: {self.response.toDict()}')
+            if self.verbose:
+                print(f'Response: {self.response.toDict()}')
             
-            errorRegister = self.energyErrorCalibration.errorSamplingRegister.extranctResponseDataFrame(self.response)
+            sample = self.energyErrorCalibration.errorSamplingRegister.extractSample(self.response, timestamp)
+            self.recordCall('readBackError', start, encoded, received, time.monotonic(), self.response.getErrorCode())
             
             if verbose == True:
                 print('================================')
                 print('READ BACK ERROR')
                 print('================================')
-                for reg in errorRegister:
-                    if isinstance(reg.dtype, float):
-                        print(f'{reg.name} -> {reg.value:.5f}')
+                for name, value in sample.items():
+                    if isinstance(value, float):
+                        print(f'{name} -> {value:.5f}')
                     else:
-                        print(f'{reg.name} -> {reg.value}')
-            return errorRegister
+                        print(f'{name} -> {value}')
+            return sample
+
+    def waitForErrorResult(self, power:float=None, margin:float=0.9, timeout:float=None, interval:float=0.1, maxInterval:float=2.0, backoff:float=1.5) -> ErrorSamplingData:
+        '''
+            Wait for a finished error measurement. Sleep until margin of the expected measurement time (see
+            EnergyErrorCalibration.estimateMeasurementTime) counted from last apply(), then poll readBackError with
+            growing interval until ValidFlagBit is set. Raise TimeoutError if no result in time
+            
+            parameters:
+                power (float) applied power in W (var for reactive), default from readBackSamplingData after last apply() or setpoints
+                margin (float) fraction of expected time slept without polling
+                timeout (float) maximum waiting time in second from the call, default twice the expected time plus 10 s
+                interval (float) first polling interval in second
+                maxInterval (float) largest polling interval in second
+                backoff (float) polling interval growth factor
+        '''
+        if self.mode == GenyTestBench.Mode.ENERGY_ERROR_CALIBRATION:
+            expected, deadline = self.errorResultSchedule(power, timeout)
+            since = self.appliedAt if self.appliedAt != None else time.monotonic()
+            if expected != None:
+                time.sleep(max(since + margin * expected - time.monotonic(), 0))
+            while True:
+                sample = self.readBackError()
+                if sample.ValidFlagBit:
+                    return sample
+                if time.monotonic() + interval > deadline:
+                    raise TimeoutError(f'No error result before deadline (expected measurement time {expected} s)')
+                time.sleep(interval)
+                interval = min(interval * backoff, maxInterval)
+    
+    def errorResultSchedule(self, power:float=None, timeout:float=None) -> tuple:
+        '''
+            Return (expected measurement time or None, monotonic deadline) used by waitForErrorResult
+        '''
+        if power == None and self.lastSampling != None:
+            power = self.lastSampling.TotalPowerReactive if self.energyErrorCalibration.isReactive() else self.lastSampling.TotalPowerActive
+        expected = self.energyErrorCalibration.estimateMeasurementTime(power)
+        if timeout == None:
+            timeout = GenyTestBench.ERROR_RESULT_TIMEOUT if expected == None else 2 * expected + 10
+        return expected, time.monotonic() + timeout
+        
+    def readBackSamplingAndError(self, timeout=10) -> tuple:
+        '''
+            Request readback sampling data and readback error sampling back-to-back. With maxInFlight > 1 both requests
+            are on the wire at the same time. Return (SamplingData, ErrorSamplingData)
+        '''
+        if self.mode == GenyTestBench.Mode.ENERGY_ERROR_CALIBRATION:
+            calibration = self.energyErrorCalibration
+            requests = (
+                (calibration.readbackSampling(), calibration.readbackSamplingRegister),
+                (calibration.readbackErrorSampling(), calibration.errorSamplingRegister),
+            )
+            deadline = time.monotonic() + timeout
+            pendings = []
+            try:
+                for buffer, _ in requests:
+                    pendings.append(self.serialMonitor.submit(buffer, max(deadline - time.monotonic(), 0)))
+                samples = []
+                for pending, (_, register) in zip(pendings, requests):
+                    try:
+                        result = pending.result(max(deadline - time.monotonic(), 0))
+                    except FutureTimeoutError:
+                        raise TimeoutError
+                    response = ResponseDataFrame()
+                    response.extractDataFrame(result)
+                    samples.append(register.extractSample(response, time.time()))
+                return tuple(samples)
+            except BaseException:
+                # free the slots of requests still waiting, or every later transaction would wait for them
+                for pending in pendings:
+                    self.serialMonitor.discard(pending)
+                raise
+
+    # STREAMING
+    def startSamplingStream(self, callback):
+        '''
+            Ask test bench to send readback sampling data continuously (control flag '*')
+
+            parameters:
+                callback (function) called from serial thread with every SamplingData
+        '''
+        if self.mode == GenyTestBench.Mode.ENERGY_ERROR_CALIBRATION:
+            self.startStream(
+                EnergyErrorCalibration.Command.READBACK_SAMPLING_DATA,
+                self.energyErrorCalibration.readbackSampling,
+                self.energyErrorCalibration.readbackSamplingRegister,
+                callback
+            )
+
+    def startErrorStream(self, callback):
+        '''
+            Ask test bench to send readback error sampling continuously (control flag '*')
+
+            parameters:
+                callback (function) called from serial thread with every ErrorSamplingData
+        '''
+        if self.mode == GenyTestBench.Mode.ENERGY_ERROR_CALIBRATION:
+            self.startStream(
+                EnergyErrorCalibration.Command.READBACK_ERROR_SAMPLING,
+                self.energyErrorCalibration.readbackErrorSampling,
+                self.energyErrorCalibration.errorSamplingRegister,
+                callback
+            )
+
+    def startStream(self, command:int, requestForm, register, callback):
+        '''
+            Register listener decoding every frame of command, then switch the test bench to continuous sending
+        '''
+        if command in self.streams:
+            raise RuntimeError(f'Stream of command {hex(command)} is already running')
+        
+        def listener(frame:bytes):
+            timestamp = time.time()
+            response = ResponseDataFrame()
+            response.extractDataFrame(frame)
+            if response.getErrorCode() == 0:
+                callback(register.extractSample(response, timestamp))
+        
+        self.streams[command] = (requestForm, listener)
+        self.serialMonitor.addListener(command, listener)
+        result = self.serialMonitor.transaction(requestForm('*'))
+        if result == b'':
+            self.stopStream(command)
+            raise TimeoutError
+
+    def stopStream(self, command:int=None):
+        '''
+            Stop continuous sending of command (control flag 0). Stop every running stream if command is None
+        '''
+        commands = list(self.streams) if command == None else [command]
+        for command in commands:
+            stream = self.streams.pop(command, None)
+            if stream == None:
+                continue
+            requestForm, listener = stream
+            self.serialMonitor.removeListener(command, listener)
+            try:
+                self.serialMonitor.transaction(requestForm(0))
+            except GenyFaultError:
+                pass # tripped test bench stopped streaming by itself
+
+    def streamSamplingData(self, count:int=None, timeout=10):
+        '''
+            Generator of SamplingData pushed by test bench in continuous mode. The stream is stopped when generator is closed
+
+            parameters:
+                count (int) number of samples to yield, None for endless
+                timeout (int) maximum time in second between two samples before raising TimeoutError
+        '''
+        return self.iterateStream(self.startSamplingStream, EnergyErrorCalibration.Command.READBACK_SAMPLING_DATA, count, timeout)
+
+    def streamError(self, count:int=None, timeout=10):
+        '''
+            Generator of ErrorSamplingData pushed by test bench in continuous mode. The stream is stopped when generator is closed
+
+            parameters:
+                count (int) number of samples to yield, None for endless
+                timeout (int) maximum time in second between two samples before raising TimeoutError
+        '''
+        return self.iterateStream(self.startErrorStream, EnergyErrorCalibration.Command.READBACK_ERROR_SAMPLING, count, timeout)
+
+    def iterateStream(self, start, command:int, count:int, timeout):
+        samples = queue.Queue()
+        start(samples.put)
+        onFault = samples.put # GenyFaultError is queued as sentinel so the consumer fails at once
+        self.serialMonitor.addFaultHandler(onFault)
+        if self.serialMonitor.fault != None: # tripped before the handler was there
+            onFault(self.serialMonitor.fault)
+        try:
+            received = 0
+            while count == None or received < count:
+                try:
+                    sample = samples.get(timeout=timeout)
+                except queue.Empty:
+                    raise TimeoutError
+                if isinstance(sample, GenyFaultError):
+                    raise GenyFaultError(sample.port, sample.frame)
+                received += 1
+                yield sample
+        finally:
+            self.serialMonitor.removeFaultHandler(onFault)
+            self.stopStream(command)
 
 if __name__ == '__main__':
     import time
@@ -0,0 +1,168 @@
+from contextlib import contextmanager
+import bisect
+import threading
+import time
+
+class Histogram:
+    '''
+        Cumulative latency histogram with fixed buckets in second, same model as Prometheus histogram
+    '''
+    BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, buckets:tuple=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # last slot is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value:float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q:float) -> float:
+        '''
+            Return estimated q quantile (0..1) by linear interpolation inside the bucket. None if empty
+        '''
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            if count > 0 and cumulative + count >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = min(self.buckets[i], self.max) if i < len(self.buckets) else self.max
+                lower = min(lower, upper)
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.max
+
+    def toDict(self) -> dict:
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max,
+            'p50': self.quantile(0.50),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+        }
+
+class Metrics:
+    '''
+        Thread safe registry of latency histograms and counters identified by name and labels.
+        One registry can be shared by many test benches, every series carries the port label
+    '''
+    HELP = {
+        'transaction_seconds': 'Serial transaction duration by phase (write, wait first byte, receive, total)',
+        'transactions_total': 'Serial transactions sent',
+        'transaction_timeouts_total': 'Serial transactions without response before timeout',
+        'transaction_faults_total': 'Serial transactions failed by test bench fault',
+        'api_seconds': 'GenyTestBench API call duration by phase (encode, decode, total)',
+        'api_errors_total': 'GenyTestBench API calls answered with non zero error code',
+        'settle_seconds': 'Time from apply until readback settled',
+        'settle_timeouts_total': 'waitSettled calls ended by timeout',
+    }
+
+    def __init__(self, namespace:str='geny'):
+        '''
+            params:
+                namespace (str) prefix of every metric name in the Prometheus dump
+        '''
+        self.namespace = namespace
+        self.lock = threading.Lock()
+        self.histograms = {} # (name, labels) -> Histogram
+        self.counters = {} # (name, labels) -> int
+
+    def key(name:str, labels:dict) -> tuple:
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def observe(self, name:str, value:float, **labels):
+        '''
+            Add value in second to the histogram name{labels}
+        '''
+        key = Metrics.key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram == None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def increment(self, name:str, value:int=1, **labels):
+        '''
+            Add value to the counter name{labels}
+        '''
+        key = Metrics.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    @contextmanager
+    def timer(self, name:str, **labels):
+        '''
+            Observe duration of a with block
+        '''
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, **labels)
+
+    def histogram(self, name:str, **labels) -> Histogram:
+        return self.histograms.get(Metrics.key(name, labels))
+
+    def counter(self, name:str, **labels) -> int:
+        return self.counters.get(Metrics.key(name, labels), 0)
+
+    def reset(self):
+        with self.lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+    def toDict(self) -> dict:
+        '''
+            Return {'histograms': [...], 'counters': [...]}, each entry has name, labels and values
+        '''
+        with self.lock:
+            return {
+                'histograms': [dict(name=name, labels=dict(labels), **histogram.toDict()) for (name, labels), histogram in self.histograms.items()],
+                'counters': [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in self.counters.items()],
+            }
+
+    def formatLabels(labels, extra:tuple=()) -> str:
+        items = tuple(labels) + extra
+        if len(items) == 0:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(k, v.replace('\\', '\\\\').replace('"', '\\"')) for k, v in items) + '}'
+
+    def prometheus(self) -> str:
+        '''
+            Return every metric in Prometheus text exposition format
+        '''
+        lines = []
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+        described = set()
+        for (name, labels), histogram in histograms:
+            fullName = f'{self.namespace}_{name}'
+            if fullName not in described:
+                described.add(fullName)
+                lines.append(f'# HELP {fullName} {Metrics.HELP.get(name, name)}')
+                lines.append(f'# TYPE {fullName} histogram')
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f'{fullName}_bucket{Metrics.formatLabels(labels, (("le", repr(bound)),))} {cumulative}')
+            lines.append(f'{fullName}_bucket{Metrics.formatLabels(labels, (("le", "+Inf"),))} {histogram.count}')
+            lines.append(f'{fullName}_sum{Metrics.formatLabels(labels)} {histogram.sum!r}')
+            lines.append(f'{fullName}_count{Metrics.formatLabels(labels)} {histogram.count}')
+        for (name, labels), value in counters:
+            fullName = f'{self.namespace}_{name}'
+            if fullName not in described:
+                described.add(fullName)
+                lines.append(f'# HELP {fullName} {Metrics.HELP.get(name, name)}')
+                lines.append(f'# TYPE {fullName} counter')
+            lines.append(f'{fullName}{Metrics.formatLabels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
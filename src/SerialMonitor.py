@@ -3,18 +3,119 @@ from datetime import datetime,timedelta
 import sys
 import time
 import threading
+from collections import deque
+import selectors
+import socket
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from Util import FrameDecoder, GenyFaultError
+from GenySystemCommand import GenySys
+from Metrics import Metrics
+from WireCapture import WireCapture
+
+class SerialReactor:
+    '''
+        Optional I/O backend driving many SerialMonitor from one thread. Every serial file descriptor is registered in a
+        selectors (epoll on linux) loop which feeds the frame decoder of the port when bytes arrive. POSIX only.
+    '''
+    def __init__(self):
+        if sys.platform.startswith('win'):
+            raise NotImplementedError('SerialReactor require POSIX file descriptor for serial port')
+        self.selector = selectors.DefaultSelector()
+        self.wakeupReader, self.wakeupWriter = socket.socketpair()
+        self.wakeupReader.setblocking(False)
+        self.selector.register(self.wakeupReader, selectors.EVENT_READ, None)
+        self.lock = threading.Lock()
+        self.fds = {} # monitor -> registered file descriptor, still known after the port is closed
+        self.runService = True
+        self.serviceIsActive = False
+        self.service = None
+
+    def register(self, monitor):
+        '''
+            Start watching serial port of monitor, the reactor thread is started on first registration
+        '''
+        with self.lock:
+            fd = monitor.ser.fileno()
+            self.selector.register(fd, selectors.EVENT_READ, monitor)
+            self.fds[monitor] = fd
+            if self.service == None:
+                self.service = threading.Thread(target=self.reactorLoop, daemon=True)
+                self.service.start()
+        self.wakeup()
+
+    def unregister(self, monitor):
+        '''
+            Stop watching serial port of monitor
+        '''
+        with self.lock:
+            fd = self.fds.pop(monitor, None)
+            if fd == None:
+                return
+            try:
+                self.selector.unregister(fd)
+            except (KeyError, ValueError):
+                pass
+        self.wakeup()
+
+    def wakeup(self):
+        try:
+            self.wakeupWriter.send(b'\x00')
+        except (BlockingIOError, OSError):
+            pass
+
+    def stop(self):
+        '''
+            Stop reactor thread and release the selector and wakeup sockets, the reactor can not be used anymore
+        '''
+        self.runService = False
+        self.wakeup()
+        if self.service != None:
+            self.service.join()
+            self.service = None
+        with self.lock:
+            self.fds.clear()
+            self.selector.close()
+        self.wakeupReader.close()
+        self.wakeupWriter.close()
+
+    def reactorLoop(self):
+        print('[SerialReactor] reactor started')
+        self.serviceIsActive = True
+        while self.runService:
+            for key, _ in self.selector.select():
+                monitor = key.data
+                if monitor == None:
+                    try:
+                        self.wakeupReader.recv(4096)
+                    except BlockingIOError:
+                        pass
+                    continue
+                try:
+                    monitor.onReadable()
+                except Exception as e:
+                    print(f'[SerialReactor] {monitor.port} read failed: {e}')
+                    monitor.onDisconnect()
+        print('[SerialReactor] reactor has been terminated')
+        self.serviceIsActive = False
 
 class SerialMonitor:
     '''
         Handler for GENY serial communication
     '''
+    READ_CHUNK_SIZE = 4096
+    FAULT_COMMANDS = (GenySys.Command.SOURCE_FEEDBACK,) # unsolicited frames meaning the test bench tripped
 
-    def __init__(self,usb_port:str, baudrate:int, onReceive):
+    def __init__(self,usb_port:str, baudrate:int, onReceive, reactor:SerialReactor=None, maxInFlight:int=1, metrics:Metrics=None, capture:WireCapture=None, verbose:bool=True):
         '''
             params:
                 usb_port (str) USB path attached to GENY test bench
                 baudrate (int) Baudrate used to communicate with the test benchs
                 onReceive (function) Function used as callback when there is buffer received from test bench
+                reactor (SerialReactor) If set, serial port is read by the shared reactor instead of a dedicated thread
+                maxInFlight (int) Number of commands allowed to wait for response at the same time. Keep 1 unless the bench accepts pipelined commands
+                metrics (Metrics) registry receiving transaction latency and counters, default a private one
+                capture (WireCapture) optional tap recording every sent and received chunk
+                verbose (bool) If false do not print every transaction (benchmark, production logging)
         '''
         if sys.platform.startswith('win'):
             self.ser = serial.Serial(
@@ -41,9 +142,24 @@ class SerialMonitor:
         self.recv_buffer = []
         self.serviceIsActive = False
         self.emergency = False
+        self.fault = None # GenyFaultError of the last fault frame until clearFault()
+        self.faultHandlers = ()
         self.callback = onReceive
         self.runService = True
         self.isRunning = False
+        self.decoder = FrameDecoder(self.onFrame, checkCRC=True)
+        self.inFlight = deque() # Future of every command waiting for response, in sending order
+        self.pendingLock = threading.Lock()
+        self.writeLock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(maxInFlight)
+        self.listeners = {} # command code -> list of function receiving unsolicited frames
+        self.reactor = reactor
+        self.chunk = bytearray(SerialMonitor.READ_CHUNK_SIZE) # reused for every read
+        self.view = memoryview(self.chunk)
+        self.metrics = Metrics() if metrics == None else metrics
+        self.capture = capture
+        self.verbose = verbose
+        self.firstByteAt = 0.0 # time.monotonic() when the first byte of the frame being received arrived
         self.service = threading.Thread(target=self.serialMonitor, daemon=True)
     
     def startMonitor(self):
@@ -51,6 +167,10 @@ class SerialMonitor:
             Run serial handler monitor
         '''
         print('[SerialHandler] starting serialMonitor')
+        if self.reactor != None:
+            self.reactor.register(self)
+            self.isRunning = True
+            return
         try:
             self.service.start()
             self.isRunning = True
@@ -62,54 +182,273 @@ class SerialMonitor:
         '''
             Stop serial handler monitor
         '''
-        print('[SerialHandler] starting serialMonitor')
+        print('[SerialHandler] stopping serialMonitor')
+        self.runService = False
         self.isRunning = False
+        if self.reactor != None:
+            self.reactor.unregister(self)
+            self.ser.close()
+            return
         if isBlocking:
             while self.serviceIsActive:
                 time.sleep(0.1)
+            self.ser.close()
         
+    def submit(self, dataFrame:bytearray, timeout=None) -> Future:
+        '''
+            Send data frame without waiting its response. Return Future completed with the response frame.
+            Responses are matched to requests by COMMAND field, the oldest request of a command is answered first.
+
+            parameter
+                dataFrame (bytearray) data farme will be sent to test bench
+                timeout (int) how much time for waiting a free slot when maxInFlight commands are waiting, None for no limit
+        '''
+        submittedAt = time.monotonic()
+        if self.fault != None:
+            raise GenyFaultError(self.port, self.fault.frame) # fresh instance, the stored one would grow its traceback at every call
+        if not self.slots.acquire(timeout=timeout if timeout != None else -1):
+            raise TimeoutError(f'No free slot to send command {hex(dataFrame[FrameDecoder.HEADER_LENGTH])}')
+        pending = Future()
+        pending.command = dataFrame[FrameDecoder.HEADER_LENGTH]
+        pending.submittedAt = submittedAt
+        pending.firstByteAt = pending.receivedAt = None
+        pending.add_done_callback(lambda future: self.slots.release())
+        with self.writeLock:
+            with self.pendingLock: # onFault sets the fault and fails inFlight under the same lock
+                if self.fault != None:
+                    pending.cancel()
+                    raise GenyFaultError(self.port, self.fault.frame)
+                self.inFlight.append(pending)
+            try:
+                self.ser.write(dataFrame)
+            except BaseException:
+                self.discard(pending) # frees the slot
+                raise
+            if self.capture != None:
+                self.capture.tx(dataFrame)
+        pending.writtenAt = time.monotonic()
+        return pending
+
+    def discard(self, pending:Future):
+        '''
+            Give up waiting response of a submitted command
+        '''
+        with self.pendingLock:
+            try:
+                self.inFlight.remove(pending)
+            except ValueError:
+                pass
+        pending.cancel()
+
     def transaction(self, dataFrame:bytearray, timeout=10) -> bytearray:
         '''
+            Send data frame and wait its response. Return b'' on timeout, raise GenyFaultError if the test bench reported a fault
+            
             parameter
                 dataFrame (bytearray) data farme will be sent to test bench
                 timeout (int) how much time for waiting serial answer in second
         '''
-        self.recvBuffer = b''
-        self.ser.write(dataFrame)
-        d_initial = datetime.now()
-        t_timeout = timedelta(seconds=timeout)
-        while datetime.now() - d_initial < t_timeout:
-            if self.recvBuffer == b'':
-                time.sleep(0.1)
-                continue
-            temp = self.recvBuffer
-            self.recvBuffer = b''
+        deadline = time.monotonic() + timeout
+        command = hex(dataFrame[FrameDecoder.HEADER_LENGTH])
+        self.metrics.increment('transactions_total', port=self.port, command=command)
+        try:
+            try:
+                pending = self.submit(dataFrame, timeout)
+            except TimeoutError:
+                self.metrics.increment('transaction_timeouts_total', port=self.port, command=command)
+                return b''
+            try:
+                temp = pending.result(max(deadline - time.monotonic(), 0))
+            except FutureTimeoutError:
+                self.discard(pending)
+                self.metrics.increment('transaction_timeouts_total', port=self.port, command=command)
+                return b''
+        except GenyFaultError:
+            self.metrics.increment('transaction_faults_total', port=self.port, command=command)
+            raise
+        self.recordTransaction(pending, command)
+        if self.verbose:
             print(f'[SerialMonitor] Transaction {temp}')
-            return temp
-        return b''
+        return temp
+
+    def recordTransaction(self, pending:Future, command:str):
+        '''
+            Observe phase durations of a completed request: write (including waiting the write lock), wait until first
+            response byte, receive until frame complete, and total
+        '''
+        observe = self.metrics.observe
+        observe('transaction_seconds', pending.writtenAt - pending.submittedAt, port=self.port, command=command, phase='write')
+        if pending.receivedAt != None:
+            firstByteAt = min(max(pending.firstByteAt, pending.writtenAt), pending.receivedAt)
+            observe('transaction_seconds', firstByteAt - pending.writtenAt, port=self.port, command=command, phase='wait')
+            observe('transaction_seconds', pending.receivedAt - firstByteAt, port=self.port, command=command, phase='receive')
+        observe('transaction_seconds', time.monotonic() - pending.submittedAt, port=self.port, command=command, phase='total')
 
     def serialWrite(self, dataFrame:bytearray)->None:
         '''
             send serial buffer to serial
         '''
-        self.ser.write(dataFrame)
+        with self.writeLock:
+            self.ser.write(dataFrame)
+            if self.capture != None:
+                self.capture.tx(dataFrame)
         
+    def addListener(self, command:int, listener):
+        '''
+            Register function called from serial thread with every received frame of the command.
+            While a command has listener, its frames only complete transaction that sent the same command
+
+            parameters:
+                command (int) command code
+                listener (function) function with one argument, the frame (bytes)
+        '''
+        listeners = self.listeners.get(command, ())
+        self.listeners[command] = listeners + (listener,)
+
+    def removeListener(self, command:int, listener):
+        '''
+            Unregister function added by addListener
+        '''
+        listeners = tuple(fn for fn in self.listeners.get(command, ()) if fn != listener)
+        if len(listeners) > 0:
+            self.listeners[command] = listeners
+        else:
+            self.listeners.pop(command, None)
+
+    def addFaultHandler(self, handler):
+        '''
+            Register function called from serial thread with GenyFaultError when test bench report a fault
+        '''
+        self.faultHandlers = self.faultHandlers + (handler,)
+
+    def removeFaultHandler(self, handler):
+        self.faultHandlers = tuple(fn for fn in self.faultHandlers if fn != handler)
+
+    def clearFault(self):
+        '''
+            Accept commands again after a fault
+        '''
+        self.fault = None
+        self.emergency = False
+
+    def onFault(self, frame:bytes):
+        '''
+            Fail every waiting request with GenyFaultError and notify fault handlers
+        '''
+        fault = GenyFaultError(self.port, frame)
+        self.emergency = True
+        with self.pendingLock:
+            self.fault = fault
+            pendings = list(self.inFlight)
+            self.inFlight.clear()
+        for pending in pendings:
+            if pending.set_running_or_notify_cancel():
+                pending.set_exception(GenyFaultError(self.port, frame))
+        for handler in self.faultHandlers:
+            try:
+                handler(fault)
+            except Exception as e:
+                print(f'[SerialHandler] fault handler failed: {e}')
+
+    def popPending(self, command:int) -> Future:
+        '''
+            Remove and return the oldest waiting request of command, None if there is none. A frame is never given to a
+            request of another command, a late response of a timed out request would shift every following response
+        '''
+        with self.pendingLock:
+            for pending in self.inFlight:
+                if pending.command == command:
+                    self.inFlight.remove(pending)
+                    return pending
+        return None
+
+    def onFrame(self, frame:bytes):
+        '''
+            Called by frame decoder when a complete frame has been received
+        '''
+        self.recvBuffer = frame
+        command = frame[FrameDecoder.HEADER_LENGTH]
+        if command in SerialMonitor.FAULT_COMMANDS:
+            self.onFault(frame)
+            if self.callback != None:
+                self.callback(frame)
+            return
+        listeners = self.listeners.get(command)
+        pending = self.popPending(command)
+        if pending != None and pending.set_running_or_notify_cancel(): # False if caller gave up meanwhile
+            pending.firstByteAt = self.firstByteAt
+            pending.receivedAt = time.monotonic()
+            pending.set_result(frame)
+        elif listeners == None:
+            print(f'[SerialHandler] {self.port} dropping unexpected frame of command {hex(command)} (late response of a timed out request?)')
+        if listeners != None:
+            for listener in listeners:
+                try:
+                    listener(frame)
+                except Exception as e:
+                    print(f'[SerialHandler] listener of command {hex(command)} failed: {e}')
+        if self.callback != None:
+            self.callback(frame)
+
+    def onDisconnect(self):
+        '''
+            Serial port is gone (device unplugged, pty closed): stop reading, close the port and fail every waiting
+            request with SerialException
+        '''
+        print(f'[SerialHandler] {self.port} disconnected')
+        self.runService = False
+        self.isRunning = False
+        if self.reactor != None:
+            self.reactor.unregister(self)
+        error = serial.SerialException(f'Serial port {self.port} disconnected')
+        with self.pendingLock:
+            pendings = list(self.inFlight)
+            self.inFlight.clear()
+        for pending in pendings:
+            if pending.set_running_or_notify_cancel():
+                pending.set_exception(error)
+        try:
+            self.ser.close()
+        except Exception:
+            pass
+
+    def onReadable(self):
+        '''
+            Called by SerialReactor when serial port has incoming bytes, read without blocking.
+            Readable without any byte is end of file (hang up)
+        '''
+        size = min(self.ser.in_waiting, SerialMonitor.READ_CHUNK_SIZE)
+        if size == 0:
+            self.onDisconnect()
+            return
+        received = self.ser.readinto(self.view[:size])
+        if received:
+            if len(self.decoder.buffer) == 0:
+                self.firstByteAt = time.monotonic()
+            if self.capture != None:
+                self.capture.rx(self.view[:received])
+            self.decoder.feed(self.view[:received])
+
     def serialMonitor(self):
         print('[SerialHandler] serialMonitor started')
+        self.serviceIsActive = True
+        view = self.view
         while self.runService:
-            self.serviceIsActive = True
-            # self.recvBuffer = b''
-            tempBuffer = b''
-            while self.runService:
-                temp = self.ser.read()
-                if temp != b'':
-                    tempBuffer += temp
-                else: # enter this block if serial not detect incoming data (refer timeout parameter on class Serial)
-                    if len(tempBuffer) > 0:
-                        self.recvBuffer = tempBuffer
-                        if self.callback != None:
-                            self.callback(tempBuffer)
-                        break
+            # Drain everything already received, or block for one byte until serial timeout
+            try:
+                size = min(self.ser.in_waiting, SerialMonitor.READ_CHUNK_SIZE) or 1
+                received = self.ser.readinto(view[:size])
+            except (serial.SerialException, OSError) as e:
+                if self.runService:
+                    print(f'[SerialHandler] {self.port} read failed: {e}')
+                    self.onDisconnect()
+                break
+            if received:
+                if len(self.decoder.buffer) == 0:
+                    self.firstByteAt = time.monotonic()
+                if self.capture != None:
+                    self.capture.rx(view[:received])
+                self.decoder.feed(view[:received])
         print('[SerialHandler] serialMonitor has been terminated')
         self.serviceIsActive = False
             
@@ -0,0 +1,230 @@
+from Util import CommmandDataFrame, CRC16, Selector, RangeLevel, VoltageRange, CurrentRange, PowerSelector, ElementSelector
+from Util import TestPlanError
+from ErrorCalibration import EnergyErrorCalibration
+import struct
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+class TestPlan:
+    '''
+        Test plan compiled ahead of the run. Setpoints are given as columns (numpy arrays or scalars broadcast to the
+        plan length), validated against range nominals in one vectorised pass, then every TEST_COMMAND data frame is
+        encoded into one contiguous buffer. Require numpy
+    '''
+    # struct format code of TEST_COMMAND_LAYOUT -> numpy type
+    NUMPY_CODES = {'B': 'u1', 'H': '<u2', 'I': '<u4', 'f': '<f4'}
+    CRC_CODE = '>u2' # CRC16 field holds the register high byte first (see CRC16.digest)
+    MAX_REPORTED_ERRORS = 10
+
+    def frameDtype():
+        '''
+            Return numpy structured dtype of one complete data frame, DATA fields are named after REGISTER_FIELDS
+        '''
+        codes = EnergyErrorCalibration.TEST_COMMAND_LAYOUT.lstrip('<')
+        return np.dtype(
+            [('SOI', 'u1'), ('LEN', '<u4'), ('COMMAND', 'u1'), ('RESERVED', 'u1')]
+            + [(name, TestPlan.NUMPY_CODES[code]) for name, code in zip(EnergyErrorCalibration.REGISTER_FIELDS, codes)]
+            + [('CRC16', TestPlan.CRC_CODE), ('EOI', 'u1')]
+        )
+
+    def enumColumn(values):
+        '''
+            Return integer column from Selector, RangeLevel or int values
+        '''
+        if isinstance(values, (Selector, RangeLevel)):
+            return values.enum
+        if isinstance(values, (list, tuple)):
+            return [value.enum if isinstance(value, (Selector, RangeLevel)) else value for value in values]
+        return values
+
+    def selectRanges(levels:list, amplitude, explicit=None):
+        '''
+            Return (index into levels, covered mask). Without explicit ranges the smallest covering level is taken
+        '''
+        nominals = np.array([level.nominal for level in levels], dtype=np.float64)
+        if explicit is None:
+            index = np.searchsorted(nominals, np.abs(amplitude), side='left')
+        else:
+            enums = np.array([level.enum for level in levels])
+            order = np.argsort(enums)
+            explicit = np.broadcast_to(np.asarray(TestPlan.enumColumn(explicit)), amplitude.shape)
+            position = np.minimum(np.searchsorted(enums[order], explicit), len(levels) - 1)
+            index = np.where(enums[order][position] == explicit, order[position], len(levels))
+        known = index < len(levels)
+        covered = known & (np.abs(amplitude) <= nominals[np.minimum(index, len(levels) - 1)])
+        return index, covered
+
+    def compile(voltage, current, powerFactor=1.0,
+                element=ElementSelector.EnergyErrorCalibration._COMBINE_ALL,
+                powerSelector=PowerSelector._3P4W_ACTIVE,
+                powerFactorUnit=EnergyErrorCalibration.PFUnit._L,
+                frequency=50.0, meterConstant=0, cycle=0,
+                voltageRange=None, currentRange=None,
+                voltageRanges=VoltageRange.YC99T_5C, currentRanges=CurrentRange.YC99T_5C):
+        '''
+            Validate and encode a test plan. Raise TestPlanError listing every invalid point
+
+            parameters:
+                voltage, current, powerFactor, frequency (array|float) setpoint columns
+                element, powerSelector (array|list|Selector) selection columns, Selector or their enum
+                powerFactorUnit (array|int) EnergyErrorCalibration.PFUnit column
+                meterConstant (array|float) meter LED blink constant
+                cycle (array|int) number of measurement cycles
+                voltageRange, currentRange (array|list|RangeLevel) explicit ranges, default smallest covering range
+                voltageRanges, currentRanges available range levels
+            return:
+                TestPlan
+        '''
+        if np == None:
+            raise ImportError('numpy is required for TestPlan')
+
+        columns = np.broadcast_arrays(
+            np.asarray(voltage, dtype=np.float64),
+            np.asarray(current, dtype=np.float64),
+            np.asarray(powerFactor, dtype=np.float64),
+            np.asarray(frequency, dtype=np.float64),
+            np.asarray(meterConstant, dtype=np.float64),
+            np.asarray(cycle),
+            np.asarray(TestPlan.enumColumn(element)),
+            np.asarray(TestPlan.enumColumn(powerSelector)),
+            np.asarray(TestPlan.enumColumn(powerFactorUnit)),
+        )
+        voltage, current, powerFactor, frequency, meterConstant, cycle, element, powerSelector, powerFactorUnit = (
+            np.atleast_1d(column).ravel() for column in columns
+        )
+
+        voltageLevels = EnergyErrorCalibration.rangeLevels(voltageRanges)
+        currentLevels = EnergyErrorCalibration.rangeLevels(currentRanges)
+        voltageIndex, voltageCovered = TestPlan.selectRanges(voltageLevels, voltage, voltageRange)
+        currentIndex, currentCovered = TestPlan.selectRanges(currentLevels, current, currentRange)
+
+        checks = (
+            (~np.isfinite(voltage) | (voltage < 0), 'voltage shall be finite and positive'),
+            (~np.isfinite(current) | (current < 0), 'current shall be finite and positive'),
+            (~voltageCovered, 'voltage exceed voltage range'),
+            (~currentCovered, 'current exceed current range'),
+            (~(np.abs(powerFactor) <= 1), 'power factor shall be within [-1, 1]'),
+            (~(frequency > 0), 'frequency shall be positive'),
+            (~np.isfinite(meterConstant) | (meterConstant < 0), 'meter constant shall be finite and positive'),
+            ((cycle < 0) | (cycle > 0xFFFF), 'measurement cycle shall fit 16 bit'),
+            ((element < 0) | (element > 0xFF), 'element selection shall fit 8 bit'),
+            ((powerSelector < 0) | (powerSelector > 0xFF), 'power selection shall fit 8 bit'),
+            ((powerFactorUnit < 0) | (powerFactorUnit > 0xFF), 'power factor unit shall fit 8 bit'),
+        )
+        errors = []
+        for mask, message in checks:
+            errors.extend((int(index), message) for index in np.flatnonzero(mask))
+        if errors:
+            errors.sort()
+            raise TestPlanError(errors, TestPlan.MAX_REPORTED_ERRORS)
+
+        voltageEnums = np.array([level.enum for level in voltageLevels])
+        frames = np.zeros(len(voltage), dtype=TestPlan.frameDtype())
+        frames['SOI'] = CommmandDataFrame.SOI_CONSTANT
+        frames['LEN'] = CommmandDataFrame.COMMAND_BIT_LENGTH + struct.calcsize(EnergyErrorCalibration.TEST_COMMAND_LAYOUT)
+        frames['COMMAND'] = EnergyErrorCalibration.Command.TEST_COMMAND
+        frames['powerSelector'] = powerSelector
+        frames['elementSelector'] = element
+        frames['voltageRange'] = voltageEnums[voltageIndex]
+        frames['voltage'] = voltage
+        frames['current'] = current
+        frames['powerFactor'] = powerFactor
+        frames['powerFactorUnit'] = powerFactorUnit
+        frames['frequency'] = frequency
+        frames['meterConstant'] = meterConstant
+        frames['calibMeasurementCycle'] = cycle
+        frames['EOI'] = CommmandDataFrame.EOI_CONSTANT
+        frames['CRC16'] = TestPlan.computeCRC(frames)
+
+        return TestPlan(frames, [voltageLevels[i] for i in voltageIndex], [currentLevels[i] for i in currentIndex])
+
+    def computeCRC(frames):
+        '''
+            Return CRC16 register value of every frame, each byte column of the whole plan is processed at once
+        '''
+        raw = frames.view(np.uint8).reshape(len(frames), frames.dtype.itemsize)
+        start = frames.dtype.fields['COMMAND'][1]
+        end = frames.dtype.fields['CRC16'][1]
+        return CRC16.crcRows(raw[:, start:end])
+
+    def __init__(self, frames, voltageRanges:list, currentRanges:list):
+        '''
+            params:
+                frames (numpy.ndarray) structured array of encoded data frames (see frameDtype)
+                voltageRanges (list) RangeLevel of each point
+                currentRanges (list) RangeLevel of each point
+        '''
+        self.frames = frames
+        self.voltageRanges = voltageRanges
+        self.currentRanges = currentRanges
+        self.frameSize = frames.dtype.itemsize
+        self.buffer = frames.tobytes() # contiguous wire image of the whole plan
+        self.view = memoryview(self.buffer)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def frame(self, index:int) -> memoryview:
+        '''
+            Return data frame of point index, slice of the plan buffer
+        '''
+        if index < 0:
+            index += len(self.frames)
+        return self.view[index * self.frameSize:(index + 1) * self.frameSize]
+
+    def run(self, bench, settleTime:float=0.0, readback:bool=True, callback=None) -> list:
+        '''
+            Send every frame to bench in plan order. Return list of SamplingData (None when readback is false).
+            The bench configuration registers are not updated, so its next apply() is a full TEST_COMMAND
+
+            parameters:
+                bench (GenyTestBench) opened test bench
+                settleTime (float) second to wait after each frame before readback
+                readback (bool) If true readback sampling data after each point
+                callback (function) called with (index, SamplingData) after each point
+        '''
+        bench.energyErrorCalibration.markApplied(None)
+        samples = []
+        for index in range(len(self.frames)):
+            # state of the previous point, no longer valid for waitForErrorResult
+            bench.appliedAt = None
+            bench.lastSampling = None
+            result = bench.serialMonitor.transaction(self.frame(index))
+            if result == b'':
+                raise TimeoutError(f'No response to point {index} of the test plan')
+            bench.response.extractDataFrame(result)
+            if bench.response.getErrorCode() != 0:
+                print(f'[TestPlan] Test bench refused point {index}')
+                break
+            bench.appliedAt = time.monotonic()
+            sample = None
+            if readback:
+                if settleTime > 0:
+                    time.sleep(settleTime)
+                try:
+                    sample = bench.readBackSamplingData()
+                except TimeoutError:
+                    raise TimeoutError(f'No readback sampling data at point {index} of the test plan')
+            samples.append(sample)
+            if callback != None:
+                callback(index, sample)
+        return samples
+
+if __name__ == '__main__':
+    def compile_grid():
+        voltage, current, powerFactor = np.meshgrid(np.linspace(10, 380, 20), np.linspace(0.01, 100, 20), (1.0, 0.8, 0.5, 0.0, -0.5), indexing='ij')
+        start = time.perf_counter()
+        plan = TestPlan.compile(voltage, current, powerFactor)
+        duration = time.perf_counter() - start
+        print(f'[compile_grid] {len(plan)} points compiled in {duration * 1000:.2f} ms, buffer {len(plan.buffer)} bytes')
+
+        try:
+            TestPlan.compile((220, 700, 230), (5, 5, 150), (1.0, 1.0, 2.0))
+        except TestPlanError as e:
+            print(f'[compile_grid] {e}')
+
+    compile_grid()
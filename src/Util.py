@@ -1,4 +1,10 @@
 import struct
+import sys
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 class VoltageRangeError(Exception):
     pass
@@ -9,6 +15,27 @@ class CurrentRangeError(Exception):
 class DatFrameError(Exception):
     pass
 
+class GenyFaultError(Exception):
+    '''
+        Raised when test bench report a fault (SOURCE_FEEDBACK frame). frame is the received fault data frame
+    '''
+    def __init__(self, port:str, frame:bytes):
+        self.port = port
+        self.frame = frame
+        self.errorCode = frame[FrameDecoder.HEADER_LENGTH + 2] if len(frame) > FrameDecoder.HEADER_LENGTH + 2 + FrameDecoder.TRAILER_LENGTH else None
+        super().__init__(f'Test bench {port} reported fault, error code {self.errorCode}')
+
+class TestPlanError(Exception):
+    '''
+        Raised when a test plan has invalid points. errors is list of (point index, message)
+    '''
+    def __init__(self, errors:list, maxReported:int=10):
+        self.errors = errors
+        detail = ', '.join(f'#{index} {message}' for index, message in errors[:maxReported])
+        if len(errors) > maxReported:
+            detail += f', ... {len(errors) - maxReported} more'
+        super().__init__(f'{len(errors)} invalid point(s): {detail}')
+
 class CommmandDataFrame:
     SOI_BIT_LENGTH = 1
     DATA_FRAME_BIT_LENGTH = 4
@@ -19,6 +46,8 @@ class CommmandDataFrame:
     SOI_CONSTANT = 0x7e
     EOI_CONSTANT = 0xff
     
+    HEADER_STRUCT = struct.Struct('<BI') # SOI, LEN
+    
     def __init__(self):
         # variable that store 
         self.SOI = []
@@ -55,34 +84,33 @@ class CommmandDataFrame:
         '''
             Extract information inside Command data frame
         '''
-        dFrame = list(dataFrame)
-        if len(dFrame) == 0 or dFrame == None: # Protection for empty datframe
+        if dataFrame == None or len(dataFrame) == 0: # Protection for empty datframe
             raise Exception(f'Data frame is empty')
-        
+        if not isinstance(dataFrame, (bytes, bytearray, memoryview)):
+            dataFrame = bytes(dataFrame)
+
         # Protection for invalid flag
-        if dFrame[0] == CommmandDataFrame.SOI_CONSTANT and dFrame[-1] == CommmandDataFrame.EOI_CONSTANT:
+        if dataFrame[0] == CommmandDataFrame.SOI_CONSTANT and dataFrame[-1] == CommmandDataFrame.EOI_CONSTANT:
             pass
         else:
             raise Exception(f'Wrong dataframe format (INVALID FLAG)')
 
-        _SOI = [dFrame.pop(0)]
-        _LEN = [dFrame.pop(0) for i in range(CommmandDataFrame.DATA_FRAME_BIT_LENGTH)]
-        commandDataLen = Util.Hex2uint(_LEN, self.DATA_FRAME_BIT_LENGTH)
-        if commandDataLen + CommmandDataFrame.CRC16_BIT_LENGTH + CommmandDataFrame.EOI_BIT_LENGTH == len(dFrame):
+        if len(dataFrame) < CommmandDataFrame.HEADER_STRUCT.size:
+            raise Exception(f'Invalid dataframe')
+        _, commandDataLen = CommmandDataFrame.HEADER_STRUCT.unpack_from(dataFrame, 0)
+        dataOffset = CommmandDataFrame.HEADER_STRUCT.size
+        crcOffset = dataOffset + commandDataLen
+        if crcOffset + CommmandDataFrame.CRC16_BIT_LENGTH + CommmandDataFrame.EOI_BIT_LENGTH == len(dataFrame) and commandDataLen >= CommmandDataFrame.COMMAND_BIT_LENGTH:
             pass
         else:
             raise Exception(f'Invalid dataframe')
-        _COMMAND = [dFrame.pop(0) for i in range(CommmandDataFrame.COMMAND_BIT_LENGTH)]
-        _DATA = [dFrame.pop(0) for i in range(commandDataLen - CommmandDataFrame.COMMAND_BIT_LENGTH)]
-        _CRC16 = [dFrame.pop(0) for i in range(CommmandDataFrame.CRC16_BIT_LENGTH)]
-        _EOI = [dFrame.pop(0)]   
-        
-        self.SOI = _SOI
-        self.LEN = _LEN
-        self.COMMAND = _COMMAND
-        self.DATA = _DATA
-        self.CRC16 = _CRC16
-        self.EOI = _EOI
+
+        self.SOI = dataFrame[:CommmandDataFrame.SOI_BIT_LENGTH]
+        self.LEN = dataFrame[CommmandDataFrame.SOI_BIT_LENGTH:dataOffset]
+        self.COMMAND = dataFrame[dataOffset:dataOffset + CommmandDataFrame.COMMAND_BIT_LENGTH]
+        self.DATA = dataFrame[dataOffset + CommmandDataFrame.COMMAND_BIT_LENGTH:crcOffset]
+        self.CRC16 = dataFrame[crcOffset:crcOffset + CommmandDataFrame.CRC16_BIT_LENGTH]
+        self.EOI = dataFrame[-CommmandDataFrame.EOI_BIT_LENGTH:]
         
     def genDataFrame(self, command:int, data:list)->list:
         '''
@@ -120,6 +148,8 @@ class ResponseDataFrame:
     
     SOI_CONSTANT = 0x7e
     EOI_CONSTANT = 0xff
+    
+    HEADER_STRUCT = struct.Struct('<BI') # SOI, LEN
       
     def __init__(self):
         # variable that store 
@@ -140,36 +170,35 @@ class ResponseDataFrame:
         '''
             Extract information inside Response data frame
         '''
-        dFrame = list(dataFrame)
-        if len(dFrame) == 0 or dFrame == None: # Protection for empty datframe
+        if dataFrame == None or len(dataFrame) == 0: # Protection for empty datframe
             raise Exception(f'Data frame is empty')
+        if not isinstance(dataFrame, (bytes, bytearray, memoryview)):
+            dataFrame = bytes(dataFrame)
 
         # Protection for invalid flag
-        if dFrame[0] == ResponseDataFrame.SOI_CONSTANT and dFrame[-1] == ResponseDataFrame.EOI_CONSTANT:
+        if dataFrame[0] == ResponseDataFrame.SOI_CONSTANT and dataFrame[-1] == ResponseDataFrame.EOI_CONSTANT:
             pass
         else:
             raise Exception(f'Wrong dataframe format (INVALID FLAG)')
         
-        _SOI = [dFrame.pop(0) for i in range(ResponseDataFrame.SOI_BIT_LENGTH)]
-        _LEN = [dFrame.pop(0) for i in range(ResponseDataFrame.DATA_FRAME_BIT_LENGTH)]
-        responseLength = Util.Hex2uint(_LEN, ResponseDataFrame.DATA_FRAME_BIT_LENGTH)
-        if responseLength + ResponseDataFrame.CRC16_BIT_LENGTH + ResponseDataFrame.EOI_BIT_LENGTH == len(dFrame):
+        if len(dataFrame) < ResponseDataFrame.HEADER_STRUCT.size:
+            raise Exception(f'Invalid dataframe')
+        _, responseLength = ResponseDataFrame.HEADER_STRUCT.unpack_from(dataFrame, 0)
+        commandOffset = ResponseDataFrame.HEADER_STRUCT.size
+        dataOffset = commandOffset + ResponseDataFrame.COMMAND_BIT_LENGTH + ResponseDataFrame.ERROR_CODE_BIT_LENGTH
+        crcOffset = commandOffset + responseLength
+        if crcOffset + ResponseDataFrame.CRC16_BIT_LENGTH + ResponseDataFrame.EOI_BIT_LENGTH == len(dataFrame) and crcOffset >= dataOffset:
             pass
         else:
             raise Exception(f'Invalid dataframe')
-        _COMMAND = [dFrame.pop(0) for i in range(ResponseDataFrame.COMMAND_BIT_LENGTH)]
-        _ERRORCODE = [dFrame.pop(0) for i in range(ResponseDataFrame.ERROR_CODE_BIT_LENGTH)]
-        _DATA = [dFrame.pop(0) for i in range(responseLength - ResponseDataFrame.COMMAND_BIT_LENGTH - ResponseDataFrame.ERROR_CODE_BIT_LENGTH)]
-        _CRC16 = [dFrame.pop(0) for i in range(ResponseDataFrame.CRC16_BIT_LENGTH)]
-        _EOI = [dFrame.pop(0) for i in range(ResponseDataFrame.EOI_BIT_LENGTH)]
         
-        self.SOI = _SOI
-        self.LEN = _LEN
-        self.COMMAND = _COMMAND
-        self.ERRORCODE = _ERRORCODE
-        self.DATA = _DATA
-        self.CRC16 = _CRC16
-        self.EOI = _EOI
+        self.SOI = dataFrame[:ResponseDataFrame.SOI_BIT_LENGTH]
+        self.LEN = dataFrame[ResponseDataFrame.SOI_BIT_LENGTH:commandOffset]
+        self.COMMAND = dataFrame[commandOffset:commandOffset + ResponseDataFrame.COMMAND_BIT_LENGTH]
+        self.ERRORCODE = dataFrame[commandOffset + ResponseDataFrame.COMMAND_BIT_LENGTH:dataOffset]
+        self.DATA = dataFrame[dataOffset:crcOffset]
+        self.CRC16 = dataFrame[crcOffset:crcOffset + ResponseDataFrame.CRC16_BIT_LENGTH]
+        self.EOI = dataFrame[-ResponseDataFrame.EOI_BIT_LENGTH:]
 
     def toDict(self) -> dict:
         '''
@@ -184,6 +213,214 @@ class ResponseDataFrame:
             'CRC16' : self.CRC16,
             'EOI' : self.EOI
         }
+
+class FrameDecoder:
+    '''
+        Incremental decoder for GENY data frames. Bytes are fed as they arrive from the wire and every
+        complete frame is emitted as soon as its EOI byte is received, based on the LEN field (refer to AT-PRO-YC99T documentation).
+
+        Frame layout: SOI(1) LEN(4, little endian) COMMAND..DATA(LEN) CRC16(2) EOI(1)
+    '''
+    HEADER_LENGTH = ResponseDataFrame.SOI_BIT_LENGTH + ResponseDataFrame.DATA_FRAME_BIT_LENGTH
+    TRAILER_LENGTH = ResponseDataFrame.CRC16_BIT_LENGTH + ResponseDataFrame.EOI_BIT_LENGTH
+    MIN_COMMAND_LENGTH = CommmandDataFrame.COMMAND_BIT_LENGTH
+    MIN_RESPONSE_LENGTH = ResponseDataFrame.COMMAND_BIT_LENGTH + ResponseDataFrame.ERROR_CODE_BIT_LENGTH
+    MIN_LENGTH = MIN_RESPONSE_LENGTH
+    MAX_LENGTH = 0x1000
+    LEN_STRUCT = struct.Struct('<I')
+
+    def __init__(self, onFrame=None, maxLength:int=MAX_LENGTH, checkCRC:bool=False, minLength:int=MIN_LENGTH):
+        '''
+            params:
+                onFrame (function) Function called with every complete frame (bytes). If None, frames are only returned by feed()
+                maxLength (int) Largest LEN value accepted, bigger value is considered as garbage and the decoder resync
+                minLength (int) Smallest LEN value accepted, MIN_RESPONSE_LENGTH (default) for bench responses or MIN_COMMAND_LENGTH for commands
+                checkCRC (bool) If True, frame with CRC16 mismatch is dropped and the decoder resync
+        '''
+        self.onFrame = onFrame
+        self.maxLength = maxLength
+        self.minLength = minLength
+        self.checkCRC = checkCRC
+        self.crcErrors = 0 # number of frames dropped because of CRC16 mismatch
+        self.buffer = bytearray()
+        self.required = 1 # number of buffered bytes needed before next frame could be complete
+        self.discarded = 0 # number of garbage bytes dropped while resynchronizing
+
+    def reset(self):
+        '''
+            Drop any partial frame
+        '''
+        self.buffer.clear()
+        self.required = 1
+
+    def feed(self, data) -> list:
+        '''
+            Push received bytes to decoder. Return list of complete frames found in the stream
+
+            parameters:
+                data (bytes|bytearray|memoryview) incoming bytes, the decoder copies it so caller may reuse the buffer
+        '''
+        buffer = self.buffer
+        buffer += data
+        frames = []
+        if len(buffer) < self.required: # Still waiting for the rest of current frame
+            return frames
+
+        start = 0
+        size = len(buffer)
+        unpackLength = FrameDecoder.LEN_STRUCT.unpack_from
+        while True:
+            # Resync to the next SOI
+            soi = buffer.find(ResponseDataFrame.SOI_CONSTANT, start)
+            if soi < 0:
+                self.discarded += size - start
+                start = size
+                self.required = 1
+                break
+            self.discarded += soi - start
+            start = soi
+
+            if size - start < FrameDecoder.HEADER_LENGTH:
+                self.required = FrameDecoder.HEADER_LENGTH
+                break
+            length = unpackLength(buffer, start + ResponseDataFrame.SOI_BIT_LENGTH)[0]
+            if length < self.minLength or length > self.maxLength:
+                # Bad length, this SOI is garbage
+                self.discarded += 1
+                start += 1
+                continue
+
+            end = start + FrameDecoder.HEADER_LENGTH + length + FrameDecoder.TRAILER_LENGTH
+            if size < end:
+                self.required = end - start
+                break
+            if buffer[end-1] != ResponseDataFrame.EOI_CONSTANT:
+                # EOI not at the computed offset, this SOI is garbage
+                self.discarded += 1
+                start += 1
+                continue
+            if self.checkCRC:
+                crcOffset = end - FrameDecoder.TRAILER_LENGTH
+                crc = CRC16.compute(memoryview(buffer)[start + FrameDecoder.HEADER_LENGTH:crcOffset])
+                if buffer[crcOffset] != crc >> 8 or buffer[crcOffset + 1] != crc & 0xFF:
+                    self.crcErrors += 1
+                    self.discarded += 1
+                    start += 1
+                    continue
+
+            frame = bytes(buffer[start:end])
+            start = end
+            frames.append(frame)
+            if self.onFrame != None:
+                self.onFrame(frame)
+
+        del buffer[:start] # bytearray drops its head without moving the tail
+        return frames
+
+class FrameEncoder:
+    '''
+        Encoder for command data frame with fixed DATA layout. SOI, LEN, COMMAND and EOI are written once into
+        a reusable frame buffer, then every encode() only packs DATA and CRC16 in place.
+    '''
+    def __init__(self, command:int, layout:str):
+        '''
+            params:
+                command (int) command code of the data frame
+                layout (str) struct format of DATA field, shall be little endian (ex: '<BBf')
+        '''
+        self.command = command
+        self.layout = struct.Struct(layout)
+        
+        length = CommmandDataFrame.COMMAND_BIT_LENGTH + self.layout.size
+        self.commandOffset = CommmandDataFrame.HEADER_STRUCT.size
+        self.dataOffset = self.commandOffset + CommmandDataFrame.COMMAND_BIT_LENGTH
+        self.crcOffset = self.commandOffset + length
+        
+        self.frame = bytearray(self.crcOffset + CommmandDataFrame.CRC16_BIT_LENGTH + CommmandDataFrame.EOI_BIT_LENGTH)
+        CommmandDataFrame.HEADER_STRUCT.pack_into(self.frame, 0, CommmandDataFrame.SOI_CONSTANT, length)
+        self.frame[self.commandOffset] = command
+        self.frame[self.commandOffset + 1] = 0x00
+        self.frame[-1] = CommmandDataFrame.EOI_CONSTANT
+        self.view = memoryview(self.frame)
+
+    def encode(self, *values) -> bytes:
+        '''
+            Return complete data frame with DATA field packed from values
+        '''
+        self.layout.pack_into(self.frame, self.dataOffset, *values)
+        crc = CRC16.compute(self.view[self.commandOffset:self.crcOffset])
+        self.frame[self.crcOffset] = crc >> 8
+        self.frame[self.crcOffset + 1] = crc & 0xFF
+        return bytes(self.frame)
+
+class FrameTemplate:
+    '''
+        Prebuilt command data frame. Frames of constant commands are built once and shared through FrameTemplate.get(),
+        while patch() gives a copy with few DATA bytes replaced and only the CRC16 after those bytes recalculated.
+    '''
+    CACHE_SIZE = 256
+    cache = {}
+
+    def __init__(self, command:int, data=b''):
+        '''
+            params:
+                command (int) command code of the data frame
+                data (bytes|list) DATA field
+        '''
+        data = bytes(data)
+        length = CommmandDataFrame.COMMAND_BIT_LENGTH + len(data)
+        self.command = command
+        self.commandOffset = CommmandDataFrame.HEADER_STRUCT.size
+        self.dataOffset = self.commandOffset + CommmandDataFrame.COMMAND_BIT_LENGTH
+        self.crcOffset = self.commandOffset + length
+        
+        frame = bytearray(CommmandDataFrame.HEADER_STRUCT.pack(CommmandDataFrame.SOI_CONSTANT, length))
+        frame.append(command)
+        frame.append(0x00)
+        frame += data
+        frame += CRC16.calc(frame[self.commandOffset:])
+        frame.append(CommmandDataFrame.EOI_CONSTANT)
+        self.frame = bytes(frame)
+        self.prefixCRC = {} # DATA offset -> CRC16 register value of the frame content before that offset
+
+    def get(command:int, data=b''):
+        '''
+            Return cached FrameTemplate of (command, data), build it on first use
+        '''
+        key = (command, bytes(data))
+        template = FrameTemplate.cache.get(key)
+        if template == None:
+            if len(FrameTemplate.cache) >= FrameTemplate.CACHE_SIZE:
+                del FrameTemplate.cache[next(iter(FrameTemplate.cache))]
+            template = FrameTemplate(command, key[1])
+            FrameTemplate.cache[key] = template
+        return template
+
+    def patch(self, offset:int, value) -> bytes:
+        '''
+            Return data frame with DATA bytes starting at offset replaced by value
+
+            parameters:
+                offset (int) position inside DATA field
+                value (bytes|list) new bytes, shall fit inside DATA field
+        '''
+        start = self.dataOffset + offset
+        end = start + len(value)
+        if offset < 0 or end > self.crcOffset:
+            raise DatFrameError(f'Patch does not fit DATA field of command {hex(self.command)}')
+        
+        crc = self.prefixCRC.get(offset)
+        if crc == None:
+            crc = CRC16.compute(self.frame[self.commandOffset:start])
+            self.prefixCRC[offset] = crc
+        
+        frame = bytearray(self.frame)
+        frame[start:end] = value
+        crc = CRC16.compute(memoryview(frame)[start:self.crcOffset], crc)
+        frame[self.crcOffset] = crc >> 8
+        frame[self.crcOffset + 1] = crc & 0xFF
+        return bytes(frame)
+
 class Selector:
     def __init__(self, enum, description):
         self.enum = enum
@@ -315,16 +552,9 @@ class Util:
     # CRC Calculation
     def calc_CRC(data_frame) -> list:
         '''
-            dataframe shall be list of data in decimal. This function returns [Low Byte CRC, High Byte CRC]
+            dataframe shall be list of data in decimal or any bytes-like object. This function returns [Low Byte CRC, High Byte CRC]
         '''
-        l_CRCHi = 0xFF 
-        l_CRCLo = 0xFF 
-        l_Index = 0
-        for i in data_frame:
-            l_Index = l_CRCHi ^ i
-            l_CRCHi = l_CRCLo ^ Util.ct_ArrayCRCHi[l_Index]
-            l_CRCLo = Util.ct_ArrayCRCLo[l_Index]
-        return [l_CRCLo, l_CRCHi]
+        return list(CRC16(data_frame).digest())
 
     # CASTING
     def float2byte(value:float, bytesize:int=4, littleEndia:bool=True)->list:
@@ -388,6 +618,108 @@ class Util:
             #TODO: Convert for big endia
             pass
           
+class CRC16:
+    '''
+        CRC16 engine used by GENY data frame. The checksum covers COMMAND until DATA field.
+
+        Both Util.ct_ArrayCRCHi and Util.ct_ArrayCRCLo are merged into one table of 16 bit entries. The running
+        register keeps the first CRC byte in the low 8 bit and the second in the high 8 bit, so a whole little endian
+        16 bit word can be processed per step with TABLE and TABLE_WORD (the table shifted by one extra byte).
+    '''
+    INITIAL_VALUE = 0xFFFF
+    TABLE = tuple(hi | (lo << 8) for hi, lo in zip(Util.ct_ArrayCRCHi, Util.ct_ArrayCRCLo))
+    TABLE_WORD = (lambda table: tuple((entry >> 8) ^ table[entry & 0xFF] for entry in table))(TABLE)
+    NATIVE_WORD = sys.byteorder == 'little'
+
+    def __init__(self, data=None):
+        '''
+            params:
+                data (bytes|bytearray|memoryview|list) optional first chunk of data
+        '''
+        self.value = CRC16.INITIAL_VALUE
+        if data != None:
+            self.update(data)
+
+    def compute(data, crc:int=INITIAL_VALUE) -> int:
+        '''
+            Continue crc register value with data. Return the new register value
+        '''
+        table = CRC16.TABLE
+        if not isinstance(data, (bytes, bytearray, memoryview)):
+            data = bytes(data)
+        data = memoryview(data).cast('B')
+        length = len(data)
+        if CRC16.NATIVE_WORD and length > 1:
+            tableWord = CRC16.TABLE_WORD
+            even = length & ~1
+            for word in data[:even].cast('H'):
+                x = crc ^ word
+                crc = tableWord[x & 0xFF] ^ table[x >> 8]
+            data = data[even:]
+        for i in data:
+            crc = (crc >> 8) ^ table[(crc ^ i) & 0xFF]
+        return crc
+
+    def update(self, data):
+        '''
+            Continue running CRC with next chunk of data. Return self so calls can be chained
+        '''
+        self.value = CRC16.compute(data, self.value)
+        return self
+
+    def copy(self):
+        '''
+            Return independent CRC16 with the same running value
+        '''
+        other = CRC16()
+        other.value = self.value
+        return other
+
+    def digest(self) -> bytes:
+        '''
+            Return CRC in the order of the CRC16 field [Low Byte CRC, High Byte CRC]
+        '''
+        return self.value.to_bytes(CommmandDataFrame.CRC16_BIT_LENGTH, 'big')
+
+    def calc(data) -> bytes:
+        '''
+            Return CRC16 field of data in one call
+        '''
+        return CRC16.compute(data).to_bytes(CommmandDataFrame.CRC16_BIT_LENGTH, 'big')
+
+    def checkFrame(dataFrame) -> bool:
+        '''
+            Return True if CRC16 field of a complete data frame (command or response) match its content
+        '''
+        return CRC16.checkFrames((dataFrame,))[0]
+
+    def checkFrames(dataFrames) -> list:
+        '''
+            Batch version of checkFrame. Return list of bool, one for each data frame
+        '''
+        compute = CRC16.compute
+        header = FrameDecoder.HEADER_LENGTH
+        trailer = FrameDecoder.TRAILER_LENGTH
+        result = []
+        for dataFrame in dataFrames:
+            end = len(dataFrame) - trailer
+            crc = compute(memoryview(dataFrame)[header:end])
+            result.append(dataFrame[end] == crc >> 8 and dataFrame[end + 1] == crc & 0xFF)
+        return result
+
+    def crcRows(rows):
+        '''
+            Vectorised compute. Return numpy uint16 register value of every row of a 2D uint8 array (rows of equal
+            length COMMAND..DATA fields), one byte column of all rows at a time. Require numpy
+        '''
+        if np == None:
+            raise ImportError('numpy is required for CRC16.crcRows')
+        table = np.array(CRC16.TABLE, dtype=np.uint16)
+        crc = np.full(len(rows), CRC16.INITIAL_VALUE, dtype=np.uint16)
+        for column in rows.T:
+            crc = (crc >> 8) ^ table[(crc ^ column) & 0xFF]
+        return crc
+
 if __name__ == '__main__':
     
     def test_1():
@@ -0,0 +1,228 @@
+from Util import FrameDecoder
+import mmap
+import os
+import struct
+import threading
+import time
+
+class WireCapture:
+    '''
+        Append-only binary log of serial traffic. Attach it to SerialMonitor (capture parameter or serialMonitor.capture attribute) to record every
+        TX and RX chunk with its time.monotonic_ns() timestamp.
+
+        Log file layout:
+            header  MAGIC (8 bytes), VERSION (uint16), reserved (uint16), start time.time_ns() (uint64)
+            records timestamp ns (uint64), direction (uint8), length (uint32), chunk bytes
+        Index file (log path + '.idx'): one record offset (uint64) every INDEX_INTERVAL records, so a reader can seek
+        without scanning the whole log
+    '''
+    MAGIC = b'GENYCAP\x00'
+    VERSION = 1
+    HEADER = struct.Struct('<8sHHQ')
+    RECORD = struct.Struct('<QBI')
+    INDEX_ENTRY = struct.Struct('<Q')
+    INDEX_INTERVAL = 256
+    TX = 0
+    RX = 1
+
+    def __init__(self, path:str):
+        '''
+            params:
+                path (str) log file, created or appended
+        '''
+        self.path = path
+        self.lock = threading.Lock()
+        self.records = 0
+        if os.path.exists(path):
+            self.records = WireCapture.repair(path) # continue numbering so the index stays aligned
+        self.file = open(path, 'ab')
+        self.index = open(path + '.idx', 'ab')
+        if self.records == 0 and self.file.tell() == 0:
+            self.file.write(WireCapture.HEADER.pack(WireCapture.MAGIC, WireCapture.VERSION, 0, time.time_ns()))
+        self.offset = self.file.tell()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def repair(path:str) -> int:
+        '''
+            Cut a log after the last complete record, dropping a record torn by a crash while writing, and rebuild its
+            index from the log when it does not match (entries lost before flush, or past the cut). A log shorter than
+            the header is emptied. Return number of complete records
+        '''
+        size = os.path.getsize(path)
+        if size < WireCapture.HEADER.size:
+            records, end, offsets = 0, 0, []
+        else:
+            with WireReplay(path) as replay:
+                records, end, offsets = replay.scan()
+        if end < size:
+            print(f'[WireCapture] {path}: dropping {size - end} bytes of incomplete record')
+            os.truncate(path, end)
+        index = b''.join(WireCapture.INDEX_ENTRY.pack(offset) for offset in offsets)
+        indexPath = path + '.idx'
+        current = b''
+        if os.path.exists(indexPath):
+            with open(indexPath, 'rb') as f:
+                current = f.read()
+        if current != index:
+            print(f'[WireCapture] {path}: rebuilding index of {records} records')
+            with open(indexPath, 'wb') as f:
+                f.write(index)
+        return records
+
+    def record(self, direction:int, data):
+        '''
+            Append one chunk. Called from the writing thread (TX) and the reading thread (RX)
+        '''
+        timestamp = time.monotonic_ns()
+        header = WireCapture.RECORD.pack(timestamp, direction, len(data))
+        with self.lock:
+            if self.records % WireCapture.INDEX_INTERVAL == 0:
+                self.index.write(WireCapture.INDEX_ENTRY.pack(self.offset))
+            self.file.write(header)
+            self.file.write(data)
+            self.offset += len(header) + len(data)
+            self.records += 1
+
+    def tx(self, data):
+        self.record(WireCapture.TX, data)
+
+    def rx(self, data):
+        self.record(WireCapture.RX, data)
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+            self.index.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+            self.index.close()
+
+class WireReplay:
+    '''
+        Reader of a WireCapture log through mmap. Records are returned as memoryview into the mapping, no copy,
+        so release them before close()
+    '''
+    def __init__(self, path:str):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+        magic, version, _, self.startTime = WireCapture.HEADER.unpack_from(self.map, 0)
+        if magic != WireCapture.MAGIC or version != WireCapture.VERSION:
+            self.close()
+            raise ValueError(f'{path} is not a GENY wire capture version {WireCapture.VERSION}')
+        self.index = ()
+        if os.path.exists(path + '.idx'):
+            with open(path + '.idx', 'rb') as f:
+                data = f.read()
+            self.index = tuple(entry[0] for entry in WireCapture.INDEX_ENTRY.iter_unpack(data[:len(data) - len(data) % WireCapture.INDEX_ENTRY.size]))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.view.release()
+        self.map.close()
+        self.file.close()
+
+    def scan(self) -> tuple:
+        '''
+            Walk record headers without reading data. Return (number of complete records, offset after the last
+            complete record, list of index offsets: one every INDEX_INTERVAL records)
+        '''
+        offset = WireCapture.HEADER.size
+        count = 0
+        offsets = []
+        size = len(self.map)
+        unpack = WireCapture.RECORD.unpack_from
+        headerSize = WireCapture.RECORD.size
+        while offset + headerSize <= size:
+            length = unpack(self.map, offset)[2]
+            if offset + headerSize + length > size:
+                break
+            if count % WireCapture.INDEX_INTERVAL == 0:
+                offsets.append(offset)
+            offset += headerSize + length
+            count += 1
+        return count, offset, offsets
+
+    def records(self, start:int=0, direction:int=None):
+        '''
+            Generator of (timestamp ns, direction, memoryview of chunk)
+
+            parameters:
+                start (int) first record number, located through the index
+                direction (int) WireCapture.TX or WireCapture.RX to filter, None for both
+        '''
+        offset = WireCapture.HEADER.size
+        skip = start
+        if start > 0 and len(self.index) > 0:
+            entry = min(start // WireCapture.INDEX_INTERVAL, len(self.index) - 1)
+            offset = self.index[entry]
+            skip = start - entry * WireCapture.INDEX_INTERVAL
+        size = len(self.map)
+        unpack = WireCapture.RECORD.unpack_from
+        headerSize = WireCapture.RECORD.size
+        while offset + headerSize <= size:
+            timestamp, recordDirection, length = unpack(self.map, offset)
+            offset += headerSize
+            if offset + length > size: # record cut by a crash while writing
+                break
+            if skip > 0:
+                skip -= 1
+            elif direction == None or recordDirection == direction:
+                yield timestamp, recordDirection, self.view[offset:offset + length]
+            offset += length
+
+    def replay(self, onFrame=None, direction:int=WireCapture.RX, realtime:bool=False, speed:float=1.0, checkCRC:bool=True) -> dict:
+        '''
+            Feed recorded chunks through a new FrameDecoder. Return dict with chunks, bytes, frames, discarded bytes and crcErrors
+
+            parameters:
+                onFrame (function) called with every decoded frame
+                direction (int) WireCapture.RX for bench responses, WireCapture.TX for sent commands
+                realtime (bool) If true keep the original timing between chunks, divided by speed, otherwise as fast as possible
+                speed (float) replay speed factor in realtime mode
+                checkCRC (bool) drop frames with wrong CRC16 like SerialMonitor
+        '''
+        minLength = FrameDecoder.MIN_COMMAND_LENGTH if direction == WireCapture.TX else FrameDecoder.MIN_RESPONSE_LENGTH
+        decoder = FrameDecoder(onFrame, checkCRC=checkCRC, minLength=minLength)
+        chunks = received = frames = 0
+        first = None
+        origin = time.monotonic_ns()
+        for timestamp, _, chunk in self.records(direction=direction):
+            if realtime:
+                if first == None:
+                    first = timestamp
+                delay = ((timestamp - first) / speed - (time.monotonic_ns() - origin)) / 1e9
+                if delay > 0:
+                    time.sleep(delay)
+            chunks += 1
+            received += len(chunk)
+            frames += len(decoder.feed(chunk))
+        return {'chunks': chunks, 'bytes': received, 'frames': frames, 'discarded': decoder.discarded, 'crcErrors': decoder.crcErrors}
+
+if __name__ == '__main__':
+    import json
+    import sys
+
+    if len(sys.argv) < 2:
+        print('usage: python WireCapture.py <capture> [--realtime]')
+        exit(1)
+    with WireReplay(sys.argv[1]) as replay:
+        start = time.perf_counter()
+        result = replay.replay(realtime='--realtime' in sys.argv)
+        duration = time.perf_counter() - start
+        result['seconds'] = duration
+        result['framesPerSec'] = result['frames'] / duration if duration > 0 else None
+        print(json.dumps(result, indent=2))
@@ -0,0 +1,79 @@
+import os
+import random
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from GenySimulator import GenySimulator
+from Util import FrameDecoder
+from BatchDecoder import BatchDecoder
+from ErrorCalibration import EnergyErrorCalibration
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+@unittest.skipIf(np == None, 'BatchDecoder requires numpy')
+class TestBatchDecoder(unittest.TestCase):
+    def setUp(self):
+        simulator = GenySimulator(corruptRate=0.02, seed=1)
+        generator = random.Random(2)
+        parts = []
+        for _ in range(2000):
+            kind = generator.random()
+            if kind < 0.45:
+                parts.append(simulator.responseFrame(EnergyErrorCalibration.Command.READBACK_SAMPLING_DATA, 0, simulator.samplingData()))
+            elif kind < 0.9:
+                parts.append(simulator.responseFrame(EnergyErrorCalibration.Command.READBACK_ERROR_SAMPLING, 0, simulator.errorSamplingData()))
+            elif kind < 0.95:
+                parts.append(simulator.responseFrame(EnergyErrorCalibration.Command.TEST_COMMAND, 0))
+            else: # line noise, ending with a false SOI
+                parts.append(bytes(generator.randrange(256) for _ in range(generator.randrange(1, 12))) + b'\x7e')
+        self.buffer = b''.join(parts)
+        self.frames = []
+        self.decoder = FrameDecoder(self.frames.append, checkCRC=True)
+        self.decoder.feed(self.buffer)
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'rx.bin')
+        with open(self.path, 'wb') as f:
+            f.write(self.buffer)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def assertSameResult(self, first, second):
+        self.assertTrue(np.array_equal(first.starts, second.starts))
+        self.assertTrue(np.array_equal(first.ends, second.ends))
+        self.assertEqual(first.sampling.tobytes(), second.sampling.tobytes())
+        self.assertEqual(first.error.tobytes(), second.error.tobytes())
+        self.assertEqual(first.crcErrors, second.crcErrors)
+
+    def test_same_as_stream_decoder(self):
+        result = BatchDecoder.decode(self.buffer)
+        self.assertEqual(result.frames, len(self.frames))
+        self.assertEqual(result.crcErrors, self.decoder.crcErrors)
+        sampling = [bytes(frame[BatchDecoder.DATA_OFFSET:-FrameDecoder.TRAILER_LENGTH]) for frame in self.frames
+                    if frame[FrameDecoder.HEADER_LENGTH] == EnergyErrorCalibration.Command.READBACK_SAMPLING_DATA]
+        expected = np.frombuffer(b''.join(sampling), dtype=BatchDecoder.SAMPLING_DTYPE)
+        for name in expected.dtype.names:
+            self.assertTrue(np.array_equal(expected[name], result.sampling[name], equal_nan=True))
+
+    def test_regions_in_one_process(self):
+        whole = BatchDecoder.decode(self.buffer)
+        regions = BatchDecoder.decodeFile(self.path, chunkSize=len(self.buffer) // 7 + 13)
+        self.assertSameResult(whole, regions)
+
+    def test_regions_in_process_pool(self):
+        single = BatchDecoder.decodeFile(self.path, chunkSize=len(self.buffer) // 3 + 17)
+        pool = BatchDecoder.decodeFile(self.path, processes=2, chunkSize=len(self.buffer) // 3 + 17)
+        self.assertSameResult(single, pool)
+
+    def test_empty_file(self):
+        open(self.path, 'wb').close()
+        self.assertEqual(BatchDecoder.decodeFile(self.path).frames, 0)
+
+if __name__ == '__main__':
+    unittest.main()
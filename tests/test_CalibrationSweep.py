@@ -0,0 +1,59 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from CalibrationSweep import CalibrationSweep, TestPoint as Point
+from ErrorCalibration import EnergyErrorCalibration
+from GenySimulator import GenySimulator
+from GenyTestBench import GenyTestBench
+from Util import ElementSelector, VoltageRange, VoltageRangeError
+
+class PlanningBench:
+    def __init__(self):
+        self.energyErrorCalibration = EnergyErrorCalibration()
+
+class TestPlanning(unittest.TestCase):
+    def setUp(self):
+        self.sweep = CalibrationSweep(PlanningBench())
+        elements = (
+            ElementSelector.EnergyErrorCalibration._A_ELEMENT,
+            ElementSelector.EnergyErrorCalibration._B_ELEMENT,
+            ElementSelector.EnergyErrorCalibration._COMBINE_ALL,
+        )
+        self.points = [Point(voltage, current, 1.0, element) for current in (0.1, 5.0) for voltage in (57.7, 220.0, 300.0) for element in elements]
+
+    def test_smallest_range(self):
+        point = self.sweep.resolve(Point(57.7, 5.0))
+        self.assertIs(point.voltageRange, VoltageRange.YC99T_5C._100V)
+        self.assertIs(self.sweep.resolve(Point(220.0, 5.0)).voltageRange, VoltageRange.YC99T_5C._220V)
+        with self.assertRaises(VoltageRangeError):
+            self.sweep.resolve(Point(1000.0, 5.0))
+
+    def test_plan_reduces_switches(self):
+        for point in self.points:
+            self.sweep.resolve(point)
+        written = self.sweep.switchCount(self.points)
+        ordered = self.sweep.plan(self.points)
+        planned = self.sweep.switchCount(ordered)
+        self.assertEqual(sorted(map(id, ordered)), sorted(map(id, self.points)))
+        self.assertLessEqual(planned['voltageRange'], 3)
+        self.assertLess(planned['voltageRange'] + planned['element'], written['voltageRange'] + written['element'])
+
+@unittest.skipIf(sys.platform.startswith('win'), 'GenySimulator needs a pseudo terminal')
+class TestRun(unittest.TestCase):
+    def test_run_on_simulator(self):
+        with GenySimulator(latency=0.001, seed=1) as simulator:
+            bench = GenyTestBench(simulator.port, verbose=False)
+            try:
+                self.assertTrue(bench.open())
+                results = CalibrationSweep(bench).run([Point(220.0, 5.0), Point(57.7, 1.0), Point(230.0, 5.0)], readbackError=True)
+                self.assertEqual(len(results), 3)
+                self.assertTrue(all(result.applied for result in results))
+                self.assertTrue(all(result.sampling != None and result.error != None for result in results))
+            finally:
+                bench.serialMonitor.stopMonitor()
+
+if __name__ == '__main__':
+    unittest.main()
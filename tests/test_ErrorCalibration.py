@@ -0,0 +1,87 @@
+import os
+import pickle
+import struct
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from ErrorCalibration import EnergyErrorCalibration, SamplingData, ErrorSamplingData, SettleDetector
+from Util import ElementSelector
+
+def sampling(voltage:float, current:float, phase:float=0.0, timestamp:float=0.0) -> SamplingData:
+    values = []
+    for _ in 'ABC':
+        values += [voltage, phase, current, phase, voltage * current, 0.0]
+    return SamplingData(struct.pack('<20f', *values, 3 * voltage * current, 0.0), timestamp)
+
+class TestApplyCommandForm(unittest.TestCase):
+    def setUp(self):
+        self.calibration = EnergyErrorCalibration()
+        self.calibration.setVoltage(220.0)
+        self.calibration.setCurrent(5.0)
+        buffer, register = self.calibration.applyCommandForm()
+        self.assertEqual(buffer[5], EnergyErrorCalibration.Command.TEST_COMMAND)
+        self.calibration.markApplied(register)
+
+    def test_unchanged(self):
+        self.assertEqual(self.calibration.applyCommandForm()[0], None)
+
+    def test_online_adjust(self):
+        self.calibration.setVoltage(230.0)
+        self.calibration.setPowerFactor(0.5)
+        self.calibration.setPowerFactorUnit(EnergyErrorCalibration.PFUnit._C)
+        self.calibration.setFrequency(60.0)
+        buffer, _ = self.calibration.applyCommandForm()
+        self.assertEqual(buffer[5], EnergyErrorCalibration.Command.ONLINE_ADJUST_COMMAND)
+
+    def test_full_command(self):
+        self.calibration.setElementSelector(ElementSelector.EnergyErrorCalibration._A_ELEMENT)
+        self.assertEqual(self.calibration.applyCommandForm()[0][5], EnergyErrorCalibration.Command.TEST_COMMAND)
+        self.calibration.setElementSelector(ElementSelector.EnergyErrorCalibration._COMBINE_ALL)
+        self.assertEqual(self.calibration.applyCommandForm(force=True)[0][5], EnergyErrorCalibration.Command.TEST_COMMAND)
+        self.calibration.markApplied(None)
+        self.assertEqual(self.calibration.applyCommandForm()[0][5], EnergyErrorCalibration.Command.TEST_COMMAND)
+
+class TestEstimateMeasurementTime(unittest.TestCase):
+    def test_estimate(self):
+        calibration = EnergyErrorCalibration()
+        calibration.setVoltage(220.0)
+        calibration.setCurrent(5.0)
+        self.assertEqual(calibration.estimateMeasurementTime(), None) # no meter constant
+        calibration.setCalibrationConstants(1600, 10)
+        self.assertAlmostEqual(calibration.estimateMeasurementTime(), 10 * 3600 * 1000 / (1600 * 3 * 220 * 5))
+        self.assertAlmostEqual(calibration.estimateMeasurementTime(1000.0), 10 * 3600 * 1000 / (1600 * 1000))
+
+class TestSnapshot(unittest.TestCase):
+    def test_immutable_and_picklable(self):
+        sample = sampling(220.0, 5.0, timestamp=1.0)
+        self.assertEqual(sample.Voltage_B, 220.0)
+        with self.assertRaises(AttributeError):
+            sample.Voltage_A = 0.0
+        self.assertEqual(pickle.loads(pickle.dumps(sample)), sample)
+        self.assertEqual(sample.toDict()['TotalPowerActive'], 3300.0)
+        error = ErrorSamplingData(struct.pack('<?fff', True, 0.1, 0.0, 0.0))
+        self.assertTrue(error.ValidFlagBit)
+
+class TestSettleDetector(unittest.TestCase):
+    def setUp(self):
+        calibration = EnergyErrorCalibration()
+        calibration.setVoltage(220.0)
+        calibration.setCurrent(5.0)
+        self.detector = SettleDetector(calibration, tolerance=0.002, window=3, phaseTolerance=0.5)
+
+    def test_settles_after_window(self):
+        results = [self.detector.update(sample) for sample in (sampling(200.0, 5.0), sampling(220.1, 5.0), sampling(220.0, 5.0), sampling(219.9, 5.0))]
+        self.assertEqual(results, [False, False, False, True])
+
+    def test_outlier_restarts_window(self):
+        for sample in (sampling(220.0, 5.0), sampling(220.0, 5.0), sampling(220.0, 4.0), sampling(220.0, 5.0)):
+            self.assertFalse(self.detector.update(sample))
+
+    def test_phase_moving(self):
+        results = [self.detector.update(sampling(220.0, 5.0, phase)) for phase in (359.9, 0.1, 0.2, 2.0)]
+        self.assertEqual(results, [False, False, True, False])
+
+if __name__ == '__main__':
+    unittest.main()
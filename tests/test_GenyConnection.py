@@ -0,0 +1,39 @@
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from GenyConnection import GenyConnection
+
+class FakeMonitor:
+    def addFaultHandler(self, handler):
+        pass
+
+    def stopMonitor(self):
+        pass
+
+class FakeBench:
+    def __init__(self, port:str, baudrate:int, metrics=None):
+        self.port = port
+        self.serialMonitor = FakeMonitor()
+
+class TestGenyConnection(unittest.TestCase):
+    def test_bench_added_after_first_use_runs_in_parallel(self):
+        started = threading.Event()
+        with GenyConnection(benchFactory=FakeBench) as connection:
+            first = connection.submit('A', lambda bench: started.wait(2))
+            second = connection.submit('B', lambda bench: started.set())
+            self.assertTrue(first.result(5)) # A waits for B, so B needs its own thread
+            second.result(5)
+            self.assertEqual(connection.executorWorkers, 2)
+
+    def test_max_workers(self):
+        with GenyConnection(benchFactory=FakeBench, maxWorkers=1) as connection:
+            results = connection.runAll(lambda bench: bench.port, ['A', 'B', 'C'])
+            self.assertEqual(results, {'A': 'A', 'B': 'B', 'C': 'C'})
+            self.assertEqual(connection.executorWorkers, 1)
+
+if __name__ == '__main__':
+    unittest.main()
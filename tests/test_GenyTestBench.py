@@ -0,0 +1,160 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from GenySimulator import GenySimulator
+from GenyTestBench import GenyTestBench
+from AsyncGenyTestBench import AsyncGenyTestBench
+from Util import GenyFaultError
+
+@unittest.skipIf(sys.platform.startswith('win'), 'GenySimulator needs a pseudo terminal')
+class TestReadBackSamplingAndError(unittest.TestCase):
+    def setUp(self):
+        self.simulator = GenySimulator(latency=0.001, seed=1)
+        self.simulator.start()
+        self.bench = GenyTestBench(self.simulator.port)
+        self.assertTrue(self.bench.open())
+
+    def tearDown(self):
+        self.bench.serialMonitor.stopMonitor()
+        self.simulator.stop()
+
+    def test_dropped_response_frees_slot(self):
+        self.simulator.dropRate = 1.0
+        with self.assertRaises(TimeoutError):
+            self.bench.readBackSamplingAndError(timeout=0.5)
+        self.assertEqual(len(self.bench.serialMonitor.inFlight), 0)
+
+        self.simulator.dropRate = 0.0
+        start = time.monotonic()
+        self.bench.readBackSamplingData()
+        self.assertLess(time.monotonic() - start, 1.0)
+
+    def test_both_responses(self):
+        sampling, error = self.bench.readBackSamplingAndError(timeout=2)
+        self.assertFalse(error.ValidFlagBit)
+        self.assertEqual(sampling.Voltage_A, 0.0)
+
+@unittest.skipIf(sys.platform.startswith('win'), 'GenySimulator needs a pseudo terminal')
+class TestAsyncReadBackSamplingAndError(unittest.TestCase):
+    def setUp(self):
+        self.simulator = GenySimulator(latency=0.001, seed=1)
+        self.simulator.start()
+
+    def tearDown(self):
+        self.simulator.stop()
+
+    def test_both_responses_and_timeout(self):
+        async def run():
+            async with AsyncGenyTestBench(self.simulator.port) as bench:
+                sampling, error = await bench.readBackSamplingAndError(timeout=2)
+                self.assertFalse(error.ValidFlagBit)
+                self.assertEqual(sampling.Voltage_A, 0.0)
+                self.simulator.dropRate = 1.0
+                with self.assertRaises(TimeoutError):
+                    await bench.readBackSamplingAndError(timeout=0.3)
+                self.simulator.dropRate = 0.0
+                await bench.readBackSamplingData()
+        asyncio.run(run())
+
+@unittest.skipIf(sys.platform.startswith('win'), 'GenySimulator needs a pseudo terminal')
+class TestFault(unittest.TestCase):
+    def setUp(self):
+        self.simulator = GenySimulator(latency=0.001, streamInterval=0.05, seed=1)
+        self.simulator.start()
+
+    def tearDown(self):
+        self.simulator.stop()
+
+    def test_fault_ends_running_stream(self):
+        bench = GenyTestBench(self.simulator.port, verbose=False)
+        try:
+            self.assertTrue(bench.open())
+            threading.Timer(0.3, self.simulator.injectFault).start()
+            start = time.monotonic()
+            with self.assertRaises(GenyFaultError):
+                for _ in bench.streamSamplingData(timeout=5):
+                    pass
+            self.assertLess(time.monotonic() - start, 2)
+            self.assertEqual(len(bench.serialMonitor.faultHandlers), 0)
+        finally:
+            bench.serialMonitor.stopMonitor()
+
+    def test_fresh_error_every_call(self):
+        bench = GenyTestBench(self.simulator.port, verbose=False)
+        try:
+            self.assertTrue(bench.open())
+            self.simulator.injectFault()
+            time.sleep(0.1)
+            errors = []
+            for _ in range(3):
+                with self.assertRaises(GenyFaultError) as context:
+                    bench.readBackSamplingData()
+                errors.append(context.exception)
+            self.assertEqual(len({id(error) for error in errors}), 3)
+            self.assertEqual(len({len(traceback.format_tb(error.__traceback__)) for error in errors}), 1)
+        finally:
+            bench.serialMonitor.stopMonitor()
+
+    def test_tripped_until_online(self):
+        bench = GenyTestBench(self.simulator.port, verbose=False)
+        try:
+            self.assertTrue(bench.open())
+            self.simulator.injectFault()
+            time.sleep(0.1)
+            bench.serialMonitor.clearFault() # forget the fault without login
+            bench.setVoltage(100)
+            self.assertFalse(bench.apply())
+            self.assertEqual(bench.response.getErrorCode(), GenySimulator.ErrorCode.TRIPPED)
+            self.assertTrue(bench.open())
+            self.assertTrue(bench.apply())
+        finally:
+            bench.serialMonitor.stopMonitor()
+
+    def test_fault_ends_running_async_stream(self):
+        async def run():
+            bench = AsyncGenyTestBench(self.simulator.port)
+            try:
+                self.assertTrue(await bench.open())
+                asyncio.get_running_loop().call_later(0.3, self.simulator.injectFault)
+                start = time.monotonic()
+                with self.assertRaises(GenyFaultError):
+                    async for _ in bench.streamSamplingData(timeout=5):
+                        pass
+                self.assertLess(time.monotonic() - start, 2)
+                self.assertEqual(len(bench.serialMonitor.faultHandlers), 0)
+            finally:
+                bench.serialMonitor.stopMonitor()
+        asyncio.run(run())
+
+@unittest.skipIf(sys.platform.startswith('win'), 'GenySimulator needs a pseudo terminal')
+class TestAsyncDisconnect(unittest.TestCase):
+    def test_disconnect_fails_transactions(self):
+        simulator = GenySimulator(latency=0.5, seed=1)
+        simulator.start()
+        async def run():
+            bench = AsyncGenyTestBench(simulator.port)
+            self.assertTrue(await bench.open())
+            transport = bench.serialMonitor
+            waiting = asyncio.ensure_future(transport.transaction(bench.energyErrorCalibration.readbackSampling(), timeout=5))
+            await asyncio.sleep(0.1)
+            start = time.monotonic()
+            simulator.stop()
+            with self.assertRaises(ConnectionError):
+                await waiting
+            self.assertLess(time.monotonic() - start, 2)
+            self.assertTrue(transport.closed)
+            self.assertEqual(transport.loop, None)
+            with self.assertRaises(ConnectionError):
+                await bench.readBackSamplingData()
+            transport.stopMonitor()
+        asyncio.run(run())
+
+if __name__ == '__main__':
+    unittest.main()
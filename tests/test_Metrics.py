@@ -0,0 +1,51 @@
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from Metrics import Histogram, Metrics
+
+class TestHistogram(unittest.TestCase):
+    def test_quantile(self):
+        histogram = Histogram()
+        self.assertEqual(histogram.quantile(0.5), None)
+        for _ in range(90):
+            histogram.observe(0.002)
+        for _ in range(10):
+            histogram.observe(0.2)
+        self.assertTrue(0.001 <= histogram.quantile(0.5) <= 0.0025)
+        self.assertTrue(0.1 <= histogram.quantile(0.99) <= 0.2)
+        self.assertEqual(histogram.max, 0.2)
+        self.assertEqual(histogram.count, 100)
+
+class TestMetrics(unittest.TestCase):
+    def test_threads(self):
+        metrics = Metrics()
+        def work():
+            for _ in range(1000):
+                metrics.increment('transactions_total', port='A')
+                metrics.observe('transaction_seconds', 0.001, port='A', phase='total')
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(metrics.counter('transactions_total', port='A'), 4000)
+        self.assertEqual(metrics.histogram('transaction_seconds', phase='total', port='A').count, 4000)
+
+    def test_prometheus(self):
+        metrics = Metrics()
+        with metrics.timer('api_seconds', port='/dev/tty"0', method='apply'):
+            pass
+        metrics.increment('api_errors_total', port='/dev/tty"0', method='apply')
+        text = metrics.prometheus()
+        self.assertIn('# TYPE geny_api_seconds histogram', text)
+        self.assertIn('geny_api_seconds_bucket{method="apply",port="/dev/tty\\"0",le="+Inf"} 1', text)
+        self.assertIn('geny_api_errors_total{method="apply",port="/dev/tty\\"0"} 1', text)
+        metrics.reset()
+        self.assertEqual(metrics.toDict(), {'histograms': [], 'counters': []})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from GenySimulator import GenySimulator
+from GenyTestBench import GenyTestBench
+from ErrorCalibration import EnergyErrorCalibration
+
+@unittest.skipIf(sys.platform.startswith('win'), 'GenySimulator needs a pseudo terminal')
+class TestLateResponse(unittest.TestCase):
+    def setUp(self):
+        self.simulator = GenySimulator(latency=0.001, seed=1)
+        self.simulator.start()
+        self.bench = GenyTestBench(self.simulator.port, verbose=False)
+        self.assertTrue(self.bench.open())
+
+    def tearDown(self):
+        self.bench.serialMonitor.stopMonitor()
+        self.simulator.stop()
+
+    def test_timeout_then_next_command(self):
+        monitor = self.bench.serialMonitor
+        self.simulator.latency = 0.4
+        self.assertEqual(monitor.transaction(self.bench.energyErrorCalibration.readbackSampling(), timeout=0.1), b'')
+        self.simulator.latency = 0.001
+
+        # the late READBACK_SAMPLING_DATA response arrives first and shall not answer TEST_COMMAND
+        self.bench.setVoltage(100)
+        self.assertTrue(self.bench.apply())
+        self.assertEqual(self.bench.response.COMMAND[0], EnergyErrorCalibration.Command.TEST_COMMAND)
+        self.bench.readBackSamplingData()
+        self.assertEqual(self.bench.response.COMMAND[0], EnergyErrorCalibration.Command.READBACK_SAMPLING_DATA)
+        self.assertEqual(len(monitor.inFlight), 0)
+
+    def test_failed_write_frees_slot(self):
+        monitor = self.bench.serialMonitor
+        write = monitor.ser.write
+        def failingWrite(data):
+            raise OSError('write failed')
+        monitor.ser.write = failingWrite
+        for _ in range(3): # more than the single slot
+            with self.assertRaises(OSError):
+                monitor.submit(self.bench.energyErrorCalibration.readbackSampling(), timeout=0.5)
+        self.assertEqual(len(monitor.inFlight), 0)
+        monitor.ser.write = write
+        self.bench.readBackSamplingData()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from GenySimulator import GenySimulator
+from GenyTestBench import GenyTestBench
+import TestPlan as plan
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+@unittest.skipIf(np == None, 'TestPlan requires numpy')
+@unittest.skipIf(sys.platform.startswith('win'), 'GenySimulator needs a pseudo terminal')
+class TestTestPlanRun(unittest.TestCase):
+    def setUp(self):
+        self.simulator = GenySimulator(latency=0.001, seed=1)
+        self.simulator.start()
+        self.bench = GenyTestBench(self.simulator.port, verbose=False)
+        self.assertTrue(self.bench.open())
+        self.plan = plan.TestPlan.compile((220, 230, 240), (5, 5, 5), 1.0)
+
+    def tearDown(self):
+        self.bench.serialMonitor.stopMonitor()
+        self.simulator.stop()
+
+    def test_run(self):
+        samples = self.plan.run(self.bench)
+        self.assertEqual(len(samples), 3)
+        self.assertIs(self.bench.lastSampling, samples[-1])
+        self.assertNotEqual(self.bench.appliedAt, None)
+
+    def test_no_response_names_point(self):
+        self.bench.appliedAt = 0.0
+        self.simulator.dropRate = 1.0
+        with self.assertRaisesRegex(TimeoutError, 'point 0'):
+            self.plan.run(self.bench)
+        self.assertEqual(self.bench.appliedAt, None)
+        self.assertEqual(self.bench.lastSampling, None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from Util import Util, CRC16, CommmandDataFrame, ResponseDataFrame, FrameDecoder, FrameTemplate
+from ErrorCalibration import EnergyErrorCalibration
+from Benchmark import Benchmark
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+def responseFrame(command:int, data:bytes=b'', errorCode:int=0) -> bytes:
+    body = bytes((command, 0x00, errorCode)) + data
+    return ResponseDataFrame.HEADER_STRUCT.pack(ResponseDataFrame.SOI_CONSTANT, len(body)) + body + CRC16.calc(body) + bytes((ResponseDataFrame.EOI_CONSTANT,))
+
+class TestCRC16(unittest.TestCase):
+    def setUp(self):
+        generator = random.Random(1)
+        self.payloads = [bytes(generator.randrange(256) for _ in range(size)) for size in range(0, 300, 7)]
+
+    def test_same_as_legacy(self):
+        for payload in self.payloads:
+            expected = Benchmark.legacyCRC(payload)
+            self.assertEqual(Util.calc_CRC(list(payload)), expected)
+            self.assertEqual(list(CRC16.calc(payload)), expected)
+            self.assertEqual(CRC16.compute(payload), expected[0] << 8 | expected[1])
+
+    def test_incremental(self):
+        payload = self.payloads[-1]
+        crc = CRC16()
+        for i in range(0, len(payload), 10):
+            crc.update(payload[i:i + 10])
+        self.assertEqual(crc.digest(), CRC16.calc(payload))
+        self.assertEqual(CRC16.compute(payload[100:], CRC16.compute(payload[:100])), CRC16.compute(payload))
+
+    @unittest.skipIf(np == None, 'crcRows requires numpy')
+    def test_rows(self):
+        rows = np.frombuffer(b''.join(payload[:32] for payload in self.payloads if len(payload) >= 32), dtype=np.uint8).reshape(-1, 32)
+        expected = [CRC16.compute(bytes(row)) for row in rows]
+        self.assertEqual(CRC16.crcRows(rows).tolist(), expected)
+
+class TestFrameDecoder(unittest.TestCase):
+    def setUp(self):
+        self.frames = [responseFrame(0xd2, bytes(range(80))), responseFrame(0x01), responseFrame(0xd5, b'\x01\x02\x03\x04')]
+        self.stream = b''.join(self.frames)
+
+    def test_split_frames(self):
+        received = []
+        decoder = FrameDecoder(received.append, checkCRC=True)
+        for i in range(len(self.stream)):
+            decoder.feed(self.stream[i:i + 1])
+        self.assertEqual(received, self.frames)
+        self.assertEqual(decoder.discarded, 0)
+
+    def test_merged_frames(self):
+        decoder = FrameDecoder(checkCRC=True)
+        self.assertEqual(decoder.feed(self.stream * 3), self.frames * 3)
+
+    def test_bad_crc(self):
+        corrupted = bytearray(self.frames[0])
+        corrupted[-3] ^= 0xFF
+        decoder = FrameDecoder(checkCRC=True)
+        self.assertEqual(decoder.feed(bytes(corrupted) + self.frames[1]), [self.frames[1]])
+        self.assertEqual(decoder.crcErrors, 1)
+        self.assertEqual(FrameDecoder().feed(bytes(corrupted)), [bytes(corrupted)]) # not checked by default
+
+    def test_resync_after_garbage(self):
+        garbage = b'\x00\x7e\xff\xff\xff\xff\x7e\x02\x00\x00\x00\x11'
+        decoder = FrameDecoder(checkCRC=True)
+        self.assertEqual(decoder.feed(garbage + self.frames[0] + garbage[:3]), [self.frames[0]])
+        self.assertEqual(decoder.feed(garbage[3:] + self.frames[2]), [self.frames[2]])
+
+    def test_truncated_frame_then_valid(self):
+        decoder = FrameDecoder(checkCRC=True)
+        self.assertEqual(decoder.feed(self.frames[0][:40] + self.frames[1]), []) # waiting for the announced length
+        self.assertEqual(decoder.feed(self.frames[0]), [self.frames[1], self.frames[0]])
+
+    def test_min_length(self):
+        command = bytes(CommmandDataFrame().genDataFrame(EnergyErrorCalibration.Command.STOP_TEST_COMMAND, []))
+        self.assertEqual(FrameDecoder(checkCRC=True).feed(command), [])
+        self.assertEqual(FrameDecoder(checkCRC=True, minLength=FrameDecoder.MIN_COMMAND_LENGTH).feed(command), [command])
+
+class TestFrameEncoder(unittest.TestCase):
+    def legacyTestCommandForm(self, calibration) -> bytes:
+        '''
+            TEST_COMMAND built field by field like the first setTestCommandForm
+        '''
+        apdu = []
+        for value, size in zip(calibration.getRegister(), (1, 1, 1, 4, 4, 4, 1, 4, 4, 2)):
+            if size == 1:
+                apdu.append(value)
+            elif size == 2:
+                apdu.extend(Util.uint2byteList(value, size))
+            else:
+                apdu.extend(Util.float2byte(value, size))
+        return bytes(CommmandDataFrame().genDataFrame(EnergyErrorCalibration.Command.TEST_COMMAND, apdu))
+
+    def test_test_command_form(self):
+        calibration = EnergyErrorCalibration()
+        self.assertEqual(calibration.setTestCommandForm(), self.legacyTestCommandForm(calibration))
+        for voltage, current, powerFactor, frequency in ((220.0, 5.0, 1.0, 50.0), (57.7, 0.25, -0.5, 60.0), (380.0, 100.0, 0.0, 45.5)):
+            calibration.setVoltage(voltage)
+            calibration.setCurrent(current)
+            calibration.setPowerFactor(powerFactor)
+            calibration.setFrequency(frequency)
+            calibration.setCalibrationConstants(1600, 10)
+            self.assertEqual(calibration.setTestCommandForm(), self.legacyTestCommandForm(calibration))
+
+    def test_readback_templates(self):
+        calibration = EnergyErrorCalibration()
+        for count, flag in ((1, 1), ('*', 2), (0, 0)):
+            self.assertEqual(calibration.readbackSampling(count), bytes(CommmandDataFrame().genDataFrame(EnergyErrorCalibration.Command.READBACK_SAMPLING_DATA, [flag])))
+            self.assertEqual(calibration.readbackErrorSampling(count), bytes(CommmandDataFrame().genDataFrame(EnergyErrorCalibration.Command.READBACK_ERROR_SAMPLING, [flag])))
+
+    def test_template_patch(self):
+        template = FrameTemplate(EnergyErrorCalibration.Command.TEST_COMMAND, bytes(range(20)))
+        self.assertEqual(template.patch(5, b'\xaa\xbb'), FrameTemplate(EnergyErrorCalibration.Command.TEST_COMMAND, bytes(range(5)) + b'\xaa\xbb' + bytes(range(7, 20))).frame)
+        self.assertEqual(template.patch(5, b'\x05\x06'), template.frame)
+
+if __name__ == '__main__':
+    unittest.main()
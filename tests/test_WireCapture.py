@@ -0,0 +1,70 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from Util import CRC16, ResponseDataFrame
+from WireCapture import WireCapture, WireReplay
+
+class TestWireCapture(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'capture.bin')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, first:int, count:int):
+        with WireCapture(self.path) as capture:
+            for i in range(first, first + count):
+                capture.record(i % 2, i.to_bytes(4, 'little'))
+
+    def read(self, start:int=0) -> list:
+        with WireReplay(self.path) as replay:
+            values = []
+            for _, _, chunk in replay.records(start=start):
+                values.append(int.from_bytes(chunk, 'little'))
+                chunk.release()
+        return values
+
+    def test_records_from_index(self):
+        self.write(0, 1000)
+        self.assertEqual(self.read(700), list(range(700, 1000)))
+        self.assertEqual(len(self.read()), 1000)
+
+    def test_torn_record_dropped_before_append(self):
+        self.write(0, 10)
+        with open(self.path, 'ab') as f:
+            f.write(WireCapture.RECORD.pack(0, WireCapture.RX, 100) + b'\x00' * 10)
+        self.write(10, 10)
+        self.assertEqual(self.read(), list(range(20)))
+
+    def test_short_index_rebuilt(self):
+        self.write(0, 600)
+        os.truncate(self.path + '.idx', WireCapture.INDEX_ENTRY.size) # entries lost before flush
+        self.write(600, 400)
+        self.assertEqual(os.path.getsize(self.path + '.idx'), 4 * WireCapture.INDEX_ENTRY.size)
+        self.assertEqual(self.read(700), list(range(700, 1000)))
+
+    def test_missing_index_rebuilt(self):
+        self.write(0, 300)
+        os.remove(self.path + '.idx')
+        self.write(300, 300)
+        self.assertEqual(self.read(550), list(range(550, 600)))
+
+    def test_replay_frames(self):
+        body = bytes((0x01, 0x00, 0x00))
+        frame = ResponseDataFrame.HEADER_STRUCT.pack(ResponseDataFrame.SOI_CONSTANT, len(body)) + body + CRC16.calc(body) + bytes((ResponseDataFrame.EOI_CONSTANT,))
+        with WireCapture(self.path) as capture:
+            capture.rx(frame[:3])
+            capture.rx(frame[3:] + frame)
+            capture.tx(b'\x00')
+        with WireReplay(self.path) as replay:
+            result = replay.replay()
+        self.assertEqual(result['frames'], 2)
+        self.assertEqual(result['crcErrors'], 0)
+
+if __name__ == '__main__':
+    unittest.main()